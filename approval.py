@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具调用的用户确认（HOST.NEED_USER_CONFIRM）。确认不阻塞事件循环：stdin在线程中读取，等待期间server的连接
+（streamable HTTP的keepalive、SSE的读取、stdio的管道）和其他对话照常进行。
+  - 批量确认：模型一步返回的所有工具调用一起确认，一次回答即可全部允许、全部拒绝或只允许其中几个；
+  - 长期允许：HOST.AUTO_APPROVE_TOOLS/AUTO_APPROVE_SERVERS中的工具和server不再询问，确认时也可以回答t/s，
+    在本次会话中一直允许这些工具或它们所在的server。
+等待确认的时间单独统计，不计入工具调用的耗时，也不计入HOST.QUERY_TIMEOUT。
+'''
+
+import time
+import asyncio
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+PROMPT_HELP = "Enter/y: call, n: cancel, t: always allow {tools}, s: always allow {servers}"
+BATCH_PROMPT_HELP = "Enter/y: call all, n: cancel all, 1,3: call only these, t: always allow these tools, s: always allow their servers"
+
+
+async def read_stdin(prompt: str) -> str:
+    """A line from stdin, read in a thread so the event loop keeps running"""
+    return await asyncio.to_thread(input, prompt)
+
+
+def parse_selection(answer: str, count: int) -> Optional[List[int]]:
+    """Indices (0-based) of calls selected by numbers such as "1,3" or "1 3", None if the answer is not a selection"""
+    parts = answer.replace(",", " ").split()
+    if not parts or not all(part.isdigit() for part in parts):
+        return None
+    return sorted({int(part) - 1 for part in parts if 1 <= int(part) <= count})
+
+
+class ToolApprovals:
+    def __init__(self, tools: Iterable[str] = (), servers: Iterable[str] = (),
+                 prompt: Optional[Callable[[str], Awaitable[str]]] = None):
+        """
+        Args:
+            tools: tools allowed without asking, by the server's tool name or the name shown to the model
+            servers: servers whose tools are allowed without asking
+            prompt: asks the user, returns the answer; reads stdin if None
+        """
+        self.tools = set(tools)
+        self.servers = set(servers)
+        self.prompt = prompt or read_stdin
+        self._lock = asyncio.Lock() # one question on the terminal at a time
+        self.asked = 0 # questions, one per step with calls to confirm
+        self.approved = 0
+        self.refused = 0
+        self.auto_approved = 0 # calls covered by a standing approval
+        self.total_wait = 0.0
+
+    def is_allowed(self, names: Tuple[str, ...], server_name: Optional[str]) -> bool:
+        return any(name in self.tools for name in names) or server_name in self.servers
+
+    async def confirm(self, calls: List[Tuple[Tuple[str, ...], Optional[str]]]) -> Tuple[List[bool], float]:
+        """
+        Ask once about the calls of a step that no standing approval covers
+
+        Args:
+            calls: (names of the tool, its server) of each call, the names as shown to the model first
+
+        Returns:
+            whether each call is approved, and the seconds spent waiting for the answer
+        """
+        approved = [self.is_allowed(names, server_name) for names, server_name in calls]
+        self.auto_approved += sum(approved)
+        pending = [i for i, allowed in enumerate(approved) if not allowed]
+        if not pending:
+            return approved, 0.0
+
+        async with self._lock:
+            start_time = time.perf_counter()
+            if len(pending) == 1:
+                names, server_name = calls[pending[0]]
+                question = "Do you want to call this tool? ({}): ".format(
+                    PROMPT_HELP.format(tools=names[0], servers=server_name or "its server"))
+            else:
+                listing = "".join(f"  {n}. {calls[i][0][0]}\n" for n, i in enumerate(pending, 1))
+                question = f"Do you want to call these {len(pending)} tools?\n{listing}({BATCH_PROMPT_HELP}): "
+            answer = (await self.prompt(question)).strip().lower()
+            wait = time.perf_counter() - start_time
+        self.asked += 1
+        self.total_wait += wait
+
+        if answer == "n":
+            selected = []
+        elif answer == "t":
+            self.tools.update(calls[i][0][0] for i in pending)
+            selected = pending
+        elif answer == "s":
+            servers = {calls[i][1] for i in pending if calls[i][1] is not None}
+            self.servers.update(servers)
+            # host tools such as read_blob have no server, they are allowed as tools
+            self.tools.update(calls[i][0][0] for i in pending if calls[i][1] is None)
+            selected = pending
+        else:
+            selection = parse_selection(answer, len(pending)) if len(pending) > 1 else None
+            # any other answer calls the tools, as before batch approval
+            selected = pending if selection is None else [pending[n] for n in selection]
+        for i in selected:
+            approved[i] = True
+        self.approved += len(selected)
+        self.refused += len(pending) - len(selected)
+        if answer in ("t", "s"):
+            logger.info(f"Standing approvals: tools {sorted(self.tools)}, servers {sorted(self.servers)}")
+        return approved, wait
+
+    def stats(self) -> dict:
+        return {
+            "asked": self.asked, "approved": self.approved, "refused": self.refused, "auto_approved": self.auto_approved,
+            "avg_wait": round(self.total_wait / self.asked, 3) if self.asked else 0.0,
+            "tools": sorted(self.tools), "servers": sorted(self.servers),
+        }
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+'''
+批量模式：从JSONL文件读取问题（每行 {"id": ..., "query": ...}，id可省略），
+每个问题在独立的对话中处理，所有对话共享同一组server连接和模型client，按BATCH.CONCURRENCY并发。
+带有相同"conversation"的问题按顺序在同一个对话中处理。也可以直接读取对话记录（HOST.TRANSCRIPT_FILE），
+其中的用户消息按原来的对话重放，配合CASSETTE.MODE = "replay"即可把录制的真实对话当作回归与性能测试的负载。
+每个问题的结果写入JSONL，结束时打印吞吐量和延迟的p50/p95/p99。
+'''
+
+import os
+import json
+import math
+import time
+import asyncio
+from typing import Dict, List
+
+from loguru import logger
+
+
+def load_queries(path: str) -> List[dict]:
+    """
+    Read {"id", "query"} records from a JSONL file, blank lines are skipped and missing ids are numbered.
+    Lines of a transcript file give the user messages as queries, tagged with their conversation.
+    """
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"query": record}
+            elif isinstance(record.get("message"), dict):
+                # a transcript line, only the user messages are replayed
+                if record["message"].get("role") != "user":
+                    continue
+                record = {"query": record["message"].get("content"), "conversation": record.get("conversation")}
+            if not record.get("query"):
+                raise ValueError(f"{path}:{line_no} has no query")
+            record.setdefault("id", len(queries) + 1)
+            queries.append(record)
+    return queries
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile, 0.0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def run_batch(client, queries: List[dict], output_file: str, concurrency: int) -> dict:
+    """
+    Run queries through the client, each in its own conversation, at most concurrency at a time.
+    Queries with the same "conversation" run one after the other in one conversation, in file order.
+
+    Args:
+        client: a MyMCPClient already connected to its servers
+        queries: records from load_queries
+        output_file: one JSON result per query is appended here, in completion order
+        concurrency: number of queries processed at the same time
+
+    Returns:
+        summary of the batch: counts, throughput, latency percentiles and token totals
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    results = []
+
+    async def run_one(record: dict, conversation, out):
+        async with semaphore:
+            result = {"id": record["id"], "query": record["query"], "conversation": conversation.id}
+            if record.get("conversation") is not None:
+                result["source_conversation"] = record["conversation"]
+            start_time = time.perf_counter()
+            try:
+                summary = await client.process_query(record["query"], conversation)
+                result.update(ok=summary["stop_reason"] is None, error=summary["stop_reason"], **summary)
+            except Exception as e:
+                logger.error(f"Batch query {record['id']} failed: {e}")
+                result.update(ok=False, error=str(e), latency=time.perf_counter() - start_time)
+            results.append(result)
+            out.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            print(f"[{len(results)}/{len(queries)}] {record['id']}: {'ok' if result['ok'] else 'failed'} in {result['latency']:.2f}s")
+
+    async def run_group(records: List[dict], out):
+        conversation = client.new_conversation()
+        for record in records:
+            await run_one(record, conversation, out)
+
+    groups: Dict[str, List[dict]] = {}
+    for record in queries:
+        key = record.get("conversation")
+        groups.setdefault(f"conversation:{key}" if key is not None else f"query:{id(record)}", []).append(record)
+
+    start_time = time.perf_counter()
+    with open(output_file, "a", encoding="utf-8") as out:
+        await asyncio.gather(*(run_group(records, out) for records in groups.values()))
+    wall_time = time.perf_counter() - start_time
+
+    latencies = [result["latency"] for result in results]
+    summary = {
+        "queries": len(results),
+        "ok": sum(1 for result in results if result["ok"]),
+        "concurrency": concurrency,
+        "wall_time": wall_time,
+        "throughput": len(results) / wall_time if wall_time else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "prompt_tokens": sum(result.get("prompt_tokens", 0) for result in results),
+        "cached_tokens": sum(result.get("cached_tokens", 0) for result in results),
+        "completion_tokens": sum(result.get("completion_tokens", 0) for result in results),
+        "tool_calls": sum(result.get("tool_calls", 0) for result in results),
+    }
+    logger.info(f"Batch finished: {summary}")
+    return summary
+
+
+def print_summary(summary: dict):
+    print("\nBatch finished: {ok}/{queries} ok, concurrency {concurrency}".format(**summary))
+    print("Wall time: {wall_time:.2f}s, throughput: {throughput:.2f} queries/s".format(**summary))
+    print("Latency p50: {latency_p50:.2f}s, p95: {latency_p95:.2f}s, p99: {latency_p99:.2f}s".format(**summary))
+    print("Tokens: {prompt_tokens} prompt ({cached_tokens} cached), {completion_tokens} completion, tool calls: {tool_calls}".format(**summary))
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+'''
+基准测试用的本地模型：一个兼容OpenAI接口（POST /v1/chat/completions，支持流式和非流式）的确定性替身。
+按scenarios.json中的剧本回应：最新的用户问题匹配到剧本后，依次返回每一步的工具调用，最后给出回答；
+发送的工具里缺少剧本要调用的工具时，先调用request_all_tools。
+首个token前的延迟和生成速度（token/秒）可以设置，prompt缓存按64 token的块模拟前缀命中。
+还可以注入故障：按比例返回500错误，或按比例额外延迟（用于测试多服务商路由的故障切换与对冲请求）；
+设置容量后，超过容量的并发请求收到带Retry-After的429（用于测试限流、重试与并发控制）。
+
+用法：python benchmarks/fake_llm.py --port 9999 --latency 0.05 --token-rate 200 [--error-rate 0.1 --slow-rate 0.2 --slow-latency 2]
+      [--capacity 4 --retry-after 0.5]
+'''
+
+import sys
+import json
+import random
+import asyncio
+import argparse
+from typing import List, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+ALL_TOOLS_NAME = "request_all_tools"
+CACHE_BLOCK_TOKENS = 64
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def find_tool(name: str, offered: List[str]) -> Optional[str]:
+    """Offered tool for a scripted tool name, the host may prefix names that clash"""
+    for offered_name in offered:
+        if offered_name == name or offered_name.endswith("_" + name):
+            return offered_name
+    return None
+
+
+class FakeLLM:
+    def __init__(self, scenarios: List[dict], latency: float, token_rate: float, cache_prefixes: int = 64,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 0.0, seed: int = 0,
+                 capacity: int = 0, retry_after: float = 0.5):
+        """
+        Args:
+            scenarios: scripts from scenarios.json, matched by their query
+            latency: seconds before the first token
+            token_rate: completion tokens per second, 0 for no generation delay
+            cache_prefixes: number of recent prompts kept for the simulated prompt cache
+            error_rate: fraction of requests answered with a 500 error
+            slow_rate: fraction of requests delayed by slow_latency more seconds before the first token
+            seed: seed of the injected faults, so runs are repeatable
+            capacity: concurrent requests served, more are answered with 429 and retry_after; 0 for no limit
+        """
+        self.scenarios = {scenario["query"]: scenario for scenario in scenarios}
+        self.latency = latency
+        self.token_rate = token_rate
+        self.cache_prefixes = cache_prefixes
+        self._prompts: List[str] = []
+        self.requests = 0
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._faults = random.Random(seed)
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.inflight = 0
+        self.throttled = 0
+        self.app = Starlette(routes=[Route("/v1/chat/completions", self.chat_completions, methods=["POST"])])
+
+    def respond(self, messages: List[dict], tools: List[dict]) -> dict:
+        """Next assistant message of the script of the latest user query"""
+        user_index = max((i for i, message in enumerate(messages) if message["role"] == "user"), default=-1)
+        query = messages[user_index].get("content") if user_index >= 0 else ""
+        scenario = self.scenarios.get(query)
+        if scenario is None:
+            return {"role": "assistant", "content": f"No script for: {str(query)[:80]}"}
+
+        since_query = messages[user_index + 1:]
+        called = [
+            [tool_call["function"]["name"] for tool_call in message["tool_calls"]]
+            for message in since_query if message["role"] == "assistant" and message.get("tool_calls")
+        ]
+        done_steps = sum(1 for names in called if names != [ALL_TOOLS_NAME])
+        steps = scenario.get("steps") or []
+        if done_steps < len(steps):
+            offered = [tool["function"]["name"] for tool in tools or []]
+            resolved = [(find_tool(call["name"], offered), call["arguments"]) for call in steps[done_steps]]
+            if any(name is None for name, _ in resolved) and ALL_TOOLS_NAME in offered and [ALL_TOOLS_NAME] not in called:
+                resolved = [(ALL_TOOLS_NAME, {})]
+            tool_calls = [
+                {"id": f"call_{done_steps}_{i}", "type": "function",
+                 "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)}}
+                for i, (name, arguments) in enumerate(resolved) if name is not None
+            ]
+            if tool_calls:
+                return {"role": "assistant", "content": None, "tool_calls": tool_calls}
+        return {"role": "assistant", "content": scenario.get("answer", "Done.")}
+
+    def usage(self, prompt: str, message: dict) -> dict:
+        """Token usage of a response, with the longest prefix shared with a recent prompt counted as cached"""
+        best = 0
+        for previous in self._prompts:
+            shared = 0
+            for a, b in zip(previous, prompt):
+                if a != b:
+                    break
+                shared += 1
+            best = max(best, shared)
+        self._prompts = (self._prompts + [prompt])[-self.cache_prefixes:]
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = self.completion_tokens(message)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": best // CHARS_PER_TOKEN // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS},
+        }
+
+    @staticmethod
+    def completion_tokens(message: dict) -> int:
+        return count_tokens(message.get("content") or "") + sum(
+            count_tokens(tool_call["function"]["arguments"]) + 1 for tool_call in message.get("tool_calls") or [])
+
+    async def generate(self, tokens: int):
+        if self.token_rate > 0:
+            await asyncio.sleep(tokens / self.token_rate)
+
+    async def chat_completions(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        if self.capacity and self.inflight >= self.capacity:
+            self.throttled += 1
+            return JSONResponse({"error": {"message": "rate limit exceeded", "type": "rate_limit_error"}}, status_code=429,
+                                headers={"retry-after": str(self.retry_after)})
+        self.inflight += 1
+        try:
+            response = await self.answer(body)
+        except BaseException:
+            self.inflight -= 1
+            raise
+        if not isinstance(response, StreamingResponse):
+            self.inflight -= 1
+        return response
+
+    async def answer(self, body: dict):
+        """The response to a request, a streamed one counts as in flight until its last chunk"""
+        if self._faults.random() < self.error_rate:
+            await asyncio.sleep(self.latency)
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=500)
+        if self._faults.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_latency)
+        message = self.respond(body["messages"], body.get("tools"))
+        usage = self.usage(json.dumps({"tools": body.get("tools"), "messages": body["messages"]}, ensure_ascii=False), message)
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+        base = {"id": f"chatcmpl-{self.requests}", "created": 0, "model": body["model"]}
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream"):
+            await self.generate(usage["completion_tokens"])
+            return JSONResponse({
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        def chunk(delta: dict, finish: Optional[str] = None) -> str:
+            return "data: " + json.dumps({
+                **base, "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }, ensure_ascii=False) + "\n\n"
+
+        async def event_stream():
+            try:
+                async for event in events():
+                    yield event
+            finally:
+                self.inflight -= 1
+
+        async def events():
+            content = message.get("content") or ""
+            for start in range(0, len(content), CHARS_PER_TOKEN):
+                yield chunk({"content": content[start:start + CHARS_PER_TOKEN]})
+                await self.generate(1)
+            for index, tool_call in enumerate(message.get("tool_calls") or []):
+                yield chunk({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function",
+                                             "function": {"name": tool_call["function"]["name"], "arguments": ""}}]})
+                arguments = tool_call["function"]["arguments"]
+                for start in range(0, len(arguments), CHARS_PER_TOKEN):
+                    yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + CHARS_PER_TOKEN]}}]})
+                    await self.generate(1)
+            yield chunk({}, finish_reason)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}) + "\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deterministic OpenAI-compatible stand-in for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--scenarios", default=None, help="scenario file (default benchmarks/scenarios.json)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="completion tokens per second, 0 for no delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with HTTP 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests delayed by --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="extra seconds of a slow request")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the injected faults")
+    parser.add_argument("--capacity", type=int, default=0, help="concurrent requests served, more get HTTP 429; 0 for no limit")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After seconds of a 429 response")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios_file = args.scenarios or __file__.replace("fake_llm.py", "scenarios.json")
+    with open(scenarios_file, "r", encoding="utf-8") as f:
+        scenarios = json.load(f)
+    fake = FakeLLM(scenarios, latency=args.latency, token_rate=args.token_rate, error_rate=args.error_rate,
+                   slow_rate=args.slow_rate, slow_latency=args.slow_latency, seed=args.seed,
+                   capacity=args.capacity, retry_after=args.retry_after)
+    print(f"Fake LLM with {len(scenarios)} scenarios on http://{args.host}:{args.port}/v1", file=sys.stderr)
+    uvicorn.run(fake.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+'''
+端到端基准测试：启动本地的确定性模型替身（fake_llm.py）和CatCom（streamable HTTP）、AlienCom（SSE）两个server，
+timetools由host通过stdio启动，然后用MyMCPClient测量：
+  startup   冷启动连接全部server的耗时；工具清单缓存命中时（延迟启动）的耗时，以及之后第一次调用工具的耗时
+  dispatch  每种连接方式下，host调用工具（execute_tool_call）比直接调用session.call_tool多出的开销
+  turns     scenarios.json中每个场景一轮对话的延迟、其中请求模型的时间（每轮第一次与之后各次调用分开统计）、步数与token数，
+            以及只读工具在流式回应结束前预先执行（HOST.SPECULATIVE_TOOLS）节省的时间
+  memory    host进程各阶段的内存（RSS）与峰值、每个会话占用的内存，以及各server进程的内存
+结果写入JSON文件（默认logs/benchmarks/），用--compare与之前的结果逐项对比。
+
+用法（在项目根目录运行）：
+  python benchmarks/run.py [--turns 10] [--latency 0.05] [--token-rate 200] [--compare logs/benchmarks/xxx.json]
+  python benchmarks/run.py --set MODEL.STREAM False HOST.TOOL_SELECTION_TOP_K 0
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loguru import logger
+
+import host
+from batch import percentile
+from config import get_cfg_defaults
+
+BENCHMARK_DIR = os.path.join(ROOT, "benchmarks")
+MODEL_MARK = "BENCHMARK"
+MODEL_NAME = "fake-llm"
+SPAN_METRIC = "mcp_host_span_duration_seconds"
+
+# one tool per transport for the dispatch benchmark, none of them is cached by the host
+DISPATCH_TOOLS = {
+    "stdio": ("get_current_time", {}),
+    "streamable_http": ("summon_cat", {"signal": "benchmark"}),
+    "sse": ("summon_alien", {"signal": "benchmark"}),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_rss(pid="self") -> Optional[int]:
+    """Resident memory of a process in bytes, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def child_pids(pid) -> List[int]:
+    """Pids of all descendants of a process (Linux only, empty elsewhere)"""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in child_pids(child)]
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident memory of this process in bytes"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def to_mb(value: Optional[int]) -> Optional[float]:
+    return round(value / 2**20, 2) if value is not None else None
+
+
+def describe(values: List[float], scale: float = 1000.0) -> dict:
+    """Count, mean and percentiles of durations in seconds, reported in milliseconds by default"""
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values) * scale, 3),
+        "p50": round(percentile(values, 50) * scale, 3),
+        "p95": round(percentile(values, 95) * scale, 3),
+        "min": round(min(values) * scale, 3),
+        "max": round(max(values) * scale, 3),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def exposed_name(client: host.MyMCPClient, tool: str) -> str:
+    """Name under which the host offers a server tool to the model"""
+    return next(name for name, (_, server_tool) in client.tool_routes.items() if server_tool == tool)
+
+
+def start_process(name: str, command: List[str], log_dir: str) -> subprocess.Popen:
+    log_file = open(os.path.join(log_dir, f"{name}.log"), "w", encoding="utf-8")
+    return subprocess.Popen(command, cwd=ROOT, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+async def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"nothing listens on port {port} after {timeout}s")
+            await asyncio.sleep(0.05)
+
+
+async def bench_startup(make_client, manifest_file: str, runs: int) -> dict:
+    """
+    Connect fresh clients to all servers: first without a manifest cache (every server starts),
+    then with the manifest the first client stored (script servers are deferred with SERVER.LAZY_START)
+    followed by one call of a deferred tool, which starts its server.
+    """
+    cold, cached, first_call = [], [], []
+    deferred = 0
+    for _ in range(runs):
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        client = make_client()
+        start_time = time.perf_counter()
+        await client.connect_to_servers(wait_all=True)
+        cold.append(time.perf_counter() - start_time)
+        await client.cleanup()
+
+        client = make_client()
+        start_time = time.perf_counter()
+        await client.connect_to_servers(wait_all=True)
+        cached.append(time.perf_counter() - start_time)
+        deferred = len(client._lazy_servers)
+        start_time = time.perf_counter()
+        await client.execute_tool_call(exposed_name(client, DISPATCH_TOOLS["stdio"][0]), DISPATCH_TOOLS["stdio"][1],
+                                       client.new_conversation())
+        first_call.append(time.perf_counter() - start_time)
+        await client.cleanup()
+    return {
+        "cold_connect_ms": describe(cold),
+        "cached_manifest_connect_ms": describe(cached),
+        "deferred_servers": deferred,
+        "first_deferred_call_ms": describe(first_call),
+    }
+
+
+async def bench_dispatch(client: host.MyMCPClient, calls: int, warmup: int) -> dict:
+    """
+    Call one tool per transport directly on its session and through execute_tool_call, interleaved,
+    the difference is what the host adds to a call (routing, semaphores, spans, logging)
+    """
+    conversation = client.new_conversation()
+    results = {}
+    for transport, (tool, arguments) in DISPATCH_TOOLS.items():
+        name = exposed_name(client, tool)
+        server_name, server_tool = client.tool_routes[name]
+        session = await client.get_session(server_name)
+        direct, hosted = [], []
+        for i in range(warmup + calls):
+            start_time = time.perf_counter()
+            await session.call_tool(server_tool, arguments)
+            direct_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            await client.execute_tool_call(name, arguments, conversation)
+            hosted_time = time.perf_counter() - start_time
+            if i >= warmup:
+                direct.append(direct_time)
+                hosted.append(hosted_time)
+        results[transport] = {
+            "tool": tool,
+            "session_call_ms": describe(direct),
+            "host_call_ms": describe(hosted),
+            "overhead_p50_ms": round((percentile(hosted, 50) - percentile(direct, 50)) * 1000, 3),
+            "overhead_mean_ms": round((sum(hosted) - sum(direct)) / len(hosted) * 1000, 3),
+        }
+    return results
+
+
+async def bench_turns(client: host.MyMCPClient, scenarios: List[dict], turns: int, warmup: int) -> dict:
+    """
+    Run each scenario turns times, each time in a new conversation. The LLM time of a turn comes from its
+    llm_request spans, the rest of the latency is spent in tools and in the host. The first LLM call of a turn is
+    reported apart from the later ones (the steps of the tool loop), which reuse the provider's pooled connection:
+    by the time to the first token when streaming, so the length of the completion does not count, else the whole call.
+    """
+    metrics = client.tracer.metrics
+    step_records = []
+    record_step = client.record_step
+    def collect_step(step_record: dict):
+        step_records.append(step_record)
+        record_step(step_record)
+    client.record_step = collect_step
+    results = {}
+    for scenario in scenarios:
+        latencies, llm_times, records = [], [], []
+        first_calls, later_calls = [], []
+        errors = 0
+        for i in range(warmup + turns):
+            conversation = client.new_conversation()
+            llm_before = metrics.histogram_total(SPAN_METRIC, span="llm_request")[0]
+            step_records.clear()
+            summary = await client.process_query(scenario["query"], conversation)
+            llm_time = metrics.histogram_total(SPAN_METRIC, span="llm_request")[0] - llm_before
+            if i < warmup:
+                continue
+            call_latencies = [step_record.get("llm_first_token", step_record["llm_latency"]) for step_record in step_records]
+            first_calls.extend(call_latencies[:1])
+            later_calls.extend(call_latencies[1:])
+            if summary["stop_reason"] is not None or summary["tool_calls"] < sum(len(step) for step in scenario.get("steps", [])):
+                errors += 1
+            latencies.append(summary["latency"])
+            llm_times.append(llm_time)
+            records.append(summary)
+        results[scenario["name"]] = {
+            "latency_ms": describe(latencies),
+            "llm_ms": describe(llm_times),
+            "first_call_ms": describe(first_calls),
+            "later_calls_ms": describe(later_calls),
+            "outside_llm_ms": describe([latency - llm for latency, llm in zip(latencies, llm_times)]),
+            "speculation_saved_ms": describe([record["speculation_saved"] for record in records]),
+            "steps": records[-1]["steps"] if records else 0,
+            "tool_calls": records[-1]["tool_calls"] if records else 0,
+            "prompt_tokens": records[-1]["prompt_tokens"] if records else 0,
+            "cached_tokens": records[-1]["cached_tokens"] if records else 0,
+            "completion_tokens": records[-1]["completion_tokens"] if records else 0,
+            "tool_tokens_saved": records[-1]["tool_tokens_saved"] if records else 0,
+            "errors": errors,
+        }
+    client.record_step = record_step
+    return results
+
+
+async def bench_conversations(client: host.MyMCPClient, query: str, count: int) -> dict:
+    """Memory kept per conversation: run one turn in each of count conversations that stay referenced"""
+    rss_before = process_rss()
+    conversations = [client.new_conversation() for _ in range(count)]
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client.process_query(query, conversation) for conversation in conversations))
+    wall_time = time.perf_counter() - start_time
+    rss_after = process_rss()
+    grown = rss_after - rss_before if rss_after is not None and rss_before is not None else None
+    return {
+        "conversations": count,
+        "wall_time_ms": round(wall_time * 1000, 3),
+        "throughput_per_s": round(count / wall_time, 2) if wall_time else None,
+        "rss_growth_mb": to_mb(grown),
+        "per_conversation_kb": round(grown / 1024 / count, 2) if grown is not None and count else None,
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a result tree, keyed by their dotted path"""
+    values = {}
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def print_comparison(results: dict, baseline: dict):
+    current = flatten({key: value for key, value in results.items() if key != "meta"})
+    previous = flatten({key: value for key, value in baseline.items() if key != "meta"})
+    print(f"\nCompared with {baseline.get('meta', {}).get('commit')} ({baseline.get('meta', {}).get('time')}):")
+    for path, value in current.items():
+        if path not in previous or path.endswith(".n"):
+            continue
+        old = previous[path]
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {path:60} {old:>12} -> {value:<12} {change}")
+
+
+def print_results(results: dict):
+    startup = results["startup"]
+    print("\nStartup: cold {} ms, cached manifest {} ms ({} deferred), first deferred call {} ms".format(
+        startup["cold_connect_ms"].get("p50"), startup["cached_manifest_connect_ms"].get("p50"),
+        startup["deferred_servers"], startup["first_deferred_call_ms"].get("p50")))
+    print("Dispatch overhead (p50):")
+    for transport, result in results["dispatch"].items():
+        print("  {:16} session {:>8} ms, host {:>8} ms, overhead {:>7} ms".format(
+            transport, result["session_call_ms"]["p50"], result["host_call_ms"]["p50"], result["overhead_p50_ms"]))
+    print("Turn latency (p50 / p95, llm p50, saved by speculative tool calls p50):")
+    for name, result in results["turns"].items():
+        print("  {:22} {:>9} / {:>9} ms, llm {:>9} ms, saved {:>7} ms, {} steps, {} tool calls, {} prompt tokens{}".format(
+            name, result["latency_ms"].get("p50"), result["latency_ms"].get("p95"), result["llm_ms"].get("p50"),
+            result["speculation_saved_ms"].get("p50"), result["steps"], result["tool_calls"], result["prompt_tokens"],
+            (f" ({result['tool_tokens_saved']} compacted away)" if result["tool_tokens_saved"] else "")
+            + (f", {result['errors']} errors" if result["errors"] else "")))
+        print("  {:22} llm call p50: first {!s:>9} ms, later {!s:>9} ms ({} later calls, to the first token when streamed)".format(
+            "", result["first_call_ms"].get("p50"), result["later_calls_ms"].get("p50"), result["later_calls_ms"]["n"]))
+    memory = results["memory"]
+    print("Memory: host {} MB after connect, {} MB at the end, peak {} MB, {} KB per conversation".format(
+        memory["host_after_connect_mb"], memory["host_end_mb"], memory["host_peak_mb"],
+        memory["conversations"]["per_conversation_kb"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the host against a fake LLM and the bundled servers")
+    parser.add_argument("--output", help="result file (default logs/benchmarks/<time>.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="result file of an earlier run to compare with")
+    parser.add_argument("--scenarios", default=os.path.join(BENCHMARK_DIR, "scenarios.json"))
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake LLM waits before the first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="completion tokens per second of the fake LLM")
+    parser.add_argument("--turns", type=int, default=10, help="measured turns per scenario")
+    parser.add_argument("--dispatch-calls", type=int, default=50, help="measured tool calls per transport")
+    parser.add_argument("--startup-runs", type=int, default=3)
+    parser.add_argument("--conversations", type=int, default=100, help="conversations kept for the memory measurement")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured repetitions before each measurement")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY VALUE", help="config overrides, as for yacs merge_from_list")
+    return parser.parse_args()
+
+
+async def run(args) -> dict:
+    with open(args.scenarios, "r", encoding="utf-8") as f:
+        scenarios = json.load(f)
+    output = args.output or os.path.join(ROOT, "logs", "benchmarks", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    log_dir = os.path.dirname(os.path.abspath(output))
+    os.makedirs(log_dir, exist_ok=True)
+    rss_start = process_rss()
+
+    llm_port, cat_port, alien_port = free_port(), free_port(), free_port()
+    processes = {
+        "fake_llm": start_process("fake_llm", [
+            sys.executable, os.path.join(BENCHMARK_DIR, "fake_llm.py"), "--port", str(llm_port), "--scenarios", args.scenarios,
+            "--latency", str(args.latency), "--token-rate", str(args.token_rate)], log_dir),
+        "catcom": start_process("catcom", [sys.executable, os.path.join(ROOT, "my_servers", "CatCom.py"), "--port", str(cat_port)], log_dir),
+        "aliencom": start_process("aliencom", [sys.executable, os.path.join(ROOT, "my_servers", "AlienCom.py"), "--port", str(alien_port)], log_dir),
+    }
+    temp_dir = tempfile.TemporaryDirectory()
+    manifest_file = os.path.join(temp_dir.name, "tool_manifest.json")
+    try:
+        for name, port in (("fake_llm", llm_port), ("catcom", cat_port), ("aliencom", alien_port)):
+            await wait_for_port(port, processes[name])
+
+        host.model_info[MODEL_MARK] = {"base_url": f"http://127.0.0.1:{llm_port}/v1"}
+        os.environ[f"{MODEL_MARK}_API_KEY"] = "benchmark"
+        cfg = get_cfg_defaults()
+        cfg.MODEL.MARK = MODEL_MARK
+        cfg.MODEL.NAME = MODEL_NAME
+        cfg.SERVER.ACCESS_PATHS = [
+            os.path.join(ROOT, "my_servers", "timetools.py"),
+            f"http://127.0.0.1:{cat_port}/mcp",
+            f"http://127.0.0.1:{alien_port}/sse",
+        ]
+        cfg.SERVER.MANIFEST_CACHE_FILE = manifest_file
+        cfg.BLOBS.DIR = os.path.join(temp_dir.name, "blobs")
+        # the logs of the run go next to its results, not into the logs of the project
+        cfg.HOST.LOG_FILE = os.path.join(log_dir, "host.log")
+        cfg.HOST.TRANSCRIPT_FILE = os.path.join(log_dir, "transcript.jsonl")
+        cfg.HOST.STEP_LOG_FILE = os.path.join(log_dir, "steps.jsonl")
+        cfg.TRACING.FILE = os.path.join(log_dir, "traces.jsonl")
+        cfg.merge_from_list(args.set)
+        cfg.freeze()
+        host.setup_logging(cfg)
+
+        results = {"meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        }}
+        print("Measuring startup...")
+        results["startup"] = await bench_startup(lambda: host.MyMCPClient(cfg), manifest_file, args.startup_runs)
+
+        client = host.MyMCPClient(cfg)
+        try:
+            await client.connect_to_servers(wait_all=True)
+            rss_connected = process_rss()
+            print("Measuring tool dispatch...")
+            results["dispatch"] = await bench_dispatch(client, args.dispatch_calls, args.warmup)
+            print("Measuring turns...")
+            results["turns"] = await bench_turns(client, scenarios, args.turns, args.warmup)
+            print("Measuring memory per conversation...")
+            conversations = await bench_conversations(client, scenarios[0]["query"], args.conversations)
+            # the stdio servers are the only children of this process besides the ones started here
+            started = {process.pid for process in processes.values()}
+            started.update(child for pid in list(started) for child in child_pids(pid))
+            stdio_rss = [process_rss(pid) for pid in child_pids(os.getpid()) if pid not in started]
+            results["memory"] = {
+                "host_start_mb": to_mb(rss_start),
+                "host_after_connect_mb": to_mb(rss_connected),
+                "host_end_mb": to_mb(process_rss()),
+                "host_peak_mb": to_mb(peak_rss()),
+                "conversations": conversations,
+                "stdio_servers_mb": to_mb(sum(rss for rss in stdio_rss if rss is not None)) if stdio_rss else None,
+                **{f"{name}_mb": to_mb(process_rss(process.pid)) for name, process in processes.items()},
+            }
+        finally:
+            await client.cleanup()
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        temp_dir.cleanup()
+        await logger.complete()
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print_results(results)
+    print(f"\nResults written to {output}")
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
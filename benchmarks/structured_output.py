@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具结果以结构化内容传递的微基准：比较BraveSearch的两种做法每次调用花费的CPU时间，按阶段分别统计。
+  text        旧做法：server把langchain返回的JSON字符串做unicode_escape解码、ast.literal_eval解析，以文本返回；
+              host再从文本里解析出JSON（compactor.py）后压缩
+  structured  新做法：server只json.loads一次，FastMCP把返回的字典同时作为structuredContent和文本块
+              （json.dumps(indent=2)）；client按outputSchema校验structuredContent；host直接压缩structuredContent
+阶段：server（工具函数与FastMCP的结果转换）、wire（结果在JSON-RPC消息里的序列化与解析）、
+client（输出schema校验，host的ToolSession用每个schema编译一次的校验器；mcp的ClientSession每次调用都重新检查、
+编译schema，以client_uncached单独列出，不计入total）、host（render_tool_content与压缩）。
+不依赖网络和Brave的API key，搜索结果是合成的，含中文、引号、反斜杠和emoji，旧做法在后几种情况下会出错，
+出错次数也一并统计（出错的调用不计入之后的阶段）。
+
+用法（在项目根目录运行）：python benchmarks/structured_output.py [--results 10] [--calls 2000]
+'''
+
+import os
+import sys
+import ast
+import json
+import time
+import random
+import argparse
+from typing import Callable, List, Tuple, TypedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import anyio
+import jsonschema
+from loguru import logger
+from mcp import types
+from mcp.server.fastmcp import FastMCP
+from referencing import Registry
+
+from blob_store import render_tool_content
+from compactor import OutputCompactor
+from config import get_cfg_defaults
+from host import ToolSession
+
+SNIPPET_WORDS = ["search", "results", "雅典", "奥林匹克", "page", "the", "data", "历史", "news", "API"]
+# text that trips the unicode_escape + ast.literal_eval round trip: quotes, backslashes, characters outside the BMP
+TRICKY = ['the "best" answer', "C:\\Users\\cat", "it's 🐱 time"]
+QUERY = "雅典奥运会"
+
+mcp = FastMCP("structured-output-benchmark")
+
+
+class SearchResult(TypedDict):
+    title: str
+    link: str
+    snippet: str
+
+
+class SearchResults(TypedDict):
+    query: str
+    results: List[SearchResult]
+
+
+@mcp.tool(structured_output=False)
+def text_search(response: str) -> str:
+    """The old brave_search, on a langchain response"""
+    response = response.encode("utf-8").decode("unicode_escape")
+    ast.literal_eval(response) # parsed to print the results
+    return response
+
+
+@mcp.tool()
+def structured_search(response: str) -> SearchResults:
+    """The new brave_search, on a langchain response"""
+    return {"query": QUERY, "results": [
+        {"title": res.get("title", ""), "link": res.get("link", ""), "snippet": res.get("snippet", "")}
+        for res in json.loads(response)
+    ]}
+
+
+def langchain_response(rng: random.Random, count: int, tricky: bool) -> str:
+    """What langchain's BraveSearch.run returns: json.dumps of a list of results, non-ASCII as \\uXXXX"""
+    results = []
+    for i in range(count):
+        snippet = " ".join(rng.choice(SNIPPET_WORDS) for _ in range(40))
+        if tricky and i == 0:
+            snippet = rng.choice(TRICKY) + " " + snippet
+        results.append({"title": f"结果 {i}: " + " ".join(rng.choice(SNIPPET_WORDS) for _ in range(6)),
+                        "link": f"https://example.com/{i}", "snippet": snippet})
+    return json.dumps(results)
+
+
+def timed(stage: Callable, items: list) -> Tuple[list, float, int]:
+    """(outputs of the items that did not fail, CPU seconds, failures) of a stage"""
+    outputs, failures = [], 0
+    start = time.process_time()
+    for item in items:
+        try:
+            outputs.append(stage(item))
+        except (ValueError, SyntaxError, UnicodeError):
+            failures += 1
+    return outputs, time.process_time() - start, failures
+
+
+def run_path(name: str, responses: List[str], compact) -> dict:
+    """CPU microseconds per call of each stage of a path"""
+    tool = mcp._tool_manager.get_tool(name)
+    schema = tool.output_schema
+    send_stream, receive_stream = anyio.create_memory_object_stream(0)
+    session = ToolSession(receive_stream, send_stream) # not started, only validates
+    session._tool_output_schemas[name] = schema # as listed by list_tools
+
+    def server(response: str) -> types.CallToolResult:
+        converted = tool.fn_metadata.convert_result(tool.fn(response))
+        content, structured = converted if isinstance(converted, tuple) else (converted, None)
+        return types.CallToolResult(content=list(content), structuredContent=structured)
+
+    def wire(result: types.CallToolResult) -> types.CallToolResult:
+        return types.CallToolResult.model_validate_json(result.model_dump_json(by_alias=True, exclude_none=True))
+
+    def client(result: types.CallToolResult) -> types.CallToolResult:
+        if schema is not None:
+            session.validate_structured_content(name, result.structuredContent)
+        return result
+
+    def client_uncached(result: types.CallToolResult) -> types.CallToolResult:
+        # as ClientSession.call_tool does
+        if schema is not None:
+            jsonschema.validate(result.structuredContent, schema, registry=Registry())
+        return result
+
+    def host(result: types.CallToolResult) -> str:
+        return render_tool_content(result.content, None, compact=compact, structured=result.structuredContent)[0]
+
+    report, items = {}, responses
+    for stage in (server, wire, client, host):
+        outputs, elapsed, failures = timed(stage, items)
+        report[stage.__name__] = round(elapsed / max(1, len(outputs)) * 1e6, 1)
+        if failures:
+            report["failures"] = report.get("failures", 0) + failures
+        if stage is wire:
+            _, elapsed, _ = timed(client_uncached, outputs)
+            report["client_uncached"] = round(elapsed / max(1, len(outputs)) * 1e6, 1)
+        items = outputs
+    report["total"] = round(sum(report[stage] for stage in ("server", "wire", "client", "host")), 1)
+    report.setdefault("failures", 0)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per tool call of text results parsed by the host vs structured content")
+    parser.add_argument("--results", type=int, default=10, help="search results per call")
+    parser.add_argument("--calls", type=int, default=2000, help="calls of each kind")
+    parser.add_argument("--tricky-rate", type=float, default=0.1, help="fraction of calls with quotes, backslashes or emoji")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logger.remove()
+
+    cfg = get_cfg_defaults()
+    compactor = OutputCompactor(cfg.COMPACT.TOOLS, cfg.COMPACT.MAX_CHARS)
+    rule = compactor.rule("brave_search")
+    # the old results were a bare list of the results
+    text_rule = {**rule, "fields": [field[len("results."):] for field in rule["fields"] if field.startswith("results.")]}
+
+    def compactor_of(rule: dict):
+        def compact(content, text: str):
+            compacted, lossy = compactor.compact(content, rule)
+            compactor.record("brave_search", compactor.uncompacted(content, text), compacted, lossy)
+            return compacted, lossy
+        return compact
+
+    rng = random.Random(args.seed)
+    responses = [langchain_response(rng, args.results, rng.random() < args.tricky_rate) for _ in range(args.calls)]
+    run_path("text_search", responses[:10], compactor_of(text_rule)) # warm up
+    run_path("structured_search", responses[:10], compactor_of(rule))
+
+    text = run_path("text_search", responses, compactor_of(text_rule))
+    structured = run_path("structured_search", responses, compactor_of(rule))
+    report = {
+        "results_per_call": args.results,
+        "calls": args.calls,
+        "cpu_us_per_call": {"text": text, "structured": structured},
+        "cpu_us_saved_per_call": {stage: round(text[stage] - structured[stage], 1)
+                                  for stage in ("server", "wire", "client", "client_uncached", "host", "total")},
+    }
+    print(json.dumps(report, indent=2))
+    print(f"text: {text['total']} µs/call, {text['failures']}/{args.calls} calls failed; "
+          f"structured: {structured['total']} µs/call, {structured['failures']} failed; "
+          f"saved {report['cpu_us_saved_per_call']['total']} µs/call "
+          f"({report['cpu_us_saved_per_call']['server'] + report['cpu_us_saved_per_call']['host']:.1f} in server and host code)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具结果的内容处理：MCP工具结果可以有多个内容块（文本、图片、音频、内嵌资源、资源链接），这里把它们都转成给模型看的文本。
+大段文本和二进制内容（如图片）不放进对话（对话在之后的每次请求中都会重新发送），而是存入本地按内容寻址的blob存储
+（BLOBS.DIR，文件名为内容的sha256），对话里只留下一个句柄（blob:<hash>）、大小、类型和文本开头的预览。
+模型需要时可以用host内置的read_blob工具分段读取存下的文本（只能读本会话的工具结果中出现过的blob）；服务模式下GET /blobs/{hash}可取回原始内容。
+'''
+
+import os
+import json
+import base64
+import hashlib
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from mcp import types
+
+HANDLE_PREFIX = "blob:"
+KEY_LENGTH = 20 # hex digits of the sha256 kept in a handle
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+class BlobStore:
+    """Content-addressed files, each with a small JSON sidecar holding its MIME type"""
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.stored = 0 # new blobs written
+        self.reused = 0 # blobs already present, same content
+        self.offloaded_bytes = 0 # bytes kept out of conversations
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def handle(key: str) -> str:
+        """Handle of a key (or of a handle)"""
+        return key if key.startswith(HANDLE_PREFIX) else HANDLE_PREFIX + key
+
+    def path(self, handle: str) -> str:
+        """File of a handle (or bare key)"""
+        key = handle[len(HANDLE_PREFIX):] if handle.startswith(HANDLE_PREFIX) else handle
+        return os.path.join(self.directory, key)
+
+    def put(self, data: bytes, mime_type: str) -> str:
+        """Store data once, returns its handle"""
+        key = hashlib.sha256(data).hexdigest()[:KEY_LENGTH]
+        self.offloaded_bytes += len(data)
+        if os.path.exists(self.path(key)):
+            self.reused += 1
+            return HANDLE_PREFIX + key
+        # written under a temporary name first, a reader never sees a partial blob
+        temp_path = self.path(key) + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        with open(self.path(key) + ".json", "w", encoding="utf-8") as f:
+            json.dump({"mime_type": mime_type, "size": len(data)}, f)
+        os.replace(temp_path, self.path(key))
+        self.stored += 1
+        logger.debug(f"Stored blob {key} ({mime_type}, {len(data)} bytes) at {self.path(key)}")
+        return HANDLE_PREFIX + key
+
+    def get(self, handle: str) -> Tuple[bytes, str]:
+        """(data, mime type) of a handle (or bare key), KeyError if unknown"""
+        key = handle[len(HANDLE_PREFIX):] if handle.startswith(HANDLE_PREFIX) else handle
+        if len(key) != KEY_LENGTH or not all(c in "0123456789abcdef" for c in key) or not os.path.exists(self.path(key)):
+            raise KeyError(handle)
+        with open(self.path(key), "rb") as f:
+            data = f.read()
+        try:
+            with open(self.path(key) + ".json", "r", encoding="utf-8") as f:
+                mime_type = json.load(f)["mime_type"]
+        except (OSError, ValueError, KeyError):
+            mime_type = "application/octet-stream"
+        return data, mime_type
+
+    def read_text(self, handle: str, offset: int = 0, length: int = 4000, allowed: Optional[Set[str]] = None) -> str:
+        """A slice of a stored text, for the read_blob tool; any handle not in allowed (if given) is unknown"""
+        try:
+            if allowed is not None and self.handle(handle) not in allowed:
+                raise KeyError(handle)
+            data, mime_type = self.get(handle)
+        except KeyError:
+            return f"Error: unknown blob {handle}"
+        if not (mime_type.startswith("text/") or mime_type in ("application/json", "application/xml")):
+            return f"Error: {handle} is {mime_type} ({format_size(len(data))}), only text blobs can be read"
+        text = data.decode("utf-8", errors="replace")
+        offset = max(0, offset)
+        part = text[offset:offset + max(1, length)]
+        end = offset + len(part)
+        return f"[{handle}, characters {offset}-{end} of {len(text)}]\n{part}"
+
+    def stats(self) -> dict:
+        return {"stored": self.stored, "reused": self.reused, "offloaded_bytes": self.offloaded_bytes}
+
+
+def render_tool_content(content: List[types.ContentBlock], store: Optional[BlobStore],
+                        inline_max_chars: int = 4000, preview_chars: int = 500,
+                        compact: Optional[Callable[[Any, str], Tuple[str, bool]]] = None,
+                        structured: Optional[Dict[str, Any]] = None) -> Tuple[str, List[str]]:
+    """
+    Text of the content blocks of a tool result, as the model gets to see it
+
+    Args:
+        content: the content of a CallToolResult
+        store: where large text and binary content go, None to keep text inline and leave binary content out
+        inline_max_chars: longer text is stored, with a preview in the result
+        preview_chars: characters of stored text kept in the result
+        compact: returns (compacted text, whether content was dropped) of the content of a text block (its text, or the
+            structured content) and its text, the full text of a lossy one is stored (see compactor.py)
+        structured: the structuredContent of the result, used instead of its text blocks, which carry the same content
+            serialized for clients that do not read structured content
+
+    Returns:
+        (text, handles of the blobs it refers to)
+    """
+    parts, handles = [], []
+
+    def add_text(text: str, mime_type: str, label: str, value: Any = None):
+        if compact is not None:
+            compacted, lossy = compact(text if value is None else value, text)
+            if lossy and store is not None:
+                handle = store.put(text.encode("utf-8"), mime_type)
+                handles.append(handle)
+                label = f"{label}, compacted, the full text is {handle}"
+            text = compacted
+        elif value is not None:
+            text = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        if store is None or len(text) <= inline_max_chars:
+            parts.append(f"[{label}]\n{text}" if label != "text" else text)
+            return
+        handle = store.put(text.encode("utf-8"), mime_type)
+        handles.append(handle)
+        parts.append(f"[{label}: {len(text)} characters stored as {handle}, the first {preview_chars} below, "
+                     f"read_blob reads the rest]\n{text[:preview_chars]}")
+
+    def add_binary(data: str, mime_type: str, label: str):
+        raw = base64.b64decode(data)
+        if store is None:
+            parts.append(f"[{label}: {mime_type}, {format_size(len(raw))}, not kept]")
+            return
+        handle = store.put(raw, mime_type)
+        handles.append(handle)
+        # the handle only, the file path of the host is no business of the model, the provider or the tenants
+        parts.append(f"[{label}: {mime_type}, {format_size(len(raw))}, stored as {handle}]")
+
+    # FastMCP wraps a return value that is not an object as {"result": value}, a string is as good as text
+    value = structured["result"] if structured is not None and list(structured) == ["result"] else structured
+    if value is not None and not isinstance(value, str):
+        text = "\n".join(block.text for block in content if isinstance(block, types.TextContent))
+        add_text(text, "application/json", "text", value)
+        content = [block for block in content if not isinstance(block, types.TextContent)]
+
+    for block in content:
+        if isinstance(block, types.TextContent):
+            add_text(block.text, "text/plain", "text")
+        elif isinstance(block, (types.ImageContent, types.AudioContent)):
+            add_binary(block.data, block.mimeType, block.type)
+        elif isinstance(block, types.EmbeddedResource):
+            resource = block.resource
+            if isinstance(resource, types.TextResourceContents):
+                add_text(resource.text, resource.mimeType or "text/plain", f"resource {resource.uri}")
+            else:
+                add_binary(resource.blob, resource.mimeType or "application/octet-stream", f"resource {resource.uri}")
+        elif isinstance(block, types.ResourceLink):
+            details = ", ".join(str(value) for value in (block.mimeType, block.size and format_size(block.size), block.description) if value)
+            parts.append(f"[resource link {block.name}: {block.uri}{', ' + details if details else ''}]")
+        else:
+            parts.append(f"[{getattr(block, 'type', type(block).__name__)} content, not supported]")
+    return "\n".join(parts), handles
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+'''
+模型请求的录制与回放（CASSETTE.MODE）。录制时照常请求模型，并把每次chat.completions.create的回应
+（消息、token用量和耗时）按请求的哈希（模型名、消息和工具列表）追加到JSONL文件；回放时完全不访问网络，
+直接返回录制的回应，可以按录制时的耗时模拟延迟。流式与非流式请求共用同一份记录。
+
+工具结果里常有随时间变化的内容（如当前时间），回放时请求与录制时不完全相同，所以每条记录另存一个
+不含工具结果内容的宽松哈希：精确哈希找不到时按宽松哈希匹配，都找不到则报错。
+'''
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import AsyncIterator, Dict, List, Optional
+
+from loguru import logger
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+
+class CassetteMiss(LookupError):
+    """No recorded response for a request in replay mode"""
+
+
+def request_keys(model: str, messages: List[dict], tools: Optional[List[dict]]) -> tuple:
+    """Exact and loose hash of a request, the loose one ignores the contents of tool results"""
+    def digest(messages: List[dict]) -> str:
+        payload = json.dumps({"model": model, "messages": messages, "tools": tools or []},
+                             sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+    loose_messages = [{**message, "content": None} if message.get("role") == "tool" else message for message in messages]
+    return digest(messages), digest(loose_messages)
+
+
+def message_from_chunks(chunks: List[ChatCompletionChunk]) -> tuple:
+    """Assemble the (message, finish_reason, usage) of a streamed response from its chunks"""
+    content_parts = []
+    tool_calls: Dict[int, dict] = {}
+    finish_reason, usage = None, None
+    for chunk in chunks:
+        if chunk.usage is not None:
+            usage = chunk.usage.model_dump(exclude_none=True)
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        if choice.delta.content:
+            content_parts.append(choice.delta.content)
+        for delta in choice.delta.tool_calls or []:
+            index = delta.index if delta.index is not None else len(tool_calls)
+            tool_call = tool_calls.setdefault(index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if delta.id:
+                tool_call["id"] = delta.id
+            if delta.function and delta.function.name:
+                tool_call["function"]["name"] = delta.function.name
+            if delta.function and delta.function.arguments:
+                tool_call["function"]["arguments"] += delta.function.arguments
+    message = {"role": "assistant", "content": "".join(content_parts) or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_call for _, tool_call in sorted(tool_calls.items())]
+    return message, finish_reason or "stop", usage
+
+
+class LLMCassette:
+    def __init__(self, path: str, mode: str, latency_scale: float = 0.0):
+        """
+        Args:
+            path: JSONL file of the recorded responses, appended to when recording
+            mode: "record" or "replay"
+            latency_scale: in replay mode, wait the recorded latency times this before answering, 0 for no wait
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._exact: Dict[str, dict] = {}
+        self._loose: Dict[str, dict] = {}
+        self.hits = 0
+        self.loose_hits = 0
+        self.recorded = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+        logger.info(f"Cassette {path} ({mode}): {len(self._exact)} recorded responses")
+
+    def _add(self, record: dict):
+        # later recordings of the same request win
+        self._exact[record["key"]] = record
+        self._loose[record["loose_key"]] = record
+
+    def lookup(self, keys: tuple, message_count: int = 0) -> dict:
+        """Recorded response for the request_keys of a request"""
+        key, loose_key = keys
+        if key in self._exact:
+            self.hits += 1
+            return self._exact[key]
+        if loose_key in self._loose:
+            self.loose_hits += 1
+            return self._loose[loose_key]
+        raise CassetteMiss(f"no recorded response for request {key} ({message_count} messages)")
+
+    def record(self, keys: tuple, model: str, message: dict, finish_reason: str, usage: Optional[dict], latency: float):
+        key, loose_key = keys
+        record = {
+            "key": key, "loose_key": loose_key, "time": time.time(), "model": model, "latency": round(latency, 4),
+            "message": message, "finish_reason": finish_reason, "usage": usage,
+        }
+        self._add(record)
+        self.recorded += 1
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "responses": len(self._exact), "hits": self.hits,
+                "loose_hits": self.loose_hits, "recorded": self.recorded}
+
+
+class CassetteClient:
+    """
+    Stands in for an AsyncOpenAI client (client.chat.completions.create and close): records the responses of
+    the wrapped client, or replays them without one
+    """
+    def __init__(self, cassette: LLMCassette, client: Optional[AsyncOpenAI] = None):
+        self.cassette = cassette
+        self.client = client
+        self.chat = self
+        self.completions = self
+
+    async def create(self, *, model: str, messages: List[dict], tools: Optional[List[dict]] = None, stream: bool = False, **kwargs):
+        # hashed before the call, the caller may extend messages once the response is complete
+        keys = request_keys(model, messages, tools)
+        if self.cassette.mode == "replay":
+            record = self.cassette.lookup(keys, len(messages))
+            if self.cassette.latency_scale > 0:
+                await asyncio.sleep(record["latency"] * self.cassette.latency_scale)
+            return self._replay_stream(record) if stream else self._replay_completion(record)
+
+        start_time = time.perf_counter()
+        response = await self.client.chat.completions.create(model=model, messages=messages, tools=tools, stream=stream, **kwargs)
+        if not stream:
+            choice = response.choices[0]
+            self.cassette.record(keys, model, choice.message.model_dump(exclude_none=True), choice.finish_reason,
+                                 response.usage.model_dump(exclude_none=True) if response.usage else None,
+                                 time.perf_counter() - start_time)
+            return response
+        return self._record_stream(response, keys, model, start_time)
+
+    async def _record_stream(self, stream, keys: tuple, model: str, start_time: float) -> AsyncIterator[ChatCompletionChunk]:
+        """Pass the chunks through, the response is recorded once the stream is complete"""
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.close()
+        message, finish_reason, usage = message_from_chunks(chunks)
+        self.cassette.record(keys, model, message, finish_reason, usage, time.perf_counter() - start_time)
+
+    @staticmethod
+    def _replay_completion(record: dict) -> ChatCompletion:
+        return ChatCompletion.model_validate({
+            "id": "replay-" + record["key"], "object": "chat.completion", "created": int(record["time"]), "model": record["model"],
+            "choices": [{"index": 0, "message": record["message"], "finish_reason": record["finish_reason"]}],
+            "usage": record["usage"],
+        })
+
+    @staticmethod
+    async def _replay_stream(record: dict) -> AsyncIterator[ChatCompletionChunk]:
+        """The recorded message as chunks: its content, each tool call whole, then the usage"""
+        base = {"id": "replay-" + record["key"], "object": "chat.completion.chunk", "created": int(record["time"]), "model": record["model"]}
+        message = record["message"]
+        deltas = []
+        if message.get("content"):
+            deltas.append({"role": "assistant", "content": message["content"]})
+        for index, tool_call in enumerate(message.get("tool_calls") or []):
+            deltas.append({"tool_calls": [{"index": index, **tool_call}]})
+        for delta in deltas:
+            yield ChatCompletionChunk.model_validate({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+        yield ChatCompletionChunk.model_validate({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": record["finish_reason"]}]})
+        if record["usage"] is not None:
+            yield ChatCompletionChunk.model_validate({**base, "choices": [], "usage": record["usage"]})
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
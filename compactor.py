@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具结果进入对话前的压缩（COMPACT）。工具结果一旦进入对话，之后每次请求模型都会重新发送，所以先按工具的规则压缩：
+  - JSON结果（结构化内容structuredContent直接使用；文本形式的JSON以及Python字面量形式的列表/字典，如str(list)，先解析）：
+    按字段投影只保留需要的字段（支持a.b形式的嵌套字段），去掉空值，限制列表的条数和每个字符串的长度，再以紧凑格式重新序列化；
+  - 普通文本：合并多余的空白，连续重复的行只保留一行并注明重复次数（这两项默认关闭，空白可能有意义，如代码、表格和
+    字符画，只对按名字配置了的工具开启）；
+  - 总字符数上限：超出时保留开头和结尾。
+除了行尾的空白和JSON的重新序列化之外，规则改变了内容时（投影、截断、去掉空值、合并空白或重复行），完整的结果存入
+blob存储（见blob_store.py），模型仍可用read_blob读取。
+每个工具压缩前后的token数都有统计；压缩前按不压缩时host放进对话的文本计算（结构化内容为紧凑的JSON，
+而不是server同时发送的缩进格式文本），只有规则改变了内容才算压缩过。
+'''
+
+import re
+import ast
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from dialogue import count_tokens
+
+_SPACES = re.compile(r"[ \t\f\v]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+DEFAULT_RULE = {
+    "fields": [], # dotted paths kept in each JSON object (each item of a list), empty for all
+    "max_items": 0, # items kept of each JSON list
+    "max_string_chars": 0, # characters kept of each JSON string
+    "max_chars": 0, # characters kept of the whole result, its head and tail
+    "drop_empty": True, # drop null, empty strings, lists and objects from JSON
+    "collapse_whitespace": False, # runs of spaces inside lines and of blank lines, trailing spaces
+    "dedupe_lines": False, # consecutive repeated lines of text
+}
+
+
+def trim_trailing(text: str) -> str:
+    """Text without the whitespace at the end of its lines and at its end, which compaction may drop losslessly"""
+    return "\n".join(line.rstrip() for line in text.split("\n")).rstrip()
+
+
+def parse_structured(text: str) -> Optional[Any]:
+    """A JSON value, or a Python literal list/dict, parsed from text; None for other text"""
+    stripped = text.strip()
+    if not stripped or stripped[0] not in "[{":
+        return None
+    try:
+        return json.loads(stripped)
+    except ValueError:
+        pass
+    try:
+        value = ast.literal_eval(stripped)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return value if isinstance(value, (list, dict)) else None
+
+
+def project(value: Any, fields: List[str]) -> Any:
+    """Keep only the dotted fields of an object, or of each object of a list"""
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if not isinstance(value, dict):
+        return value
+    groups: Dict[str, List[str]] = {} # top-level field -> the rest of its paths, "" for the whole field
+    for field in fields:
+        head, _, rest = field.partition(".")
+        groups.setdefault(head, []).append(rest)
+    projected: Dict[str, Any] = {}
+    for head, rests in groups.items():
+        if head in value:
+            projected[head] = value[head] if "" in rests else project(value[head], rests)
+    return projected
+
+
+class OutputCompactor:
+    def __init__(self, rules: List[Tuple[str, dict]], max_chars: int = 0):
+        """
+        Args:
+            rules: (tool name, options) pairs, options override DEFAULT_RULE for that tool
+            max_chars: max_chars of the tools without a rule of their own, 0 for no limit
+        """
+        self.default_rule = {**DEFAULT_RULE, "max_chars": max_chars}
+        self.rules = {}
+        for name, options in rules:
+            unknown = set(options) - set(DEFAULT_RULE)
+            if unknown:
+                raise ValueError(f"unknown compaction options for {name}: {sorted(unknown)}")
+            self.rules[name] = {**self.default_rule, **options}
+        self.tool_stats: Dict[str, dict] = {} # tool name -> {"results", "compacted", "tokens_before", "tokens_after"}
+
+    def rule(self, *names: str) -> dict:
+        """The rule of the first name that has one, such as the server's tool name and the name exposed to the model"""
+        return next((self.rules[name] for name in names if name in self.rules), self.default_rule)
+
+    def compact(self, content: Union[str, dict, list], rule: dict) -> Tuple[str, bool]:
+        """
+        Args:
+            content: text of a result, or its structured content, which needs no parsing
+
+        Returns:
+            (compacted text, whether content was changed, not just reformatted or stripped of trailing whitespace)
+        """
+        lossy = False
+        value = parse_structured(content) if isinstance(content, str) else content
+        if value is not None:
+            value, lossy = self._compact_value(value, rule, top=True)
+            compacted = json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+        else:
+            compacted = self._compact_text(content, rule)
+            lossy = trim_trailing(compacted) != trim_trailing(content)
+        max_chars = rule["max_chars"]
+        if max_chars and len(compacted) > max_chars:
+            omitted = len(compacted) - max_chars
+            head = max_chars * 2 // 3
+            compacted = compacted[:head] + f"\n[... {omitted} characters omitted ...]\n" + compacted[len(compacted) - (max_chars - head):]
+            lossy = True
+        return compacted, lossy
+
+    def _compact_value(self, value: Any, rule: dict, top: bool = False) -> Tuple[Any, bool]:
+        lossy = False
+        if top and rule["fields"]:
+            projected = project(value, rule["fields"])
+            lossy = projected != value
+            value = projected
+        if isinstance(value, list):
+            if rule["max_items"] and len(value) > rule["max_items"]:
+                value, lossy = value[:rule["max_items"]], True
+            items = [self._compact_value(item, rule) for item in value]
+            value = [item for item, _ in items if not (rule["drop_empty"] and item in (None, "", [], {}))]
+            return value, lossy or len(value) < len(items) or any(item_lossy for _, item_lossy in items)
+        if isinstance(value, dict):
+            items = {key: self._compact_value(item, rule) for key, item in value.items()}
+            value = {key: item for key, (item, _) in items.items() if not (rule["drop_empty"] and item in (None, "", [], {}))}
+            return value, lossy or len(value) < len(items) or any(item_lossy for _, item_lossy in items.values())
+        if isinstance(value, str):
+            if rule["collapse_whitespace"]:
+                collapsed = " ".join(value.split())
+                lossy = collapsed != value
+                value = collapsed
+            if rule["max_string_chars"] and len(value) > rule["max_string_chars"]:
+                return value[:rule["max_string_chars"]] + "…", True
+        return value, lossy
+
+    @staticmethod
+    def _compact_text(text: str, rule: dict) -> str:
+        lines = text.split("\n")
+        if rule["collapse_whitespace"]:
+            # indentation is kept, it may carry meaning (code, ASCII art)
+            lines = [line[:len(line) - len(line.lstrip())] + _SPACES.sub(" ", line.strip()) if line.strip() else ""
+                     for line in lines]
+        if rule["dedupe_lines"]:
+            deduped, count = [], 0
+            for i, line in enumerate(lines):
+                count += 1
+                if i + 1 < len(lines) and lines[i + 1] == line and line:
+                    continue
+                deduped.append(f"{line} [repeated {count} times]" if count > 1 else line)
+                count = 0
+            lines = deduped
+        text = "\n".join(lines)
+        if rule["collapse_whitespace"]:
+            # not strip(), the first line keeps its indentation
+            text = _BLANK_LINES.sub("\n\n", text).strip("\n")
+        return text
+
+    @staticmethod
+    def uncompacted(content: Union[str, dict, list], text: str) -> str:
+        """What the host puts into the dialogue without compaction: the text, or structured content as compact JSON"""
+        if isinstance(content, str):
+            return text
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str)
+
+    def record(self, tool_name: str, before: str, after: str, changed: bool) -> int:
+        """
+        Count a compacted result, returns the tokens saved
+
+        Args:
+            before: the result as the host would put it into the dialogue without compaction (see uncompacted)
+            after: the compacted result
+            changed: whether a rule changed the content (the lossy flag of compact)
+        """
+        stats = self.tool_stats.setdefault(tool_name, {"results": 0, "compacted": 0, "tokens_before": 0, "tokens_after": 0})
+        tokens_before, tokens_after = count_tokens(before), count_tokens(after)
+        stats["results"] += 1
+        stats["compacted"] += changed
+        stats["tokens_before"] += tokens_before
+        stats["tokens_after"] += tokens_after
+        return tokens_before - tokens_after
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: {**stats, "tokens_saved": stats["tokens_before"] - stats["tokens_after"]}
+                for name, stats in self.tool_stats.items()}
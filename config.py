@@ -21,6 +21,61 @@ _C.MODEL = CN()
 _C.MODEL.MARK = "HUNYUAN"
 _C.MODEL.NAME = "hunyuan-turbos-latest"
 
+# 与模型API之间的HTTP连接池设置，同一个provider的client会被缓存复用
+_C.MODEL.HTTP2 = True
+    # 是否使用HTTP/2（需要安装h2，即pip install httpx[http2]；只对https地址生效）
+_C.MODEL.MAX_CONNECTIONS = 20
+_C.MODEL.MAX_KEEPALIVE_CONNECTIONS = 10
+_C.MODEL.KEEPALIVE_EXPIRY = 60.0
+    # 空闲连接保持的秒数
+_C.MODEL.STREAM = True
+    # 是否使用流式输出：回答边生成边打印，HOST.SPECULATIVE_TOOLS中的只读工具在参数完整时就开始执行
+
+_C.ROUTING = CN()
+    # 在多个模型服务商之间路由：按最近的延迟（流式为首个token的延迟）与出错率排序，出错或超时就换下一个
+_C.ROUTING.PROVIDERS = [
+    # ("DEEPSEEK", "deepseek-chat"),
+    # ("DASHSCOPE", "qwen-max-latest"),
+]
+    # MODEL.MARK/MODEL.NAME之外备选的(MARK, 模型名)，需要在.env中设置各自的API key；为空则只使用MODEL
+_C.ROUTING.ATTEMPT_TIMEOUT = 60.0
+    # 一次请求发出后等待回应（流式为第一个chunk）的秒数上限，超时后换下一个服务商；0为不限。
+    # 在限流器中排队和重试前退避的时间不算在内
+_C.ROUTING.WINDOW = 50
+    # 按最近多少次请求统计每个服务商的延迟和出错率
+_C.ROUTING.FAILURE_COOLDOWN = 30.0
+    # 服务商出错后的这段时间（秒）内排在最后
+_C.ROUTING.HEDGE = False
+    # 对冲请求：首选服务商超过其延迟的HEDGE_PERCENTILE分位数还没有回应时，再向下一个服务商发出同样的请求，采用先回应的。
+    # 会增加token消耗，服务模式下可以在请求中用"hedge"单独开启
+_C.ROUTING.HEDGE_PERCENTILE = 95.0
+_C.ROUTING.HEDGE_MIN_DELAY = 1.0
+    # 对冲前至少等待的秒数，延迟样本不足时也用它
+
+_C.RATE_LIMIT = CN()
+    # 每个服务商（MARK）的限流、重试与并发控制，多个对话同时请求时避免被服务商限流后直接报错
+_C.RATE_LIMIT.PROVIDER_LIMITS = [
+    # ("DEEPSEEK", 60, 100000),
+]
+    # (MARK, 每分钟请求数, 每分钟token数)，0为不限；未列出的服务商只按响应头中的x-ratelimit-*与Retry-After限流
+_C.RATE_LIMIT.INITIAL_CONCURRENCY = 8
+    # 每个服务商同时进行的请求数上限的初始值，之后按AIMD调整：成功时缓慢增加，被限流（429/503）时减半
+_C.RATE_LIMIT.MIN_CONCURRENCY = 1
+_C.RATE_LIMIT.MAX_CONCURRENCY = 64
+_C.RATE_LIMIT.MAX_RETRIES = 3
+    # 429、5xx和连接错误的重试次数；配置了ROUTING.PROVIDERS时不在同一服务商重试，而是切换到下一个
+_C.RATE_LIMIT.BACKOFF_BASE = 0.5
+_C.RATE_LIMIT.BACKOFF_MAX = 20.0
+    # 第n次重试前随机等待0到min(BACKOFF_MAX, BACKOFF_BASE * 2**n)秒；有Retry-After时至少等那么久
+
+_C.CASSETTE = CN()
+    # 模型请求的录制与回放，用于反复跑同一批问题（回归测试、性能测试）而不依赖真实的模型服务
+_C.CASSETTE.MODE = ""
+    # "record"：照常请求模型，同时把每次的请求哈希与回应追加到FILE；"replay"：不访问网络，返回录制的回应，找不到时报错；留空则关闭
+_C.CASSETTE.FILE = ".cache/llm_cassette.jsonl"
+_C.CASSETTE.LATENCY_SCALE = 0.0
+    # 回放时先等待录制时的耗时乘以该比例再返回，用于模拟模型延迟；0为不等待
+
 _C.SERVER = CN()
 _C.SERVER.ACCESS_PATHS = [
     "D:/GitRepo/MCP-Explorer/my_servers/Timetools.py",
@@ -29,16 +84,134 @@ _C.SERVER.ACCESS_PATHS = [
     # "http://localhost:8080/sse", # 使用SSE连接的server前必须先将其启动，并一直挂着
     # "http://localhost:8081/mcp", # 使用Streamable HTTP连接的server可以在需要时启动，使用后可以关闭
 ] 
+_C.SERVER.LAZY_START = True
+    # 延迟启动：脚本未改动的server直接使用缓存的工具列表，直到它的工具第一次被调用时才启动（只对本地脚本生效）
+_C.SERVER.MANIFEST_CACHE_FILE = ".cache/tool_manifest.json"
+    # 工具列表缓存的保存路径，server启动后更新；留空则不缓存
+_C.SERVER.HEALTH_CHECK_INTERVAL = 30.0
+    # 对已连接的server发送ping的间隔（秒）；设为0则不做健康检查，也不回收空闲server
+_C.SERVER.HEALTH_CHECK_TIMEOUT = 5.0
+_C.SERVER.HEALTH_CHECK_FAILURES = 2
+    # 连续多少次ping失败后认为连接已断开，并重新连接（重新initialize）
+_C.SERVER.RECONNECT_BACKOFF_INITIAL = 1.0
+_C.SERVER.RECONNECT_BACKOFF_MAX = 60.0
+    # 重连的等待时间从INITIAL开始每次翻倍，最多MAX秒
+_C.SERVER.MAX_RECONNECT_ATTEMPTS = 5
+    # 连续重连失败多少次后放弃；之后调用它的工具时会再尝试启动
+_C.SERVER.IDLE_TIMEOUT = 600.0
+    # server空闲（没有工具调用）超过该秒数后被关闭以释放资源，它的工具仍然可用，下次调用时重新启动；设为0则不回收
 
 _C.HOST = CN()
-_C.HOST.MAX_MASSAGE_TURNS = 20
-    # HOST所记录的message数目上限，由于每次都会将全部message传递给模型，所以过多的message会导致token数过多
-    # 注意，除了消息，工具调用也会被记录在message中，所以每新增一轮对话可能增加两条或更多message
+_C.HOST.CONTEXT_TOKEN_BUDGET = 16000
+    # 每次请求发送给模型的token数上限（消息+工具列表），由于每次都会将全部message传递给模型，所以需要控制历史记录的大小
+    # 超出时先截断较早的工具调用结果，再整轮丢弃最早的对话；system prompt始终保留，工具调用与其结果不会被拆开
+_C.HOST.MODEL_TOKEN_BUDGETS = [
+    # ("deepseek-chat", 60000),
+    # ("llama3.2", 8000),
+]
+    # 按模型名单独设置的token上限，覆盖CONTEXT_TOKEN_BUDGET
+_C.HOST.COMPACT_TOOL_RESULT_CHARS = 200
+    # 压缩较早的工具调用时，工具结果保留的字符数
+_C.HOST.COMPACT_TARGET_RATIO = 0.75
+    # 超出token上限时把对话压缩到上限的这一比例，之后几轮只在末尾追加消息，prompt前缀不变，可以命中模型服务商的prompt缓存
+_C.HOST.TOOL_SELECTION_TOP_K = 5
+    # 每次请求只发送与问题最相关（BM25检索工具名、描述与参数名）的前k个工具，以及本次对话中用过的工具；
+    # 同一对话中发送过的工具之后一直保留（新的工具追加在末尾），以保持prompt前缀不变；
+    # 模型可以通过request_all_tools要求下一步发送全部工具。工具总数不超过k时总是全部发送；设为0则关闭
 # _C.HOST.LOG_FILE = "" 
 _C.HOST.LOG_FILE = "logs/.log"
     # 日志保存路径, 留空则将日志输出到控制台
+_C.HOST.TRANSCRIPT_FILE = "logs/transcript.jsonl"
+    # 对话记录保存路径，每条消息加入对话时写入一行JSON（由后台线程写入，不阻塞对话）；留空则不记录
+_C.HOST.TRANSCRIPT_MAX_CHARS = 2000
+    # 对话记录中单条消息内容的最大字符数，超出时只保留开头和结尾
 _C.HOST.NEED_USER_CONFIRM = False 
-    # 调用工具时是否需要用户确认
+    # 调用工具时是否需要用户确认（只在交互式对话中）。模型一步返回的多个工具调用一起确认；
+    # 等待回答时事件循环照常运行，不计入工具耗时和QUERY_TIMEOUT（见approval.py）
+_C.HOST.AUTO_APPROVE_TOOLS = []
+    # 不需要确认的工具（server上的工具名或模型看到的名字）；确认时回答t也会在本次会话中长期允许这些工具
+_C.HOST.AUTO_APPROVE_SERVERS = []
+    # 不需要确认的server，其所有工具都直接调用；确认时回答s也会在本次会话中长期允许这些server
+_C.HOST.MAX_INFLIGHT_PER_SERVER = 4
+    # 模型一次返回多个工具调用时会并发执行，这里限制同一个server上同时进行的调用数目
+_C.HOST.TOOL_CACHE_DEFAULT_TTL = 300.0
+    # 工具结果缓存的有效期（秒）。只读且幂等（MCP注解readOnlyHint和idempotentHint均为True）的工具默认启用缓存
+_C.HOST.TOOL_CACHE_TTLS = [
+    ("transform_timezone", 86400.0),
+    ("brave_search", 600.0),
+    ("get_filter_image_url", 600.0),
+]
+    # 按工具名单独设置缓存有效期，可以为没有注解的工具开启缓存；设为0则关闭该工具的缓存
+_C.HOST.TOOL_CACHE_MAX_ENTRIES = 256
+    # 缓存的结果条数上限，超出时淘汰最久未使用的
+_C.HOST.SPECULATIVE_TOOLS = [
+    "get_current_time",
+    "transform_timezone",
+    "brave_search",
+]
+    # 流式输出时可以预先执行的只读工具：参数一旦完整且符合工具的inputSchema就开始调用，不等回应结束；
+    # 最终回应中的调用与之不同时丢弃结果。其他工具在回应结束后才调用（有副作用的调用无法撤回）。
+    # 开启HOST.NEED_USER_CONFIRM时，只有被长期允许的工具（AUTO_APPROVE_TOOLS/SERVERS或确认时回答t/s）才预先执行
+_C.HOST.MAX_AGENT_STEPS = 10
+    # 处理一个问题时最多请求模型的次数（模型每次调用工具后都会再请求一次）
+_C.HOST.QUERY_TIMEOUT = 180.0
+    # 处理一个问题的时间上限（秒），超时后正在进行的工具调用会被取消
+_C.HOST.QUERY_TOKEN_LIMIT = 100000
+    # 处理一个问题累计消耗的token数上限（prompt+completion）
+_C.HOST.STEP_LOG_FILE = "logs/steps.jsonl"
+    # 每一步（请求模型+执行工具）的耗时与token数记录，每行一个JSON，便于跨会话统计；留空则不记录
+
+_C.BLOBS = CN()
+    # 工具结果中的大段文本和二进制内容（图片、音频、二进制资源）存入本地的blob存储，对话中只留句柄、大小和预览，
+    # 避免每次请求模型都重新发送它们
+_C.BLOBS.DIR = ".cache/blobs"
+    # blob存储目录，文件名为内容的哈希（相同内容只存一份）；留空则关闭：文本全部放进对话，二进制内容只留类型和大小
+_C.BLOBS.INLINE_MAX_CHARS = 4000
+    # 超过这个字符数的文本块存为blob，模型可以用host内置的read_blob工具分段读取
+_C.BLOBS.PREVIEW_CHARS = 500
+    # 存为blob的文本在对话中保留的开头字符数
+
+_C.COMPACT = CN()
+    # 工具结果进入对话前的压缩（见compactor.py）：JSON结果按字段投影并限制条数和长度，去掉空值；
+    # 按工具配置时，文本还可以合并多余空白和重复行。改变了内容时，完整结果存入blob存储（BLOBS），模型仍可读取
+_C.COMPACT.ENABLED = True
+_C.COMPACT.MAX_CHARS = 0
+    # 没有单独规则的工具，结果的字符数上限（超出时保留开头和结尾）；0为不限（大段文本由BLOBS处理）
+_C.COMPACT.TOOLS = [
+    ("brave_search", {"fields": ["query", "results.title", "results.link", "results.snippet"], "max_items": 5, "max_string_chars": 400,
+                      "collapse_whitespace": True}),
+    ("get_filter_image_url", {"max_chars": 1000}),
+]
+    # 按工具名设置的规则，可用的选项：fields（保留的字段，a.b为嵌套字段）、max_items（列表条数）、
+    # max_string_chars（每个字符串的长度）、max_chars（总字符数）、drop_empty（去掉空值）、
+    # collapse_whitespace（合并空白，默认关闭）、dedupe_lines（合并连续重复的行，默认关闭）
+
+_C.BATCH = CN()
+    # 批量模式（python host.py --batch queries.jsonl）：从JSONL文件读取问题，每个问题使用独立的对话，共享server连接
+_C.BATCH.CONCURRENCY = 4
+    # 同时处理的问题数
+_C.BATCH.OUTPUT_FILE = "logs/batch_results.jsonl"
+    # 每个问题的回答、耗时与token数，每行一个JSON
+
+_C.SERVE = CN()
+    # 服务模式（python host.py --serve）：以HTTP/WebSocket接口对外提供对话，所有会话共享server连接和模型client
+_C.SERVE.HOST = "127.0.0.1"
+_C.SERVE.PORT = 8000
+_C.SERVE.TENANT_CONCURRENCY = 4
+    # 每个租户（请求头X-Tenant）同时处理的问题数
+_C.SERVE.TENANT_MAX_QUEUED = 16
+    # 每个租户排队等待的问题数上限，超出时返回429
+_C.SERVE.MAX_CONVERSATIONS = 1000
+    # 同时存在的会话数上限
+_C.SERVE.CONVERSATION_IDLE_TIMEOUT = 3600.0
+    # 会话空闲超过该秒数后被清除；设为0则不清除
+
+_C.TRACING = CN()
+    # 各阶段耗时追踪（连接server、list_tools、请求模型、调用工具、agent每一步），同时汇总成Prometheus直方图
+_C.TRACING.FILE = "logs/traces.jsonl"
+    # span的保存路径，每个span一行JSON（含trace_id/parent_id，可还原嵌套关系）；留空则不保存
+_C.TRACING.METRICS_PORT = 0
+    # 交互和批量模式下在该端口提供 GET /metrics（Prometheus文本格式）；设为0则不提供。服务模式总是在其端口上提供/metrics
 
 def get_cfg_defaults():
     """Get a yacs CfgNode object with default values for my_project."""
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+'''
+对话上下文管理：按token数而不是消息条数控制发送给模型的历史记录。
+消息追加时增量计数；超出预算时先压缩较早的工具调用结果，再整轮丢弃最早的对话，
+system prompt 始终保留，工具调用（assistant.tool_calls + 对应的tool消息）不会被拆开。
+'''
+
+import re
+import json
+from typing import List, Callable, Optional
+
+from loguru import logger
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception: # tiktoken is optional, fall back to an estimate
+    _ENCODING = None
+_CJK = re.compile("[\u2e80-\U0010ffff]") # ~1 token per char in the estimate
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens of a text with tiktoken if available, otherwise estimate (CJK ~1 token per char, others ~4 chars per token)"""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    cjk_chars = len(_CJK.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def count_message_tokens(message: dict) -> int:
+    """Count tokens of one chat message, including its tool calls and the per-message overhead"""
+    tokens = 4
+    content = message.get("content")
+    if content:
+        tokens += count_tokens(content if isinstance(content, str) else json.dumps(content, ensure_ascii=False))
+    for tool_call in message.get("tool_calls") or []:
+        tokens += 4 + count_tokens(tool_call["function"]["name"]) + count_tokens(tool_call["function"]["arguments"])
+    return tokens
+
+
+class Dialogue:
+    def __init__(self, init_messages: List[dict], compact_chars: int = 200, on_append: Optional[Callable[[dict], None]] = None):
+        """
+        Args:
+            init_messages: leading messages (the system prompt) that are never evicted
+            compact_chars: tool results of compacted tool calls are cut to this many characters
+            on_append: called with every message added to the dialogue (the initial ones included), e.g. to journal it
+        """
+        self.init_messages = init_messages
+        self.compact_chars = compact_chars
+        self.on_append = on_append
+        self.messages: List[dict] = []
+        self._token_counts: List[int] = [] # token count of each message, same order as self.messages
+        self.reset()
+
+    def reset(self):
+        """Drop everything but the initial messages"""
+        self.messages = [message.copy() for message in self.init_messages]
+        self._token_counts = [count_message_tokens(message) for message in self.messages]
+        if self.on_append is not None:
+            for message in self.messages:
+                self.on_append(message)
+
+    def append(self, message: dict):
+        """Add a message and count its tokens once"""
+        self.messages.append(message)
+        self._token_counts.append(count_message_tokens(message))
+        if self.on_append is not None:
+            self.on_append(message)
+
+    @property
+    def total_tokens(self) -> int:
+        self._sync()
+        return sum(self._token_counts)
+
+    def _sync(self):
+        """Count messages that were added to self.messages directly"""
+        for message in self.messages[len(self._token_counts):]:
+            self._token_counts.append(count_message_tokens(message))
+
+    def _turn_starts(self) -> List[int]:
+        """Indexes of the user messages, each one starts a turn"""
+        return [idx for idx, message in enumerate(self.messages) if message["role"] == "user"]
+
+    def _compact_tool_results(self, idx: int) -> int:
+        """Cut the tool results that answer the tool calls of the assistant message at idx, returns tokens saved"""
+        saved = 0
+        call_ids = {tool_call["id"] for tool_call in self.messages[idx]["tool_calls"]}
+        for tool_idx in range(idx + 1, len(self.messages)):
+            message = self.messages[tool_idx]
+            if message["role"] != "tool" or message.get("tool_call_id") not in call_ids:
+                break
+            content = message.get("content")
+            if not isinstance(content, str) or len(content) <= self.compact_chars:
+                continue
+            self.messages[tool_idx] = {
+                **message,
+                "content": content[:self.compact_chars] + f"...[truncated {len(content) - self.compact_chars} chars]",
+            }
+            new_count = count_message_tokens(self.messages[tool_idx])
+            saved += self._token_counts[tool_idx] - new_count
+            self._token_counts[tool_idx] = new_count
+        return saved
+
+    def fit(self, token_budget: int, target: Optional[int] = None) -> int:
+        """
+        Shrink the dialogue once it exceeds token_budget:
+        cut the tool results of earlier turns, then drop the oldest whole turns, then cut the tool results of the latest turn.
+        The initial messages and the latest turn are always kept.
+
+        Args:
+            token_budget: the dialogue is left untouched while it fits
+            target: size to shrink to once over budget (token_budget by default). A lower target leaves room for the
+                next turns to be appended without touching the earlier messages, which keeps the prompt prefix cacheable.
+
+        Returns:
+            token count after fitting
+        """
+        self._sync()
+        total = sum(self._token_counts)
+        if total <= token_budget:
+            return total
+        before = total
+        budget = token_budget
+        token_budget = min(target, token_budget) if target is not None else token_budget
+
+        turn_starts = self._turn_starts()
+        last_turn_start = turn_starts[-1] if turn_starts else len(self.messages)
+
+        # 1. compact tool results of earlier turns, oldest tool calls first
+        total -= self._compact_range(len(self.init_messages), last_turn_start, total - token_budget)
+
+        # 2. evict the oldest turns, a turn is a user message and everything up to the next one
+        first_kept = len(self.init_messages)
+        for turn_start in turn_starts[1:]:
+            if total <= token_budget:
+                break
+            total -= sum(self._token_counts[first_kept:turn_start])
+            first_kept = turn_start
+        if first_kept > len(self.init_messages):
+            del self.messages[len(self.init_messages):first_kept]
+            del self._token_counts[len(self.init_messages):first_kept]
+
+        # 3. compact tool results of the latest turn
+        if total > token_budget:
+            last_turn_start = self._turn_starts()[-1] if turn_starts else len(self.init_messages)
+            total -= self._compact_range(last_turn_start, len(self.messages), total - token_budget)
+
+        if total > budget:
+            logger.warning(f"Latest turn alone takes {total} tokens, more than the budget {budget}")
+        logger.info(f"Dialogue shrunk from {before} to {total} tokens (budget {budget}, target {token_budget})")
+        return total
+
+    def _compact_range(self, start: int, end: int, excess: int) -> int:
+        """Compact tool calls in self.messages[start:end] from the oldest on until excess tokens are saved, returns tokens saved"""
+        saved = 0
+        for idx in range(start, end):
+            if saved >= excess:
+                break
+            message = self.messages[idx]
+            if message["role"] == "assistant" and message.get("tool_calls"):
+                saved += self._compact_tool_results(idx)
+        return saved
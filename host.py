@@ -1,25 +1,55 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import sys
 import json
+import time
+import uuid
 import asyncio
+import argparse
 import textwrap
-from typing import List
+import importlib.util
+from typing import List, Dict, Set, Tuple, Callable, Optional
 from contextlib import AsyncExitStack
+from functools import partial
 
-from mcp import ClientSession, StdioServerParameters
+from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 from mcp.client.sse import sse_client
 from mcp.client.streamable_http import streamablehttp_client
 
-from openai import AsyncOpenAI
+import httpx
+from jsonschema import SchemaError
+from jsonschema.exceptions import best_match
+from jsonschema.protocols import Validator
+from jsonschema.validators import validator_for
+from referencing import Registry
+from referencing.exceptions import Unresolvable
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from loguru import logger
 from config import get_cfg_defaults
+from dialogue import Dialogue, count_tokens
+from tool_cache import ToolResultCache
+from manifest_cache import ToolManifestCache
+from tool_index import ToolIndex
+from tracing import Tracer, serve_metrics
+from cassette import LLMCassette, CassetteClient
+from routing import ProviderRouter
+from rate_limit import ProviderLimiter, Permit
+from blob_store import BlobStore, render_tool_content
+from compactor import OutputCompactor
+from approval import ToolApprovals
+import batch
+
+transcript_logger = logger.bind(transcript=True)
+step_logger = logger.bind(steps=True)
 
 model_info = {
     "DEEPSEEK": {"base_url": "https://api.deepseek.com",},
@@ -29,6 +59,189 @@ model_info = {
     "HUNYUAN": {"base_url": "https://api.hunyuan.cloud.tencent.com/v1",},
 }
 
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# offered along with a selected subset of the tools, so the model can still ask for the rest
+ALL_TOOLS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "request_all_tools",
+        "description": "Call this if none of the offered tools fits the task, all tools will be offered in the next step.",
+        "parameters": {"type": "object", "properties": {}},
+    }
+}
+
+# offered while a blob store is configured, large tool results are stored there and only previewed in the dialogue
+READ_BLOB_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "read_blob",
+        "description": "Read more of a large tool result that was stored as a blob, such as blob:0123abcd...",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "blob": {"type": "string", "description": "handle of the blob"},
+                "offset": {"type": "integer", "description": "first character to read", "default": 0},
+                "length": {"type": "integer", "description": "number of characters to read", "default": 4000},
+            },
+            "required": ["blob"],
+        },
+    }
+}
+
+# the host's own tools, they only change what the model is offered or read results it already got and need no confirmation
+HOST_TOOL_NAMES = {ALL_TOOLS_TOOL["function"]["name"], READ_BLOB_TOOL["function"]["name"]}
+
+# result of a tool call the user refused to run
+REFUSED_TOOL_RESULT = "Error: the user refused this tool call"
+
+async def prepend_chunk(first_chunk, stream, permit: Optional[Permit] = None):
+    """The chunks of a stream whose first chunk was already read, the permit of the request is released once it ends"""
+    outcome = "error"
+    try:
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+        outcome = "success"
+    finally:
+        await close_stream(stream)
+        if permit is not None:
+            await permit.release(outcome)
+
+async def close_stream(stream):
+    """Release the connection of a response stream that is not read to its end"""
+    close = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+    if close is not None:
+        await close()
+
+def new_usage_totals() -> dict:
+    return {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+def add_usage(totals: dict, step_record: dict):
+    """Add the token usage of one request to totals from new_usage_totals"""
+    totals["requests"] += 1
+    for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+        totals[key] += step_record.get(key, 0)
+
+def format_cache_usage(totals: dict) -> str:
+    prompt_tokens = totals["prompt_tokens"]
+    return "{}/{} prompt tokens cached ({:.0%}) in {} requests".format(
+        totals["cached_tokens"], prompt_tokens, totals["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0, totals["requests"])
+
+def console_output(text: str):
+    """Output of the interactive conversation"""
+    print(text, end='', flush=True)
+
+class Conversation:
+    """
+    State of one conversation: its dialogue, where its output goes and its counters.
+    Server sessions, tools, LLM clients and caches are shared by all conversations of a MyMCPClient.
+    """
+    def __init__(self, output: Optional[Callable[[str], None]] = None, interactive: bool = False, hedge: Optional[bool] = None):
+        """
+        Args:
+            output: receives the text shown to the user (answers, tool calls and results), discarded if None
+            interactive: whether the user can be asked on stdin to confirm tool calls
+            hedge: whether LLM requests of this conversation are hedged, ROUTING.HEDGE if None
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.dialogue: Optional[Dialogue] = None # set by MyMCPClient.new_conversation
+        self.output = output or (lambda text: None)
+        self.interactive = interactive
+        self.query_count = 0
+        self.journal_time = 0.0 # time spent journaling messages, reported per turn
+        self.journal_count = 0
+        self.tool_tokens_saved = 0 # tokens of tool results removed by compaction, reported per turn
+        self.used_tools = set() # tools called in this conversation, always offered again
+        self.blobs: Set[str] = set() # handles of the blobs its tool results refer to, the only ones it may read
+        self.offered_tools: List[str] = [] # tools offered so far, in the order they were first offered (see select_tools)
+        self.usage = new_usage_totals()
+        self.all_tools = False # the model asked for all tools during the current query
+        self.query_timeout: Optional[asyncio.Timeout] = None # HOST.QUERY_TIMEOUT of the current query, paused during approvals
+        self.hedge = hedge
+
+class ServerStatus:
+    """Health of one configured server, kept across its reconnects"""
+    def __init__(self, server_path: str):
+        self.server_path = server_path
+        self.state = "starting" # starting, ready, reconnecting, deferred (not started, or reaped while idle), failed, stopped
+        self.restarts = 0 # connections after the first one
+        self.connections = 0
+        self.connected_at: Optional[float] = None
+        self.total_uptime = 0.0 # of the previous connections
+        self.last_used = time.monotonic()
+        self.inflight = 0 # tool calls running on the server
+        self.last_error: Optional[str] = None
+
+    def connected(self):
+        if self.connections:
+            self.restarts += 1
+        self.connections += 1
+        self.connected_at = time.monotonic()
+        self.last_used = self.connected_at
+        self.state = "ready"
+
+    def disconnected(self, state: str, error: Optional[str] = None):
+        if self.connected_at is not None:
+            self.total_uptime += time.monotonic() - self.connected_at
+            self.connected_at = None
+        self.state = state
+        if error is not None:
+            self.last_error = error
+
+    def summary(self) -> dict:
+        uptime = time.monotonic() - self.connected_at if self.connected_at is not None else 0.0
+        return {
+            "state": self.state,
+            "restarts": self.restarts,
+            "uptime": round(uptime, 1),
+            "total_uptime": round(self.total_uptime + uptime, 1),
+            "idle": round(time.monotonic() - self.last_used, 1),
+            "inflight": self.inflight,
+            "last_error": self.last_error,
+        }
+
+class ToolSession(ClientSession):
+    """
+    ClientSession that validates the structured content of tool results with a validator compiled once per output schema,
+    ClientSession itself checks and compiles the schema on every call. Overrides ClientSession's private validation hook,
+    mcp has no public one; it raises the same RuntimeErrors as ClientSession, also for $refs that do not resolve.
+    mcp is pinned for it, tests/test_tool_session.py fails if a new version changes the hook or when it is called.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._output_validators: Dict[str, Tuple[dict, Validator]] = {} # tool name -> (outputSchema, its validator)
+
+    async def _validate_tool_result(self, name: str, result: types.CallToolResult) -> None:
+        if self._tool_output_schemas.get(name) is None:
+            # not listed yet (refreshes the schemas), or no schema to validate against
+            return await super()._validate_tool_result(name, result)
+        self.validate_structured_content(name, result.structuredContent)
+
+    def validate_structured_content(self, name: str, structured: Optional[dict]):
+        """RuntimeError, as raised by ClientSession, unless structured matches the listed outputSchema of the tool"""
+        output_schema = self._tool_output_schemas[name]
+        cached = self._output_validators.get(name)
+        if cached is None or cached[0] is not output_schema:
+            validator_class = validator_for(output_schema)
+            try:
+                validator_class.check_schema(output_schema)
+            except SchemaError as e:
+                raise RuntimeError(f"Invalid schema for tool {name}: {e}")
+            # $refs resolve within the schema only, as in ClientSession
+            cached = (output_schema, validator_class(output_schema, registry=Registry()))
+            self._output_validators[name] = cached
+        if structured is None:
+            raise RuntimeError(f"Tool {name} has an output schema but did not return structured content")
+        try:
+            error = best_match(cached[1].iter_errors(structured))
+        except Unresolvable as e:
+            # a $ref that does not resolve within the schema, found while validating
+            raise RuntimeError(f"Invalid schema for tool {name}: {e}") from e
+        if error is not None:
+            raise RuntimeError(f"Invalid structured content returned by tool {name}: {error.message}")
+
 class MyMCPClient:
     def __init__(self, cfg):
         # Initialize session and client objects
@@ -36,117 +249,547 @@ class MyMCPClient:
         self.model_name = cfg.MODEL.NAME
 
         self.sessions: List[ClientSession] = []
-        self.exit_stack = AsyncExitStack()
-        self._streams_contexts = []
-        self._session_contexts = []
         self.tools = []
 
+        # each server lives in its own task, see run_server
+        self._server_tasks: Dict[str, asyncio.Task] = {} # script path or url -> task
+        self._servers_starting = set() # paths of servers that are still connecting
+        self._server_ready = asyncio.Event() # set once the first server is ready (or all failed)
+        self._servers_settled = asyncio.Event() # set once every server is ready or failed
+        self._shutdown_event = asyncio.Event()
+
+        # routing table, built once in connect_to_servers
+        self.server_sessions: Dict[str, ClientSession] = {} # server name -> session
+        self.server_tools: Dict[str, List[types.Tool]] = {} # server name -> tools
+        self.tool_routes: Dict[str, Tuple[str, str]] = {} # exposed tool name -> (server name, tool name)
+        self._path_servers: Dict[str, str] = {} # script path or url -> server name
+        self._stale_servers = set() # servers that sent tools/list_changed
+        self._lazy_servers: Dict[str, str] = {} # server name -> script path, tools advertised from the manifest cache, not started yet
+        self._lazy_starts: Dict[str, asyncio.Future] = {} # script path -> resolved with True/False once a lazy server is up/failed
+        self.manifest_cache = ToolManifestCache(cfg.SERVER.MANIFEST_CACHE_FILE)
+        self.server_status: Dict[str, ServerStatus] = {} # script path or url -> health, see run_server
+        self._list_tools_calls = 0 # list_tools round trips, reported per turn
+        self._server_semaphores: Dict[str, asyncio.Semaphore] = {} # limit in-flight tool calls per server
+        self.tool_cache = ToolResultCache(max_entries=cfg.HOST.TOOL_CACHE_MAX_ENTRIES)
+        self.blob_store = BlobStore(cfg.BLOBS.DIR) if cfg.BLOBS.DIR else None # large and binary tool results
+        self.compactor = OutputCompactor(cfg.COMPACT.TOOLS, cfg.COMPACT.MAX_CHARS) if cfg.COMPACT.ENABLED else None
+        self.approvals = ToolApprovals(cfg.HOST.AUTO_APPROVE_TOOLS, cfg.HOST.AUTO_APPROVE_SERVERS) # HOST.NEED_USER_CONFIRM
+        self._tool_cache_ttls: Dict[Tuple[str, str], float] = {} # (server name, tool name) -> ttl, cacheable tools only
+        self._speculative_validators: Dict[str, Validator] = {} # exposed name -> inputSchema validator, HOST.SPECULATIVE_TOOLS only
+        self._exposed_names: Dict[Tuple[str, str], str] = {} # (server name, tool name) -> name shown to the model, never reassigned
+
+        self._llm_clients: Dict[Tuple[str, str], AsyncOpenAI] = {} # (MODEL.MARK, base_url) -> long-lived client
+        self.router = ProviderRouter(
+            [(cfg.MODEL.MARK, cfg.MODEL.NAME)] + [tuple(route) for route in cfg.ROUTING.PROVIDERS],
+            attempt_timeout=cfg.ROUTING.ATTEMPT_TIMEOUT,
+            window=cfg.ROUTING.WINDOW,
+            failure_cooldown=cfg.ROUTING.FAILURE_COOLDOWN,
+            hedge_percentile=cfg.ROUTING.HEDGE_PERCENTILE,
+            hedge_min_delay=cfg.ROUTING.HEDGE_MIN_DELAY,
+        ) # picks the provider of each LLM request
+        self._limiters: Dict[str, ProviderLimiter] = {} # MODEL.MARK -> rate limits, retries and concurrency of the provider
+        self.cassette = LLMCassette(cfg.CASSETTE.FILE, cfg.CASSETTE.MODE, cfg.CASSETTE.LATENCY_SCALE) if cfg.CASSETTE.MODE else None
+
         self.init_messages = [{
             "role": "system",
             "content": "You are a helpful assistant. If you have not called any tool, answer the question. Otherwise, call the appropriate tool."
         }]
-        self.messages = self.init_messages.copy()
+        self.session_id = uuid.uuid4().hex[:12] # tags the step records and transcript of this session
+        self.usage = new_usage_totals() # token usage of all conversations, with the prompt tokens served from the provider's cache
+        self._tools_tokens = 0 # tokens taken by the full tools list
+        self.tool_index = ToolIndex() # picks the tools relevant to a query, see select_tools
+        self.tracer = Tracer(export_file=bool(cfg.TRACING.FILE)) # spans around connects, list_tools, LLM requests, tool calls and steps
+        self.conversation = self.new_conversation(output=console_output, interactive=True) # the chat loop's conversation
+
+    def new_conversation(self, output: Optional[Callable[[str], None]] = None, interactive: bool = False) -> Conversation:
+        """Start a conversation with its own dialogue, it shares servers and LLM clients with the others"""
+        conversation = Conversation(output=output, interactive=interactive)
+        conversation.dialogue = Dialogue(
+            self.init_messages,
+            compact_chars=self.cfg.HOST.COMPACT_TOOL_RESULT_CHARS,
+            on_append=partial(self.journal_message, conversation),
+        )
+        return conversation
+
+    def journal_message(self, conversation: Conversation, message: dict):
+        """
+        Write a message to the transcript journal once, when it is added to the dialogue.
+        The record is only queued here, a background thread of the transcript sink writes it (see setup_logging).
+        Contents longer than HOST.TRANSCRIPT_MAX_CHARS are sampled (head and tail).
+        """
+        if not self.cfg.HOST.TRANSCRIPT_FILE:
+            return
+        start_time = time.perf_counter()
+        content = message.get("content")
+        max_chars = self.cfg.HOST.TRANSCRIPT_MAX_CHARS
+        if isinstance(content, str) and len(content) > max_chars:
+            message = {
+                **message,
+                "content": content[:max_chars // 2] + f" ...[{len(content) - max_chars} chars skipped]... " + content[-(max_chars // 2):],
+                "content_chars": len(content),
+            }
+        transcript_logger.info(json.dumps({
+            "time": time.time(),
+            "session": self.session_id,
+            "conversation": conversation.id,
+            "query": conversation.query_count,
+            "message": message,
+        }, ensure_ascii=False, default=str))
+        conversation.journal_time += time.perf_counter() - start_time
+        conversation.journal_count += 1
+
+    @property
+    def dialogue(self) -> Dialogue:
+        """Dialogue of the chat loop's conversation"""
+        return self.conversation.dialogue
+
+    @property
+    def messages(self) -> List[dict]:
+        """Messages of the chat loop's conversation, add new ones with dialogue.append so their tokens are counted once"""
+        return self.conversation.dialogue.messages
+
+    @property
+    def token_budget(self) -> int:
+        """Prompt token budget of the current model, HOST.MODEL_TOKEN_BUDGETS overrides HOST.CONTEXT_TOKEN_BUDGET"""
+        return dict(self.cfg.HOST.MODEL_TOKEN_BUDGETS).get(self.model_name, self.cfg.HOST.CONTEXT_TOKEN_BUDGET)
+
+    def fit_context(self, conversation: Conversation, tools_tokens: Optional[int] = None) -> int:
+        """
+        Shrink the dialogue so that messages and tools fit into the token budget, returns the estimated prompt tokens
+
+        Args:
+            conversation: whose dialogue is shrunk
+            tools_tokens: tokens of the tools sent along, the full tools list by default
+        """
+        if tools_tokens is None:
+            tools_tokens = self._tools_tokens
+        dialogue = conversation.dialogue
+        # once over budget, shrink well below it, so the following turns only append and the prompt prefix stays cached
+        messages_budget = self.token_budget - tools_tokens
+        prompt_tokens = dialogue.fit(messages_budget, int(messages_budget * self.cfg.HOST.COMPACT_TARGET_RATIO)) + tools_tokens
+        logger.info(f"Prompt size: ~{prompt_tokens} tokens ({len(dialogue.messages)} messages, tools ~{tools_tokens} tokens)")
+        return prompt_tokens
+
+    def select_tools(self, conversation: Conversation) -> List[dict]:
+        """
+        Tools to send with the next request of a conversation: request_all_tools, then the tools offered before in the
+        conversation, then newly selected ones (the HOST.TOOL_SELECTION_TOP_K most relevant to the latest query and the
+        tools used so far). The list only grows at its end, so the prompt prefix stays the same for the provider's cache.
+        All tools are sent if selection is off, there are not more than top-k of them, or the model asked for them.
+        """
+        top_k = self.cfg.HOST.TOOL_SELECTION_TOP_K
+        if top_k <= 0 or len(self.tools) <= top_k or conversation.all_tools:
+            return self.tools
+        query = next((message["content"] for message in reversed(conversation.dialogue.messages)
+                      if message["role"] == "user" and isinstance(message.get("content"), str)), "")
+        selected = set(self.tool_index.search(query, top_k)) | conversation.used_tools
+        tools_by_name = {tool["function"]["name"]: tool for tool in self.tools}
+        for name in tools_by_name:
+            if name in selected and name not in conversation.offered_tools:
+                conversation.offered_tools.append(name)
+        return [ALL_TOOLS_TOOL] + [tools_by_name[name] for name in conversation.offered_tools if name in tools_by_name]
     
     async def cleanup(self):
         """Properly clean up the sessions and streams"""
-        await self.exit_stack.aclose()
-        for session_context in self._session_contexts:
-            if session_context:
-                await session_context.__aexit__(None, None, None)
-        for streams_context in self._streams_contexts:
-            if streams_context:
-                await streams_context.__aexit__(None, None, None)
+        self._shutdown_event.set()
+        for server_path, task in self._server_tasks.items():
+            if server_path in self._servers_starting:
+                task.cancel() # still connecting, it will not notice the shutdown event
+        await asyncio.gather(*self._server_tasks.values(), return_exceptions=True)
+
+        llm_clients, self._llm_clients = self._llm_clients, {}
+        for llm_client in llm_clients.values():
+            await llm_client.close()
 
-    async def connect_to_servers(self):
+    async def connect_to_servers(self, wait_all: bool = False):
         """
         Connect to local MCP server by stdio or sse transport. Servers defined in config.py.
+        All servers are connected concurrently. Returns as soon as the first server is ready,
+        tools of slower servers join self.tools when their sessions come up.
+
+        With SERVER.LAZY_START, script servers whose manifest is cached and unchanged are not started here:
+        their cached tools are advertised at once and the server is started on the first call of one of them.
+
+        Args:
+            wait_all: return only once every started server is ready or failed, so their tools are there from the first query
+        """
+        eager_paths = []
+        for server_path in self.cfg.SERVER.ACCESS_PATHS:
+            self.server_status[server_path] = ServerStatus(server_path)
+            manifest = None
+            if self.cfg.SERVER.LAZY_START and not server_path.startswith("http"):
+                manifest = self.manifest_cache.load(server_path)
+            if manifest is None:
+                eager_paths.append(server_path)
+                continue
+            server_name = self._unique_server_name(manifest[0])
+            self.server_tools[server_name] = manifest[1]
+            self._path_servers[server_path] = server_name
+            self._lazy_servers[server_name] = server_path
+            self.server_status[server_path].state = "deferred"
+            logger.info(f"Server [{server_name}] ({server_path}) deferred, tools from cache:{[tool.name for tool in manifest[1]]}")
+        if self._lazy_servers:
+            self.rebuild_tool_routes()
+
+        self._servers_starting = set(eager_paths)
+        self._server_tasks = {server_path: asyncio.create_task(self.run_server(server_path)) for server_path in eager_paths}
+        if self._server_tasks:
+            await (self._servers_settled if wait_all else self._server_ready).wait()
+
+    async def get_session(self, server_name: str) -> ClientSession:
+        """Session of a server, a lazy (or reaped) server is started on its first use, a reconnecting one is waited for"""
+        if server_name in self._lazy_servers:
+            server_path = self._lazy_servers[server_name]
+            if server_path not in self._lazy_starts:
+                logger.info(f"Starting deferred server [{server_name}] ({server_path})")
+                self._lazy_starts[server_path] = asyncio.get_running_loop().create_future()
+                self._servers_starting.add(server_path)
+                self._server_tasks[server_path] = asyncio.create_task(self.run_server(server_path))
+            if not await asyncio.shield(self._lazy_starts[server_path]):
+                raise RuntimeError(f"server [{server_name}] failed to start")
+        return self.server_sessions[server_name]
+
+    async def run_server(self, server_path: str):
         """
-        for server_command in self.cfg.SERVER.ACCESS_PATHS:
-            if server_command.startswith("http"):
-                # await self.connect_sse_server(server_command)
-                await self.connect_to_streamable_http_server(server_command)
+        Supervise one server until cleanup: connect, health-check the connection, and reconnect it when it is lost,
+        with exponential backoff (SERVER.RECONNECT_BACKOFF_*) and at most SERVER.MAX_RECONNECT_ATTEMPTS failed attempts in a row.
+        A server idle for SERVER.IDLE_TIMEOUT is closed, its tools stay advertised and it is started again on the next call.
+
+        Args:
+            server_path: path of a server script, or url of a running server
+        """
+        status = self.server_status.setdefault(server_path, ServerStatus(server_path))
+        delay = self.cfg.SERVER.RECONNECT_BACKOFF_INITIAL
+        failed_attempts = 0
+        while True:
+            outcome = await self.run_connection(server_path, status)
+            if outcome in ("shutdown", "idle"):
+                return
+            if outcome == "ready_lost":
+                delay, failed_attempts = self.cfg.SERVER.RECONNECT_BACKOFF_INITIAL, 0
+            elif not status.connections:
+                status.state = "failed" # never connected, nothing to reconnect to
+                return
             else:
-                await self.connect_stdio_server(server_command)
-        
+                failed_attempts += 1
+                if failed_attempts >= self.cfg.SERVER.MAX_RECONNECT_ATTEMPTS:
+                    logger.error(f"Giving up on server {server_path} after {failed_attempts} failed reconnects")
+                    status.state = "failed"
+                    return
+            status.state = "reconnecting"
+            # calls made meanwhile wait for the reconnect instead of starting another connection (see get_session)
+            self._lazy_starts.setdefault(server_path, asyncio.get_running_loop().create_future())
+            logger.info(f"Reconnecting to server {server_path} in {delay:.1f}s")
+            try:
+                await asyncio.wait_for(self._shutdown_event.wait(), delay)
+                return
+            except TimeoutError:
+                pass
+            delay = min(delay * 2, self.cfg.SERVER.RECONNECT_BACKOFF_MAX)
+            self._servers_starting.add(server_path)
+
+    async def run_connection(self, server_path: str, status: ServerStatus) -> str:
+        """
+        Connect to a server once and hold the connection until it ends.
+        The transport and session contexts must be entered and exited in the same task, so each server gets its own.
+
+        Returns:
+            "shutdown", "idle" (reaped), "ready_lost" (was ready, then lost) or "failed" (could not connect)
+        """
+        start_time = time.perf_counter()
+        server_name = None
+        outcome = "failed"
+        try:
+            async with AsyncExitStack() as exit_stack:
+                with self.tracer.span("connect", server=self._path_servers.get(server_path), path=server_path,
+                                      restarts=status.restarts) as span:
+                    if server_path.startswith("http") and server_path.rstrip("/").endswith("/sse"):
+                        server_name = await self.connect_sse_server(server_path, exit_stack)
+                    elif server_path.startswith("http"):
+                        server_name = await self.connect_to_streamable_http_server(server_path, exit_stack)
+                    else:
+                        server_name = await self.connect_stdio_server(server_path, exit_stack)
+                    span.set(server=server_name)
+                    if server_name is None:
+                        span.status = "error"
+                if server_name is None:
+                    return outcome
+                self.rebuild_tool_routes()
+                status.connected()
+                logger.info("Server [{}] ready in {:.3f}s (restarts: {})".format(
+                    server_name, time.perf_counter() - start_time, status.restarts))
+                self._finish_server_startup(server_path, ready=True)
+                outcome = await self.supervise_session(server_name, status)
+                if outcome == "ready_lost":
+                    status.last_error = "health check failed"
+        except Exception as e:
+            if self._shutdown_event.is_set():
+                # the stdio transport may complain about its closed pipes while shutting down
+                logger.debug(f"Server {server_path} closed with error: {e}")
+                outcome = "shutdown"
+            else:
+                logger.error(f"Server {server_path} stopped with error: {e}")
+                print(f"**Server {server_path} stopped with error: {e}**")
+                status.last_error = str(e)
+                outcome = "ready_lost" if status.state == "ready" else "failed"
+        finally:
+            self._finish_server_startup(server_path, ready=False)
+            if server_name is not None:
+                if outcome == "shutdown":
+                    self.unregister_session(server_name)
+                else:
+                    self.suspend_session(server_name, server_path)
+            status.disconnected({"shutdown": "stopped", "idle": "deferred"}.get(outcome, "reconnecting"))
+        return outcome
+
+    async def supervise_session(self, server_name: str, status: ServerStatus) -> str:
+        """
+        Ping a connected server every SERVER.HEALTH_CHECK_INTERVAL seconds until cleanup, until
+        SERVER.HEALTH_CHECK_FAILURES pings in a row fail, or until it has been idle for SERVER.IDLE_TIMEOUT seconds.
+
+        Returns:
+            "shutdown", "ready_lost" or "idle"
+        """
+        session = self.server_sessions[server_name]
+        interval = self.cfg.SERVER.HEALTH_CHECK_INTERVAL
+        idle_timeout = self.cfg.SERVER.IDLE_TIMEOUT
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._shutdown_event.wait(), interval if interval > 0 else None)
+                return "shutdown"
+            except TimeoutError:
+                pass
+            if idle_timeout > 0 and not status.inflight and time.monotonic() - status.last_used > idle_timeout:
+                logger.info(f"Server [{server_name}] idle for more than {idle_timeout}s, closing it")
+                return "idle"
+            try:
+                await asyncio.wait_for(session.send_ping(), self.cfg.SERVER.HEALTH_CHECK_TIMEOUT)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.warning(f"Health check of server [{server_name}] failed ({failures}/{self.cfg.SERVER.HEALTH_CHECK_FAILURES}): {e!r}")
+                if failures >= self.cfg.SERVER.HEALTH_CHECK_FAILURES:
+                    return "ready_lost"
+
+    def _finish_server_startup(self, server_path: str, ready: bool):
+        """Mark a server as connected or failed, wake up connect_to_servers when there is something to use"""
+        self._servers_starting.discard(server_path)
+        lazy_start = self._lazy_starts.pop(server_path, None)
+        if lazy_start is not None and not lazy_start.done():
+            lazy_start.set_result(ready) # a failed lazy server is tried again on the next call
+        if ready or not self._servers_starting:
+            self._server_ready.set()
+        if not self._servers_starting:
+            self._servers_settled.set()
+
+    def rebuild_tool_routes(self):
+        """
+        Build the tool name -> server routing table and the tools list sent to the model.
+        The list is ordered by the server's position in SERVER.ACCESS_PATHS and then by tool name, whatever order
+        the servers came up in, so the same tools always serialize to the same prompt prefix.
+        A tool name already offered by an earlier connected server is exposed as "<server>__<tool>",
+        so names the model has seen stay valid when more servers come up.
+        """
+        self.tool_routes = {}
+        self._tool_cache_ttls = {}
+        self._speculative_validators = {}
+        configured_ttls = dict(self.cfg.HOST.TOOL_CACHE_TTLS)
+        speculative_tools = set(self.cfg.HOST.SPECULATIVE_TOOLS)
         available_tools = []
-        for session in self.sessions:
-            response = await session.list_tools()
-            available_tools.extend([{
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            } for tool in response.tools])
+        path_order = {path: idx for idx, path in enumerate(self.cfg.SERVER.ACCESS_PATHS)}
+        server_names = sorted(self.server_tools, key=lambda name: (path_order.get(self._server_path(name), len(path_order)), name))
+        for server_name in server_names:
+            for tool in sorted(self.server_tools[server_name], key=lambda tool: tool.name):
+                # results are cached for tools that are read-only and idempotent, or listed in config
+                annotations = tool.annotations
+                if annotations is not None and annotations.readOnlyHint and annotations.idempotentHint:
+                    ttl = configured_ttls.get(tool.name, self.cfg.HOST.TOOL_CACHE_DEFAULT_TTL)
+                else:
+                    ttl = configured_ttls.get(tool.name, 0)
+                if ttl > 0:
+                    self._tool_cache_ttls[(server_name, tool.name)] = ttl
+                exposed_name = self._exposed_names.get((server_name, tool.name))
+                if exposed_name is None:
+                    exposed_name = tool.name
+                    if exposed_name in self._exposed_names.values():
+                        exposed_name = f"{server_name}__{tool.name}"[:64]
+                        logger.info(f"Tool name [{tool.name}] is offered by several servers, exposed as [{exposed_name}]")
+                    self._exposed_names[(server_name, tool.name)] = exposed_name
+                self.tool_routes[exposed_name] = (server_name, tool.name)
+                if tool.name in speculative_tools or exposed_name in speculative_tools:
+                    try:
+                        validator_class = validator_for(tool.inputSchema)
+                        validator_class.check_schema(tool.inputSchema)
+                        self._speculative_validators[exposed_name] = validator_class(tool.inputSchema)
+                    except SchemaError as e:
+                        logger.warning(f"Tool [{exposed_name}] is not run speculatively, its inputSchema is invalid: {e.message}")
+                available_tools.append({
+                    "type": "function",
+                    "function": {
+                        "name": exposed_name,
+                        "description": tool.description,
+                        "parameters": tool.inputSchema
+                    }
+                })
+        if self.blob_store is not None:
+            available_tools.append(READ_BLOB_TOOL)
         self.tools = available_tools
-        
+        self._tools_tokens = count_tokens(json.dumps(self.tools, ensure_ascii=False))
+        self.tool_index.build(self.tools)
+
+    async def register_session(self, session: ClientSession, server_path: str):
+        """
+        Initialize a connected session and record its tools in the routing table
+
+        Args:
+            session: the connected (not yet initialized) session
+            server_path: script path or url of the server, used when the server reports no name
+        """
+        init_result = await session.initialize()
+        raw_name = init_result.serverInfo.name or server_path
+        server_name = self._path_servers.get(server_path) # a lazy server keeps the name its cached tools were advertised with
+        if server_name in self._lazy_servers:
+            del self._lazy_servers[server_name]
+        else:
+            server_name = self._unique_server_name(raw_name)
+        self.sessions.append(session)
+        self.server_sessions[server_name] = session
+        self._path_servers[server_path] = server_name
+
+        with self.tracer.span("list_tools", server=server_name) as span:
+            response = await session.list_tools()
+            span.set(tools=len(response.tools))
+        self._list_tools_calls += 1
+        self.server_tools[server_name] = response.tools
+        if not server_path.startswith("http"):
+            self.manifest_cache.store(server_path, raw_name, response.tools)
+        logger.info(f"Connected to server [{server_name}] ({server_path}) with tools:{[tool.name for tool in response.tools]}")
+        return server_name
+
+    def unregister_session(self, server_name: str):
+        """Drop a closed session and its tools from the routing table"""
+        session = self.server_sessions.pop(server_name, None)
+        if session in self.sessions:
+            self.sessions.remove(session)
+        self.server_tools.pop(server_name, None)
+        self._path_servers = {path: name for path, name in self._path_servers.items() if name != server_name}
+        self._stale_servers.discard(server_name)
+        self.rebuild_tool_routes()
+
+    def suspend_session(self, server_name: str, server_path: str):
+        """Drop a closed session but keep advertising its tools, the server is connected again when they are called"""
+        session = self.server_sessions.pop(server_name, None)
+        if session in self.sessions:
+            self.sessions.remove(session)
+        self._stale_servers.discard(server_name)
+        self._lazy_servers[server_name] = server_path
+
+    def _server_path(self, server_name: str) -> Optional[str]:
+        return next((path for path, name in self._path_servers.items() if name == server_name), None)
+
+    def server_stats(self) -> Dict[str, dict]:
+        """Health of every configured server, by server name (or path if it never connected)"""
+        return {self._path_servers.get(path, path): status.summary() for path, status in self.server_status.items()}
+
+    def rate_limit_stats(self) -> Dict[str, dict]:
+        """Concurrency limit, queue and throttling of every provider used so far, by MODEL.MARK"""
+        return {mark: limiter.stats() for mark, limiter in self._limiters.items()}
+
+    def _unique_server_name(self, raw_name: str) -> str:
+        """Turn a server name into a unique name that is valid inside a function name"""
+        base_name = re.sub(r"[^a-zA-Z0-9_-]", "_", os.path.splitext(os.path.basename(raw_name.rstrip("/")))[0]) or "server"
+        server_name, idx = base_name, 1
+        while server_name in self.server_sessions or server_name in self.server_tools:
+            idx += 1
+            server_name = f"{base_name}_{idx}"
+        return server_name
+
+    async def refresh_stale_tools(self):
+        """Re-list the tools of servers that sent tools/list_changed, then rebuild the routing table"""
+        if not self._stale_servers:
+            return
+        stale_servers, self._stale_servers = self._stale_servers, set()
+        for server_name in stale_servers:
+            with self.tracer.span("list_tools", server=server_name, refresh=True) as span:
+                response = await self.server_sessions[server_name].list_tools()
+                span.set(tools=len(response.tools))
+            self._list_tools_calls += 1
+            self.server_tools[server_name] = response.tools
+            logger.info(f"Tools of server [{server_name}] changed, now:{[tool.name for tool in response.tools]}")
+        self.rebuild_tool_routes()
+
+    async def handle_server_message(self, server_path: str, message):
+        """
+        Message handler of a session. A tools/list_changed notification only marks the server as stale,
+        the tools are re-listed before the next request (awaiting list_tools here would block the session's reader).
+        """
+        if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+            server_name = self._path_servers.get(server_path)
+            if server_name:
+                logger.info(f"Server [{server_name}] notified tools/list_changed")
+                self._stale_servers.add(server_name)
 
-    async def connect_sse_server(self, server_url: str):
+    async def connect_sse_server(self, server_url: str, exit_stack: AsyncExitStack):
         """
         Connect to a local MCP server using SSE transport
 
         Args:
             server_url: url of the server (such as http://localhost:8000/messages/)
+            exit_stack: keeps the transport and session contexts alive
+
+        Returns:
+            name of the connected server, None if the connection failed
         """
-        # Store the context managers so they stay alive
-        self._streams_contexts.append(sse_client(url=server_url))
         try:
-            streams = await self._streams_contexts[-1].__aenter__() # streams相当于(stdio, write)
+            streams = await exit_stack.enter_async_context(sse_client(url=server_url)) # streams相当于(stdio, write)
         except Exception as e:
             logger.error(f"Failed to connect to SSE server: {e}")
             logger.error(f"Please check if the server is running at {server_url}")
             print(f"**Failed to connect to SSE server: {e}**")
             print(f"**Please check if the server is running at {server_url}**")
-            self._streams_contexts.pop()
             return
 
-        self._session_contexts.append(ClientSession(*streams))
-        session: ClientSession = await self._session_contexts[-1].__aenter__()
-        self.sessions.append(session)
-        await session.initialize()
-
+        session = await exit_stack.enter_async_context(ToolSession(*streams, message_handler=partial(self.handle_server_message, server_url)))
         logger.info(f"Connecting to sse server {server_url}")
-        response = await session.list_tools()
-        tools = response.tools
-        logger.info(f"Connected to server {server_url} with tools{[tool.name for tool in tools]}")
+        return await self.register_session(session, server_url)
     
-    async def connect_to_streamable_http_server(self, server_url: str):
+    async def connect_to_streamable_http_server(self, server_url: str, exit_stack: AsyncExitStack):
         """
         Connect to a local MCP server using Streamable HTTP transport
 
         Args:
             server_url: url of the server (such as http://localhost:8080/mcp)
+            exit_stack: keeps the transport and session contexts alive
+
+        Returns:
+            name of the connected server, None if the connection failed
         """
-        self._streams_contexts.append(streamablehttp_client(
-            url=server_url,
-        ))
         try:
-            read_stream, write_stream, _ = await self._streams_contexts[-1].__aenter__()
+            read_stream, write_stream, _ = await exit_stack.enter_async_context(streamablehttp_client(
+                url=server_url,
+            ))
         except Exception as e:
             logger.error(f"Failed to connect to Streamable HTTP server: {e}")
             logger.error(f"Please check if the server is running at {server_url}")
             print(f"**Failed to connect to Streamable HTTP server: {e}**")
             print(f"**Please check if the server is running at {server_url}**")
-            self._streams_contexts.pop()
             return
         
-        self._session_contexts.append(ClientSession(read_stream, write_stream))
-        session: ClientSession = await self._session_contexts[-1].__aenter__()
-        self.sessions.append(session)
-        await session.initialize()
-
+        session = await exit_stack.enter_async_context(ToolSession(read_stream, write_stream, message_handler=partial(self.handle_server_message, server_url)))
         logger.info(f"Connecting to streamable HTTP server {server_url}")
-        response = await session.list_tools()
-        tools = response.tools
-        logger.info(f"Connected to server {server_url} with tools{[tool.name for tool in tools]}")
+        return await self.register_session(session, server_url)
     
-    async def connect_stdio_server(self, server_script_path: str):
+    async def connect_stdio_server(self, server_script_path: str, exit_stack: AsyncExitStack):
         """
         Connect to a local MCP server script using stdio transport
 
         Args:
             server_script_path: path to the server script (for me only .py)
+            exit_stack: keeps the transport and session contexts alive
+
+        Returns:
+            name of the connected server, None if the script is not supported
         """
         is_python = server_script_path.endswith('.py')
         if not is_python:
@@ -170,125 +813,712 @@ class MyMCPClient:
             env=None
         )
         
-        stdio, write = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        session = await self.exit_stack.enter_async_context(ClientSession(stdio, write))
-        self.sessions.append(session)
-        await session.initialize()
+        stdio, write = await exit_stack.enter_async_context(stdio_client(server_params))
+        session = await exit_stack.enter_async_context(ToolSession(stdio, write, message_handler=partial(self.handle_server_message, server_script_path)))
         logger.info("Connecting to server script: {}".format(server_script_path))
+        return await self.register_session(session, server_script_path)
 
-        # List available tools
-        response = await session.list_tools()
-        tools = response.tools
-        logger.info(f"Connected to server with tools:{[tool.name for tool in tools]}")
 
+    def get_llm_client(self, mark: Optional[str] = None) -> AsyncOpenAI:
+        """
+        Get the client of a provider, MODEL.MARK by default. Clients are cached per (mark, base_url),
+        so connections are kept alive and reused by every request, including each step of the tool loop.
+        """
+        mark = mark or self.cfg.MODEL.MARK
+        base_url = model_info[mark]["base_url"]
+        if self.cassette is not None and self.cassette.mode == "replay":
+            # replayed responses need neither network nor API key
+            if ("replay", "") not in self._llm_clients:
+                self._llm_clients[("replay", "")] = CassetteClient(self.cassette)
+            return self._llm_clients[("replay", "")]
+        if (mark, base_url) not in self._llm_clients:
+            # HTTP/2 is negotiated through TLS, plain http endpoints (such as local ollama) stay on HTTP/1.1
+            http2 = self.cfg.MODEL.HTTP2 and HTTP2_AVAILABLE and base_url.startswith("https")
+            limiter = self.get_limiter(mark)
+            async def observe_rate_limits(response: httpx.Response):
+                limiter.observe_headers(response.headers)
+            http_client = DefaultAsyncHttpxClient(
+                http2=http2,
+                event_hooks={"response": [observe_rate_limits]},
+                limits=httpx.Limits(
+                    max_connections=self.cfg.MODEL.MAX_CONNECTIONS,
+                    max_keepalive_connections=self.cfg.MODEL.MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=self.cfg.MODEL.KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._llm_clients[(mark, base_url)] = AsyncOpenAI(
+                api_key=os.getenv("{}_API_KEY".format(mark.upper())),
+                base_url=base_url,
+                http_client=http_client,
+                # retried by the provider's limiter (see get_limiter), which knows about the other requests
+                max_retries=0,
+            )
+            if self.cassette is not None:
+                self._llm_clients[(mark, base_url)] = CassetteClient(self.cassette, self._llm_clients[(mark, base_url)])
+            logger.info(f"Created LLM client for {mark} ({base_url}), http2: {http2}")
+        return self._llm_clients[(mark, base_url)]
 
-    async def get_response_message(self) -> ChatCompletionMessage:
-        """Get response from OpenAI API"""
-        client = AsyncOpenAI(
-            api_key=os.getenv("{}_API_KEY".format(self.cfg.MODEL.MARK.upper())),
-            base_url=model_info[self.cfg.MODEL.MARK]["base_url"],
-        )
-        response = await client.chat.completions.create(
-            model=self.model_name,
-            messages=self.messages,
-            tools=self.tools,
+    def get_limiter(self, mark: Optional[str] = None) -> ProviderLimiter:
+        """Rate limiter of a provider, MODEL.MARK by default, shared by all its requests and models"""
+        mark = mark or self.cfg.MODEL.MARK
+        if mark not in self._limiters:
+            limits = {limit[0]: limit[1:] for limit in self.cfg.RATE_LIMIT.PROVIDER_LIMITS}
+            requests_per_minute, tokens_per_minute = limits.get(mark, (0, 0))
+            self._limiters[mark] = ProviderLimiter(
+                mark,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                initial_concurrency=self.cfg.RATE_LIMIT.INITIAL_CONCURRENCY,
+                min_concurrency=self.cfg.RATE_LIMIT.MIN_CONCURRENCY,
+                max_concurrency=self.cfg.RATE_LIMIT.MAX_CONCURRENCY,
+                max_retries=self.cfg.RATE_LIMIT.MAX_RETRIES,
+                backoff_base=self.cfg.RATE_LIMIT.BACKOFF_BASE,
+                backoff_max=self.cfg.RATE_LIMIT.BACKOFF_MAX,
+            )
+        return self._limiters[mark]
+
+    async def get_response_message(
+        self,
+        conversation: Conversation,
+        on_tool_call: Optional[Callable[[int, ChatCompletionMessageToolCall], None]] = None,
+        step_record: Optional[dict] = None,
+    ) -> ChatCompletionMessage:
+        """
+        Get response from OpenAI API
+
+        Args:
+            conversation: whose dialogue is sent
+            on_tool_call: in streaming mode, called with (index, tool_call) as soon as the arguments of a tool call are complete
+            step_record: if given, filled with llm_latency, prompt_tokens, completion_tokens and the tools sent
+        """
+        if step_record is None:
+            step_record = {}
+        with self.tracer.span("llm_request", model=self.model_name, conversation=conversation.id, stream=self.cfg.MODEL.STREAM) as span:
+            await self.refresh_stale_tools()
+            tools = self.select_tools(conversation)
+            tools_tokens = self._tools_tokens if tools is self.tools else count_tokens(json.dumps(tools, ensure_ascii=False))
+            estimated_prompt_tokens = self.fit_context(conversation, tools_tokens)
+            step_record.update(tools_sent=len(tools), tools_tokens=tools_tokens, tools_tokens_full=self._tools_tokens)
+            if tools is not self.tools:
+                logger.info(f"Tools: sent {len(tools) - 1} of {len(self.tools)}, ~{tools_tokens} instead of ~{self._tools_tokens} tokens")
+            start_time = time.perf_counter()
+            response, (mark, model), permit = await self.create_completion(conversation, tools, estimated_prompt_tokens)
+            # the model's latency starts once the request is sent, the time before is spent in the limiter's queue
+            if permit is not None:
+                start_time = permit.started
+                step_record.update(queue_wait=permit.queue_wait, retry_wait=permit.retry_wait, retries=permit.retries)
+            else:
+                step_record.update(queue_wait=0.0, retry_wait=0.0, retries=0)
+            step_record.update(provider=mark, model=model)
+            span.set(provider=mark, model=model, queue_wait=step_record["queue_wait"], retries=step_record["retries"])
+            if self.cfg.MODEL.STREAM:
+                message = await self.get_streamed_response_message(conversation, response, start_time, on_tool_call, step_record)
+            else:
+                step_record["llm_latency"] = time.perf_counter() - start_time
+                logger.info("LLM call took {:.3f}s".format(step_record["llm_latency"]))
+                self._record_usage(step_record, response.usage)
+                message = response.choices[0].message
+
+            # providers that report no usage get an estimate
+            if "prompt_tokens" not in step_record:
+                step_record["cached_tokens"] = 0
+                step_record["prompt_tokens"] = estimated_prompt_tokens
+                step_record["completion_tokens"] = count_tokens(message.content or "") + sum(
+                    count_tokens(tool_call.function.arguments) for tool_call in message.tool_calls or [])
+            span.set(tool_calls=len(message.tool_calls or []),
+                     **{key: step_record[key] for key in ("prompt_tokens", "cached_tokens", "completion_tokens", "tools_sent")})
+            # the estimate was taken from the token bucket before the request, the rest is charged now
+            if permit is not None:
+                permit.limiter.consume_tokens(
+                    step_record["completion_tokens"] + max(0, step_record["prompt_tokens"] - estimated_prompt_tokens))
+        self.tracer.metrics.observe("mcp_host_llm_queue_wait_seconds", step_record["queue_wait"],
+                                    "Time LLM requests waited for the provider's rate and concurrency limits", model=step_record["model"])
+        for kind in ("prompt", "cached", "completion"):
+            self.tracer.metrics.inc("mcp_host_llm_tokens_total", step_record[f"{kind}_tokens"],
+                                    "Tokens used by LLM requests, cached is the part of prompt served from the provider's cache",
+                                    model=step_record["model"], kind=kind)
+        return message
+
+    async def create_completion(self, conversation: Conversation, tools: List[dict], prompt_tokens: int = 0) -> tuple:
+        """
+        Send the dialogue of a conversation through the router: to the provider that is fastest lately, failing over
+        to the others of ROUTING.PROVIDERS on errors and timeouts, and hedged if the conversation (or ROUTING.HEDGE) asks for it.
+        Each attempt waits for the rate and concurrency limits of its provider and is retried there on throttling and
+        transient errors (RATE_LIMIT).
+
+        Args:
+            prompt_tokens: estimated prompt tokens, for the provider's tokens per minute
+
+        Returns:
+            (response, (mark, model), permit), in streaming mode the response is the chunk stream, starting with the first
+            chunk, and releases the permit once it ends. The permit is None for replayed responses.
+        """
+        messages = conversation.dialogue.messages
+        stream = self.cfg.MODEL.STREAM
+
+        async def attempt(route, timed):
+            mark, model = route
+            client = self.get_llm_client(mark)
+
+            async def request():
+                if not stream:
+                    return await client.chat.completions.create(model=model, messages=messages, tools=tools)
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    tools=tools,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                # a streaming provider has answered once its first chunk is there, until then another one may still win
+                try:
+                    first_chunk = await response.__anext__()
+                except StopAsyncIteration:
+                    await close_stream(response)
+                    raise RuntimeError(f"{mark}/{model} returned an empty stream")
+                except BaseException:
+                    await close_stream(response)
+                    raise
+                return first_chunk, response
+
+            if self.cassette is not None and self.cassette.mode == "replay":
+                return await timed(request), None
+            # only the requests themselves are timed by the router, not the limiter's queue and backoff;
+            # with other providers to fail over to, a failed request goes to them instead of being retried
+            return await self.get_limiter(mark).call(partial(timed, request), prompt_tokens,
+                                                     max_retries=0 if len(self.router.routes) > 1 else None)
+
+        async def discard(result):
+            response, permit = result
+            if stream:
+                await close_stream(response[1])
+            if permit is not None:
+                await permit.release("cancelled")
+
+        hedge = conversation.hedge if conversation.hedge is not None else self.cfg.ROUTING.HEDGE
+        (response, permit), route = await self.router.call(attempt, hedge=hedge, discard=discard)
+        if route != (self.cfg.MODEL.MARK, self.model_name):
+            logger.info(f"LLM request served by {route[0]}/{route[1]}")
+        if stream:
+            return prepend_chunk(*response, permit), route, permit
+        if permit is not None:
+            await permit.release()
+        return response, route, permit
+
+    @staticmethod
+    def _record_usage(step_record: dict, usage):
+        """Copy token usage reported by the provider into a step record, with the prompt tokens it served from its cache"""
+        if usage is None:
+            return
+        step_record["prompt_tokens"] = usage.prompt_tokens
+        step_record["completion_tokens"] = usage.completion_tokens
+        # OpenAI style prompt_tokens_details.cached_tokens, or DeepSeek's prompt_cache_hit_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None)
+        if cached_tokens is None:
+            cached_tokens = (usage.model_extra or {}).get("prompt_cache_hit_tokens")
+        step_record["cached_tokens"] = cached_tokens or 0
+
+    async def get_streamed_response_message(
+        self,
+        conversation: Conversation,
+        stream,
+        start_time: float,
+        on_tool_call: Optional[Callable[[int, ChatCompletionMessageToolCall], None]] = None,
+        step_record: Optional[dict] = None,
+    ) -> ChatCompletionMessage:
+        """
+        Read a streamed response (from create_completion) started at start_time. Content goes to the conversation's output
+        as it arrives, tool calls are rebuilt from their argument deltas and handed to on_tool_call once their JSON arguments parse.
+        """
+        if step_record is None:
+            step_record = {}
+
+        content_parts = []
+        tool_calls: Dict[int, dict] = {} # index -> {"id", "name", "arguments", "done"}
+        first_token_time = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    self._record_usage(step_record, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if first_token_time is None and (delta.content or delta.tool_calls):
+                    first_token_time = time.perf_counter()
+                    step_record["llm_first_token"] = first_token_time - start_time
+                    logger.info("LLM first token after {:.3f}s".format(step_record["llm_first_token"]))
+
+                if delta.content:
+                    if not content_parts:
+                        conversation.output('\nAnswer: ')
+                    conversation.output(delta.content)
+                    content_parts.append(delta.content)
+
+                for tool_call_delta in delta.tool_calls or []:
+                    index = tool_call_delta.index if tool_call_delta.index is not None else len(tool_calls)
+                    tool_call = tool_calls.setdefault(index, {"id": "", "name": "", "arguments": "", "done": False})
+                    if tool_call_delta.id:
+                        tool_call["id"] = tool_call_delta.id
+                    if tool_call_delta.function:
+                        if tool_call_delta.function.name:
+                            tool_call["name"] = tool_call_delta.function.name
+                        if tool_call_delta.function.arguments:
+                            tool_call["arguments"] += tool_call_delta.function.arguments
+                    self._check_streamed_tool_call(index, tool_call, on_tool_call)
+        finally:
+            # a stream left early (cancelled query, error) releases its connection and the request's permit
+            await close_stream(stream)
+        if content_parts:
+            conversation.output('\n')
+        step_record["llm_latency"] = time.perf_counter() - start_time
+        logger.info("LLM call took {:.3f}s".format(step_record["llm_latency"]))
+
+        # arguments that never parsed (or empty arguments) are handed over once the stream ends
+        for index, tool_call in sorted(tool_calls.items()):
+            if not tool_call["arguments"]:
+                tool_call["arguments"] = "{}"
+            self._check_streamed_tool_call(index, tool_call, on_tool_call)
+        return ChatCompletionMessage(
+            role="assistant",
+            content="".join(content_parts) or None,
+            tool_calls=[ChatCompletionMessageToolCall(
+                id=tool_call["id"],
+                type="function",
+                function=Function(name=tool_call["name"], arguments=tool_call["arguments"]),
+            ) for _, tool_call in sorted(tool_calls.items())] or None,
         )
 
-        return response.choices[0].message
+    def _check_streamed_tool_call(
+        self, index: int, tool_call: dict, on_tool_call: Optional[Callable[[int, ChatCompletionMessageToolCall], None]]
+    ):
+        """Hand a streamed tool call to on_tool_call once, when its arguments are a complete JSON object"""
+        if tool_call["done"] or not tool_call["name"]:
+            return
+        try:
+            if not isinstance(json.loads(tool_call["arguments"]), dict):
+                return
+        except json.JSONDecodeError:
+            return
+        tool_call["done"] = True
+        logger.info(f"Streamed tool call [{tool_call['name']}] is complete")
+        if on_tool_call is not None:
+            on_tool_call(index, ChatCompletionMessageToolCall(
+                id=tool_call["id"],
+                type="function",
+                function=Function(name=tool_call["name"], arguments=tool_call["arguments"]),
+            ))
+
+    async def process_query(self, query: str, conversation: Optional[Conversation] = None) -> dict:
+        """
+        Process a query using OpenAI and available tools
+
+        Args:
+            query: the user's query
+            conversation: defaults to the chat loop's conversation
 
-    async def process_query(self, query: str) -> None:
-        """Process a query using OpenAI and available tools"""
+        Returns:
+            summary of the turn: answer, latency, steps, tool_calls, prompt_tokens, completion_tokens, stop_reason,
+            tool_tokens_saved (by compaction of its tool results)
+        """
+        conversation = conversation or self.conversation
         logger.info("Processing a  query...")
+        conversation.query_count += 1
+        conversation.all_tools = False
         
-        self.messages += [{
+        conversation.dialogue.append({
             "role": "user",
             "content": query
-        }]
+        })
 
-        await self.send_messages()
-    
-    def log_all_messages(self):
-        """Show all messages in the conversation"""
-        logger.info("All messages in the conversation:")
-        formatted_messages = ''
-        for message in self.messages:
-            for key, value in message.items():
-                formatted_messages += f"{key}: {value}\n"
-            formatted_messages += "\n"
-        logger.info("Formatted messages: \n{}".format(formatted_messages))
+        start_time = time.perf_counter()
+        list_tools_calls = self._list_tools_calls
+        with self.tracer.span("query", model=self.model_name, conversation=conversation.id, query=conversation.query_count) as span:
+            summary = await self.agent_loop(conversation)
+            span.set(journal_ms=conversation.journal_time * 1000, list_tools_calls=self._list_tools_calls - list_tools_calls,
+                     **{key: summary[key] for key in ("steps", "tool_calls", "prompt_tokens", "cached_tokens", "completion_tokens", "stop_reason")})
+        summary["latency"] = time.perf_counter() - start_time
+        summary["tool_tokens_saved"] = conversation.tool_tokens_saved
+        summary["answer"] = next((message.get("content") for message in reversed(conversation.dialogue.messages)
+                                  if message["role"] == "assistant" and message.get("content")), None)
+        logger.info("Turn finished in {:.3f}s, list_tools round trips: {}, transcript logging: {:.2f}ms for {} messages".format(
+            summary["latency"], self._list_tools_calls - list_tools_calls,
+            conversation.journal_time * 1000, conversation.journal_count))
+        logger.info("Tool cache: {}".format(self.tool_cache.stats()))
+        if conversation.tool_tokens_saved:
+            logger.info(f"Tool output compaction saved ~{conversation.tool_tokens_saved} tokens per later request")
+        logger.info("Prompt cache: turn {}/{} tokens cached, session {}".format(
+            summary["cached_tokens"], summary["prompt_tokens"], format_cache_usage(self.usage)))
+        conversation.journal_time, conversation.journal_count = 0.0, 0
+        conversation.tool_tokens_saved = 0
+        return summary
+
+    async def agent_loop(self, conversation: Conversation) -> dict:
+        """
+        Send messages to the model and run the tools it asks for, step after step, until it answers without tool calls.
+        Stops early at HOST.MAX_AGENT_STEPS steps, HOST.QUERY_TIMEOUT seconds (in-flight tool calls are cancelled)
+        or HOST.QUERY_TOKEN_LIMIT tokens.
+
+        Returns:
+            totals of the steps: steps, tool_calls, prompt_tokens, cached_tokens, completion_tokens,
+            llm_latency, queue_wait (time spent waiting for the rate limits), speculation_saved (tool time overlapped with
+            the streamed response), approval_wait (time the user took to confirm tool calls, not part of the time limit),
+            stop_reason (None if the model answered)
+        """
+        summary = {"steps": 0, "tool_calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                   "llm_latency": 0.0, "queue_wait": 0.0, "speculation_saved": 0.0, "approval_wait": 0.0, "stop_reason": None}
+        try:
+            async with asyncio.timeout(self.cfg.HOST.QUERY_TIMEOUT) as conversation.query_timeout:
+                for step in range(1, self.cfg.HOST.MAX_AGENT_STEPS + 1):
+                    with self.tracer.span("agent_step", conversation=conversation.id, step=step) as span:
+                        step_record = await self.send_messages(conversation)
+                        span.set(tool_calls=step_record["tool_calls"], tool_latency=step_record["tool_latency"])
+                    step_record.update(session=self.session_id, conversation=conversation.id, query=conversation.query_count, step=step)
+                    self.record_step(step_record)
+                    add_usage(self.usage, step_record)
+                    add_usage(conversation.usage, step_record)
+                    for key in ("tool_calls", "prompt_tokens", "cached_tokens", "completion_tokens", "llm_latency", "queue_wait",
+                                "speculation_saved", "approval_wait"):
+                        summary[key] += step_record[key]
+                    summary["steps"] = step
+                    if not step_record["tool_calls"]:
+                        return summary
+                    used_tokens = summary["prompt_tokens"] + summary["completion_tokens"]
+                    if used_tokens >= self.cfg.HOST.QUERY_TOKEN_LIMIT:
+                        summary["stop_reason"] = f"token limit reached ({used_tokens} tokens)"
+                        break
+                else:
+                    summary["stop_reason"] = f"step limit reached ({self.cfg.HOST.MAX_AGENT_STEPS} steps)"
+        except TimeoutError:
+            # only the query's own limit, any other timeout is an error of the query
+            if conversation.query_timeout is None or not conversation.query_timeout.expired():
+                raise
+            summary["stop_reason"] = f"time limit reached ({self.cfg.HOST.QUERY_TIMEOUT}s)"
+        finally:
+            conversation.query_timeout = None
+
+        logger.warning(f"Agent loop stopped: {summary['stop_reason']}")
+        conversation.output(f"\n[Stopped: {summary['stop_reason']}]\n")
+        conversation.dialogue.append({
+            "role": "assistant",
+            "content": f"[Stopped: {summary['stop_reason']}]"
+        })
+        return summary
+
+    def record_step(self, step_record: dict):
+        """Log one agent step and append it to HOST.STEP_LOG_FILE for aggregation across sessions"""
+        logger.info("Step {step}: llm {llm_latency:.3f}s (queued {queue_wait:.3f}s, {retries} retries), "
+                    "tools {tool_latency:.3f}s ({tool_calls} calls, approval {approval_wait:.3f}s), "
+                    "tokens {prompt_tokens}+{completion_tokens} ({cached_tokens} cached)".format(**step_record))
+        if self.cfg.HOST.STEP_LOG_FILE:
+            # only queued here, a background thread of the step sink writes it (see setup_logging)
+            step_logger.info(json.dumps({"time": time.time(), "model": self.model_name, **step_record}))
     
-    def user_confirm_tool_call(self, tool_name: str, tool_args: dict) -> bool:
-        print(f"\n[Calling tool {tool_name} with args {tool_args}]")
-        if not self.cfg.HOST.NEED_USER_CONFIRM:
-            return True
-        # Ask user for confirmation
-        cmd = input("Do you want to call this tool? ('n' to cancel, any other key to continue): ").strip().lower()
-        if cmd == 'n':
-            print(f"Skipping tool call [{tool_name}]")
+    def needs_confirmation(self, tool_name: str, conversation: Conversation) -> bool:
+        """Whether a call of the tool would be asked about, i.e. must not start before confirm_tool_calls"""
+        if not self.cfg.HOST.NEED_USER_CONFIRM or not conversation.interactive or tool_name in HOST_TOOL_NAMES:
             return False
-        return True
+        route = self.tool_routes.get(tool_name)
+        if route is None:
+            return not self.approvals.is_allowed((tool_name,), None)
+        return not self.approvals.is_allowed((tool_name, route[1]), route[0])
+
+    async def confirm_tool_calls(self, calls: List[Tuple[str, dict]], conversation: Conversation) -> Tuple[List[bool], float]:
+        """
+        Show the tool calls of a step and, with HOST.NEED_USER_CONFIRM in an interactive conversation, ask the user once
+        about those without a standing approval. The host's own tools (HOST_TOOL_NAMES) are never asked about.
+        The event loop keeps running meanwhile, the query's time limit is paused.
+
+        Args:
+            calls: (tool name, arguments) of each call
+
+        Returns:
+            whether each call is approved, and the seconds spent waiting for the user
+        """
+        for tool_name, tool_args in calls:
+            conversation.output(f"\n[Calling tool {tool_name} with args {tool_args}]\n")
+        approved = [True] * len(calls)
+        pending = [i for i, (tool_name, _) in enumerate(calls) if tool_name not in HOST_TOOL_NAMES]
+        if not self.cfg.HOST.NEED_USER_CONFIRM or not conversation.interactive or not pending:
+            return approved, 0.0
+        routes = {i: self.tool_routes.get(calls[i][0]) for i in pending}
+        timeout = conversation.query_timeout
+        deadline = timeout.when() if timeout is not None else None
+        if deadline is not None:
+            timeout.reschedule(None)
+        start_time = time.perf_counter()
+        try:
+            answers, wait = await self.approvals.confirm([
+                ((calls[i][0], routes[i][1]), routes[i][0]) if routes[i] is not None else ((calls[i][0],), None)
+                for i in pending
+            ])
+        finally:
+            if deadline is not None:
+                timeout.reschedule(deadline + time.perf_counter() - start_time)
+        for i, ok in zip(pending, answers):
+            approved[i] = ok
+        for (tool_name, _), ok in zip(calls, approved):
+            if not ok:
+                conversation.output(f"Skipping tool call [{tool_name}]\n")
+        if wait:
+            self.tracer.metrics.observe("mcp_host_tool_approval_wait_seconds", wait,
+                                        "Time the user took to confirm the tool calls of a step")
+            logger.info(f"User confirmed {sum(approved)}/{len(calls)} tool calls after {wait:.3f}s")
+        return approved, wait
     
-    async def send_messages(self) -> None:
-        """Send messages to the server and get a response"""
+    async def execute_tool_call(self, tool_name: str, tool_args: dict, conversation: Optional[Conversation] = None,
+                                speculative: bool = False) -> str:
+        """
+        Call a tool on the server that offers it, at most HOST.MAX_INFLIGHT_PER_SERVER calls run on one server at a time
+
+        Args:
+            tool_name: name of the tool as exposed to the model
+            tool_args: arguments of the call
+            conversation: the result is shown in its output, defaults to the chat loop's conversation
+            speculative: started before the model's response is complete, the result is shown only once it is used
+
+        Returns:
+            text of the tool result, or an error message if the call failed
+        """
+        conversation = conversation or self.conversation
+        if tool_name == ALL_TOOLS_TOOL["function"]["name"]:
+            conversation.all_tools = True
+            logger.info("Model asked for all tools")
+            return f"All {len(self.tools)} tools are offered from the next step on."
+        if tool_name == READ_BLOB_TOOL["function"]["name"] and self.blob_store is not None:
+            try:
+                offset, length = int(tool_args.get("offset", 0)), int(tool_args.get("length", self.cfg.BLOBS.INLINE_MAX_CHARS))
+                # only blobs of this conversation's own tool results, not those of other conversations (or tenants)
+                result_txt = self.blob_store.read_text(str(tool_args.get("blob", "")), offset, length, allowed=conversation.blobs)
+            except (TypeError, ValueError):
+                result_txt = "Error: offset and length must be integers"
+            conversation.output(f'[Tool result]: {result_txt}\n')
+            return result_txt
+        if tool_name not in self.tool_routes:
+            logger.error(f"No server offers tool [{tool_name}]")
+            return f"Error: tool [{tool_name}] is not available"
+        server_name, server_tool_name = self.tool_routes[tool_name]
+        conversation.used_tools.add(tool_name)
+        if server_name not in self._server_semaphores:
+            self._server_semaphores[server_name] = asyncio.Semaphore(self.cfg.HOST.MAX_INFLIGHT_PER_SERVER)
+
+        async def call_tool() -> types.CallToolResult:
+            status = self.server_status.get(self._server_path(server_name))
+            if status is not None:
+                status.inflight += 1
+            try:
+                session = await self.get_session(server_name) # after the cache lookup, so cached results never start a server
+                async with self._server_semaphores[server_name]:
+                    with self.tracer.span("call_tool", server=server_name, tool=server_tool_name) as span:
+                        result = await session.call_tool(server_tool_name, tool_args)
+                        if result.isError:
+                            span.status = "error"
+                        return result
+            finally:
+                if status is not None:
+                    status.inflight -= 1
+                    status.last_used = time.monotonic()
+
+        start_time = time.perf_counter()
+        ttl = self._tool_cache_ttls.get((server_name, server_tool_name), 0)
+        # the span includes cache lookups and waiting for a slot of the server, call_tool spans only the call itself
+        with self.tracer.span("tool_call", server=server_name, tool=server_tool_name, cacheable=ttl > 0, speculative=speculative) as span:
+            try:
+                if ttl > 0:
+                    tool_call_result = await self.tool_cache.get_or_call(
+                        ToolResultCache.make_key(server_name, server_tool_name, tool_args),
+                        ttl,
+                        call_tool,
+                        cache_if=lambda result: not result.isError,
+                    )
+                else:
+                    tool_call_result = await call_tool()
+                tokens_saved = 0
+                def compact(content, text: str) -> Tuple[str, bool]:
+                    nonlocal tokens_saved
+                    compacted, lossy = self.compactor.compact(content, self.compactor.rule(server_tool_name, tool_name))
+                    tokens_saved += self.compactor.record(server_tool_name, self.compactor.uncompacted(content, text), compacted, lossy)
+                    return compacted, lossy
+                result_txt, handles = render_tool_content(tool_call_result.content, self.blob_store,
+                                                          self.cfg.BLOBS.INLINE_MAX_CHARS, self.cfg.BLOBS.PREVIEW_CHARS,
+                                                          compact if self.compactor is not None else None,
+                                                          tool_call_result.structuredContent)
+                if tokens_saved:
+                    conversation.tool_tokens_saved += tokens_saved
+                    span.set(tokens_saved=tokens_saved)
+                    self.tracer.metrics.inc("mcp_host_tool_output_tokens_saved_total", tokens_saved,
+                                            "Tokens removed from tool results by compaction before they entered the dialogue",
+                                            tool=server_tool_name)
+                if handles:
+                    conversation.blobs.update(handles)
+                    # from now on the conversation is offered read_blob even when tools are selected
+                    conversation.used_tools.add(READ_BLOB_TOOL["function"]["name"])
+                    span.set(blobs=len(handles))
+                if tool_call_result.isError:
+                    span.status = "error"
+            except Exception as e:
+                logger.error(f"calling tool [{tool_name}] on server [{server_name}] failed: {e}")
+                result_txt = f"Error: {e}"
+                span.status = "error"
+                span.set(error=str(e))
+        if not speculative:
+            conversation.output(f'[Tool result]: {result_txt}\n')
+        logger.info("calling tool [{}] on server [{}] with args [{}], got result:[{}] in {:.3f}s".format(
+            tool_name, server_name, tool_args, result_txt, time.perf_counter() - start_time))
+        return result_txt
+
+    async def send_messages(self, conversation: Conversation) -> dict:
+        """
+        Send messages of a conversation to the model, run the tool calls in its response and add everything to its dialogue.
+        This is one step of the agent loop.
+
+        Returns:
+            step record with llm_latency, tool_latency, prompt_tokens, completion_tokens, tool_calls (count),
+            approval_wait (seconds the user took to confirm the calls, not part of tool_latency)
+            and the speculative calls: speculative_calls (used), speculative_discarded, speculation_saved (seconds)
+        """
         logger.info("Sending messages to the model...")
+        step_record = {"tool_latency": 0.0, "tool_calls": 0, "approval_wait": 0.0,
+                       "speculative_calls": 0, "speculative_discarded": 0, "speculation_saved": 0.0}
+
+        # Read-only tools of HOST.SPECULATIVE_TOOLS start as soon as their streamed arguments are complete and valid,
+        # the others once the response is complete (and confirmed). A speculative call is used only if the final response has
+        # the same call.
+        speculations: Dict[int, dict] = {} # index of tool call -> {"name", "args", "task", "started", "finished"}
+        def speculate(index: int, tool_call: ChatCompletionMessageToolCall):
+            tool_name = tool_call.function.name
+            validator = self._speculative_validators.get(tool_name)
+            # a call the user is still to confirm does not run before the answer, not even speculatively
+            if validator is None or self.needs_confirmation(tool_name, conversation):
+                return
+            tool_args = json.loads(tool_call.function.arguments)
+            if not validator.is_valid(tool_args):
+                logger.info(f"Streamed arguments of [{tool_name}] do not match its inputSchema, not run speculatively")
+                return
+            speculation = {"name": tool_name, "args": tool_args, "started": time.perf_counter(), "finished": None}
+            speculation["task"] = asyncio.create_task(self.execute_tool_call(tool_name, tool_args, conversation, speculative=True))
+            speculation["task"].add_done_callback(lambda _: speculation.update(finished=time.perf_counter()))
+            speculations[index] = speculation
+            logger.info(f"Speculatively calling [{tool_name}] while the response is streamed")
 
-        assistant_message = await self.get_response_message()
-        if assistant_message.content: 
-            print('\nAnswer:',assistant_message.content)
+        async def adopt(speculation: dict) -> str:
+            result_txt = await speculation["task"]
+            conversation.output(f'[Tool result]: {result_txt}\n')
+            return result_txt
+
+        def discard(index: int):
+            speculation = speculations.pop(index)
+            speculation["task"].cancel()
+            step_record["speculative_discarded"] += 1
+            self.tracer.metrics.inc("mcp_host_speculative_tool_calls_total", 1,
+                                    "Tool calls started before the response was complete, by whether the result was used",
+                                    tool=speculation["name"], outcome="discarded")
+
+        tool_tasks: Dict[int, Optional[asyncio.Task]] = {} # index of tool call -> task, None if the user refused
+        tool_start_time = None
+        response_time = None
+        def start_tool_call(index: int, tool_name: str, tool_args: dict, approved: bool):
+            nonlocal tool_start_time
+            speculation = speculations.get(index)
+            if not approved:
+                if speculation is not None:
+                    discard(index)
+                tool_tasks[index] = None
+                return
+            if speculation is not None:
+                # the time the call ran while the response was still streamed
+                step_record["speculative_calls"] += 1
+                step_record["speculation_saved"] += min(speculation["finished"] or response_time, response_time) - speculation["started"]
+                self.tracer.metrics.inc("mcp_host_speculative_tool_calls_total", 1,
+                                        "Tool calls started before the response was complete, by whether the result was used",
+                                        tool=tool_name, outcome="used")
+                tool_start_time = min(tool_start_time or speculation["started"], speculation["started"])
+                tool_tasks[index] = asyncio.create_task(adopt(speculation))
+                return
+            tool_start_time = tool_start_time or time.perf_counter()
+            tool_tasks[index] = asyncio.create_task(self.execute_tool_call(tool_name, tool_args, conversation))
+
+        try:
+            assistant_message = await self.get_response_message(conversation, on_tool_call=speculate, step_record=step_record)
+            response_time = time.perf_counter()
+        except BaseException:
+            for speculation in speculations.values():
+                speculation["task"].cancel()
+            raise
+        if assistant_message.content and not self.cfg.MODEL.STREAM: 
+            conversation.output(f'\nAnswer: {assistant_message.content}\n')
 
         if not assistant_message.tool_calls:
             logger.info("No tool calls found in the response.")
-            self.messages.append({
+            for index in list(speculations):
+                discard(index)
+            conversation.dialogue.append({
                 "role": "assistant",
                 "content": assistant_message.content
             })
 
         else:
             logger.info("Assistant call tools:{}".format([tool_call.function.name for tool_call in assistant_message.tool_calls]))
-            # Handle each tool call
-            for tool_call in assistant_message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-                
-                # Find the session that has the tool
-                for session in self.sessions:
-                    response = await session.list_tools()
-                    if any(tool.name == tool_name for tool in response.tools):
-                        # user check
-                        if not self.user_confirm_tool_call(tool_name, tool_args):
-                            continue
-
-                        # Execute tool call
-                        tool_call_result = await session.call_tool(tool_name, tool_args)
-                        result_txt = tool_call_result.content[0].text
-                        print(f'[Tool result]: {result_txt}')
-
-                        logger.info(f"calling tool [{tool_name}] with args [{tool_args}], got result:[{result_txt}]")
-
-                        # Add tool call and result to messages
-                        self.messages.append({
-                            "role": "assistant",
-                            "tool_calls": [{
-                                "id": tool_call.id,
-                                "type": "function",
-                                "function": {
-                                    "name": tool_name,
-                                    "arguments": json.dumps(tool_args)
-                                }
-                            }]
-                        })
-                        self.messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": result_txt
-                        })
-            
-            await self.send_messages()
+            calls = [(tool_call.function.name, json.loads(tool_call.function.arguments)) for tool_call in assistant_message.tool_calls]
+            for index, speculation in list(speculations.items()):
+                if index >= len(calls) or (speculation["name"], speculation["args"]) != calls[index]:
+                    logger.info(f"Speculative call of [{speculation['name']}] does not match the final response, discarded")
+                    discard(index)
+            # speculative calls keep running while the user decides
+            try:
+                approved, step_record["approval_wait"] = await self.confirm_tool_calls(calls, conversation)
+            except BaseException:
+                for speculation in speculations.values():
+                    speculation["task"].cancel()
+                raise
+            approved_time = time.perf_counter()
+            for index, (tool_name, tool_args) in enumerate(calls):
+                start_tool_call(index, tool_name, tool_args, approved[index])
+            accepted_calls = sum(1 for task in tool_tasks.values() if task is not None)
+            if speculations:
+                logger.info("Speculative tool calls: {} used, {} discarded, {:.3f}s saved".format(
+                    step_record["speculative_calls"], step_record["speculative_discarded"], step_record["speculation_saved"]))
+
+            # Tool calls run concurrently, results come back in the model's order
+            # (if the agent loop times out here, gather cancels the calls still running)
+            start_time = time.perf_counter()
+            results = await asyncio.gather(*[
+                tool_tasks[index] for index in range(len(assistant_message.tool_calls)) if tool_tasks[index] is not None
+            ])
+            logger.info("Executed {} tool calls, waited {:.3f}s after the response".format(accepted_calls, time.perf_counter() - start_time))
+            step_record["tool_calls"] = accepted_calls
+            if tool_start_time is not None:
+                step_record["tool_latency"] = time.perf_counter() - tool_start_time
+                if tool_start_time < approved_time:
+                    # speculative calls started before the approval, the wait is counted apart
+                    step_record["tool_latency"] = max(0.0, step_record["tool_latency"] - step_record["approval_wait"])
+
+            # Add tool calls and results to messages, refused calls get a result saying so
+            results = iter(results)
+            conversation.dialogue.append({
+                "role": "assistant",
+                "content": assistant_message.content,
+                "tool_calls": [{
+                    "id": tool_call.id,
+                    "type": "function",
+                    "function": {
+                        "name": tool_name,
+                        "arguments": json.dumps(tool_args)
+                    }
+                } for tool_call, (tool_name, tool_args) in zip(assistant_message.tool_calls, calls)]
+            })
+            for index, tool_call in enumerate(assistant_message.tool_calls):
+                conversation.dialogue.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": next(results) if tool_tasks[index] is not None else REFUSED_TOOL_RESULT
+                })
+        return step_record
 
     def self_check(self):
         """Check if everything is ok"""
-        if len(self.messages) > self.cfg.HOST.MAX_MASSAGE_TURNS:
-            logger.warning("Message length exceeds the limit. Cleaning up...")
+        if self.dialogue.total_tokens + self._tools_tokens > self.token_budget:
+            logger.warning("Dialogue exceeds the token budget. Cleaning up...")
             self.clean_dialogue(command="touch_max")
 
     async def chat_loop(self):
@@ -302,6 +1532,7 @@ class MyMCPClient:
         Commands:
           - 'quit': Exit the program
           - 'restart': Restart the dialogue and clean up memory
+          - 'stats': Show tool and prompt cache statistics, server and LLM provider health, cassette hits
           - 'help': Show help message
         """
         help_text = textwrap.dedent(help_text)
@@ -311,45 +1542,119 @@ class MyMCPClient:
         
         while True:
             self.self_check()
-            self.log_all_messages()
             try:
-                query = input("\nQuery: ").strip()
+                # read input in a thread, so servers that are still starting can finish meanwhile
+                query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
                 if query.lower() == 'quit':
                     break
                 if query.lower() == 'restart':
                     print("Restarting dialogue...")
                     self.clean_dialogue(command="user_restart")
                     continue
+                if query.lower() == 'stats':
+                    print(f"Tool cache: {self.tool_cache.stats()}")
+                    print(f"Prompt cache: {format_cache_usage(self.usage)}")
+                    if self.cassette is not None:
+                        print(f"Cassette: {self.cassette.stats()}")
+                    if self.blob_store is not None:
+                        print(f"Blobs: {self.blob_store.stats()}")
+                    if self.compactor is not None:
+                        print(f"Tool output compaction: {self.compactor.stats()}")
+                    if self.cfg.HOST.NEED_USER_CONFIRM:
+                        print(f"Tool approvals: {self.approvals.stats()}")
+                    for route, route_stats in self.router.summary().items():
+                        print(f"LLM [{route}]: {route_stats}")
+                    for mark, limit_stats in self.rate_limit_stats().items():
+                        print(f"LLM limits [{mark}]: {limit_stats}")
+                    for server_name, server_stats in self.server_stats().items():
+                        print(f"Server [{server_name}]: {server_stats}")
+                    continue
                 if query.lower() == 'help':
                     print(help_text)
+                    print(f"Available tools: { [tool['function']['name'] for tool in self.tools] } ")
                     continue
                 await self.process_query(query)
             except Exception as e:
+                # servers are supervised on their own, a failed query does not tear them down
+                logger.exception(f"Query failed: {e}")
                 print(f"\nError: {str(e)}")
-                await self.cleanup()
         
         print("\nExited.")
     
     def clean_dialogue(self, command: str):
         """Clean up memory and restart dialogue"""
         if command == "user_restart":
-            self.messages = self.init_messages.copy()
+            self.dialogue.reset()
+            self.conversation.used_tools.clear()
+            self.conversation.offered_tools.clear()
             logger.info("Memory cleaned.")
         if command == "touch_max":
-            self.messages = self.messages[-self.cfg.HOST.MAX_MASSAGE_TURNS:]
+            self.fit_context(self.conversation)
             logger.info("Memory touch max, auto clean.")
 
+def setup_logging(cfg):
+    """
+    Send logs to HOST.LOG_FILE (or the console), the message transcript to HOST.TRANSCRIPT_FILE, step records to
+    HOST.STEP_LOG_FILE and spans to TRACING.FILE.
+    File sinks are enqueued, so the event loop only queues records and a background thread writes them.
+    """
+    logger.remove()
+    def not_transcript(record):
+        return not any(key in record["extra"] for key in ("transcript", "trace", "steps"))
+    if cfg.HOST.LOG_FILE:
+        logger.add(cfg.HOST.LOG_FILE, rotation="1 MB", retention="7 days", level="DEBUG", enqueue=True, filter=not_transcript)
+    else:
+        logger.add(sys.stderr, level="DEBUG", filter=not_transcript)
+    if cfg.HOST.TRANSCRIPT_FILE:
+        logger.add(cfg.HOST.TRANSCRIPT_FILE, format="{message}", rotation="10 MB", level="INFO", enqueue=True,
+                   filter=lambda record: "transcript" in record["extra"])
+    if cfg.HOST.STEP_LOG_FILE:
+        logger.add(cfg.HOST.STEP_LOG_FILE, format="{message}", level="INFO", enqueue=True,
+                   filter=lambda record: "steps" in record["extra"])
+    if cfg.TRACING.FILE:
+        logger.add(cfg.TRACING.FILE, format="{message}", rotation="10 MB", level="INFO", enqueue=True,
+                   filter=lambda record: "trace" in record["extra"])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MCP host, chats interactively unless --batch or --serve is given")
+    parser.add_argument("--batch", metavar="QUERIES", help="JSONL file of queries to run without interaction")
+    parser.add_argument("--output", help="JSONL file for the batch results (default BATCH.OUTPUT_FILE)")
+    parser.add_argument("--concurrency", type=int, help="queries processed at the same time (default BATCH.CONCURRENCY)")
+    parser.add_argument("--serve", action="store_true", help="serve conversations over HTTP/WebSocket")
+    parser.add_argument("--port", type=int, help="port of the server (default SERVE.PORT)")
+    return parser.parse_args()
+
 async def main():
+    args = parse_args()
     cfg = get_cfg_defaults()
-    if cfg.HOST.LOG_FILE:
-        logger.remove() # 移除控制台输出
-        logger.add(cfg.HOST.LOG_FILE, rotation="1 MB", retention="7 days", level="DEBUG")
+    setup_logging(cfg)
     client = MyMCPClient(cfg)
+    metrics_task = None
+    if cfg.TRACING.METRICS_PORT and not args.serve:
+        metrics_task = asyncio.create_task(serve_metrics(client.tracer, cfg.SERVE.HOST, cfg.TRACING.METRICS_PORT))
     try:
-        await client.connect_to_servers()
-        await client.chat_loop()
+        if args.batch:
+            queries = batch.load_queries(args.batch)
+            await client.connect_to_servers(wait_all=True)
+            summary = await batch.run_batch(
+                client, queries,
+                output_file=args.output or cfg.BATCH.OUTPUT_FILE,
+                concurrency=args.concurrency or cfg.BATCH.CONCURRENCY,
+            )
+            batch.print_summary(summary)
+        elif args.serve:
+            # imported here so the interactive and batch modes do not need the web server packages
+            from serve import ConversationServer
+            await client.connect_to_servers(wait_all=True)
+            await ConversationServer(client, cfg).serve(cfg.SERVE.HOST, args.port or cfg.SERVE.PORT)
+        else:
+            await client.connect_to_servers()
+            await client.chat_loop()
     finally:
+        if metrics_task is not None:
+            metrics_task.cancel()
         await client.cleanup()
+        await logger.complete()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具清单缓存：保存每个stdio server的名字和工具列表（name、description、inputSchema等），
+并记录server脚本的指纹（修改时间、大小和内容哈希）。下次启动时若指纹未变，host直接用缓存的工具列表，
+server进程推迟到它的工具第一次被调用时才启动。
+'''
+
+import os
+import json
+import hashlib
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from mcp import types
+
+
+def script_fingerprint(script_path: str) -> Optional[dict]:
+    """Fingerprint of a server script: its mtime, size and content hash, None if it cannot be read"""
+    try:
+        stat = os.stat(script_path)
+        with open(script_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest}
+
+
+def fingerprint_matches(cached: Optional[dict], current: Optional[dict]) -> bool:
+    """Same mtime and size, or same content (a touched or re-checked-out but unchanged script still matches)"""
+    if not cached or not current:
+        return False
+    return (cached["mtime_ns"], cached["size"]) == (current["mtime_ns"], current["size"]) or cached["sha256"] == current["sha256"]
+
+
+class ToolManifestCache:
+    def __init__(self, path: str):
+        """
+        Args:
+            path: JSON file holding the manifests, keyed by server script path
+        """
+        self.path = path
+        self._manifests = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._manifests = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable tool manifest cache {path}: {e}")
+
+    def load(self, script_path: str) -> Optional[Tuple[str, List[types.Tool]]]:
+        """Cached (server name, tools) of a script, None if it was never cached or the script changed since"""
+        manifest = self._manifests.get(script_path)
+        if manifest is None:
+            return None
+        if not fingerprint_matches(manifest.get("fingerprint"), script_fingerprint(script_path)):
+            logger.info(f"Tool manifest of {script_path} is outdated")
+            return None
+        return manifest["server_name"], [types.Tool.model_validate(tool) for tool in manifest["tools"]]
+
+    def store(self, script_path: str, server_name: str, tools: List[types.Tool]):
+        """Save the manifest of a connected server, the file is only rewritten when something changed"""
+        manifest = {
+            "fingerprint": script_fingerprint(script_path),
+            "server_name": server_name,
+            "tools": [tool.model_dump(mode="json", exclude_none=True) for tool in tools],
+        }
+        if not self.path or self._manifests.get(script_path) == manifest:
+            return
+        self._manifests[script_path] = manifest
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifests, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
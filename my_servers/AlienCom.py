@@ -112,6 +112,26 @@ def summon_alien(signal: str):
         logger.error(f"召唤外星人失败: {e}")
         return "外星人召唤失败！"
 
+@mcp.tool()
+def record_transmission(signal: str, lines: int = 200) -> str:
+    """
+    录下外星人回应信号发来的一段通讯记录（内容较长，可用来演示大段文本的工具结果）。
+
+    Args:
+        signal (str): 发送给外星人的信号。
+        lines (int): 记录的行数。
+
+    Returns:
+        str: 通讯记录，每行一个带序号的频率读数。
+    """
+    logger.info(f"录制外星人通讯: {signal}, {lines} 行")
+    seed = int.from_bytes(hashlib.md5(signal.encode('utf-8')).digest()[:4], byteorder='big')
+    records = []
+    for i in range(max(1, min(lines, 5000))):
+        seed = (seed * 1103515245 + 12345) % 2**31
+        records.append(f"#{i:04d} freq={1420 + seed % 1000 / 100:.2f}MHz amplitude={seed % 97:02d} pattern={seed:08x}")
+    return "\n".join(records)
+
 # 创建Starlette应用
 def create_starlette_app(mcp_server: Server) -> Starlette:
     sse = SseServerTransport("/messages/")
@@ -136,8 +156,11 @@ def create_starlette_app(mcp_server: Server) -> Starlette:
     )
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AlienCom MCP server (SSE)")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
     HOST = "0.0.0.0"
-    PORT = 8080
+    PORT = args.port
 
     mcp_server = mcp._mcp_server
     starlette_app = create_starlette_app(mcp_server)
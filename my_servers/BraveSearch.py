@@ -7,7 +7,8 @@ Brave Search是一个隐私保护的搜索引擎，提供API接口供开发者
   https://python.langchain.com/api_reference/community/tools/langchain_community.tools.brave_search.tool.BraveSearch.html
 
 '''
-import ast
+import json
+from typing import List, TypedDict
 from langchain_community.tools import BraveSearch
 
 import os
@@ -15,17 +16,31 @@ from dotenv import load_dotenv
 load_dotenv()
 BRAVE_API_KEY = os.getenv("BRAVE_API_KEY") 
 
-# from mcp.server.fastmcp import FastMCP
-from fastmcp import FastMCP
-mcp = FastMCP("web-search-server")
+# mcp自带的FastMCP支持结构化输出（outputSchema与structuredContent），fastmcp 2.6还不支持
+from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+from mcp.types import ToolAnnotations
+mcp = FastMCP("web-search-server", host="0.0.0.0", port=8888, streamable_http_path="/mcp")
 
-@mcp.tool()
+
+class SearchResult(TypedDict):
+    title: str
+    link: str
+    snippet: str
+
+
+class SearchResults(TypedDict):
+    query: str
+    results: List[SearchResult]
+
+
+@mcp.tool(annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
 def brave_search(query: str, 
                  country: str = "ALL",
                  search_lang: str = "en",
                  count: int = 3,
                  safesearch: str = "off",
-                ) -> str:
+                ) -> SearchResults:
     '''
     search queries through Brave Search API
 
@@ -37,22 +52,23 @@ def brave_search(query: str,
         safesearch: str, filters search results for adult content. Available value: "off", "moderate", "strict".
     
     return:
-        response: str, search result or error message. Search result is string of a list of dicts, each dict contains a web page result.
+        response: the query and a list of web page results, each with title, link and snippet.
+            Errors are returned as an error result.
     '''
     try:
-        response = search_query(
+        results = search_query(
             query, 
             country=country,
             search_lang=search_lang,
             count=count,
             safesearch=safesearch,
         )
-        return response
     except Exception as e:
-        return f"Error: {e}"
+        raise ToolError(f"Brave Search failed: {e}")
+    return {"query": query, "results": results}
 
 
-def search_query(query, country="ALL", search_lang="en", count=3, safesearch="off", show_results=True):
+def search_query(query, country="ALL", search_lang="en", count=3, safesearch="off", show_results=True) -> List[SearchResult]:
     params = {
         "country": country,
         "search_lang": search_lang,
@@ -64,39 +80,36 @@ def search_query(query, country="ALL", search_lang="en", count=3, safesearch="of
         search_kwargs=params,
     )
 
-    response = tool.run(query)
-    response = response.encode('utf-8').decode('unicode_escape') # transform unicode to utf-8
+    # langchain返回json.dumps的结果（非ASCII字符为\uXXXX转义），json.loads一次即可还原，
+    # 不再需要unicode_escape解码和ast.literal_eval（它们在结果含引号、反斜杠或emoji时会出错）
     '''
-    result format: string of a list of dicts
+    result format: JSON list of dicts
     each dict contains:
         title: str, title of the result
         link: str, link to the result
         snippet: str, snippet of the result
     '''
+    response = tool.run(query)
+    results = [
+        {"title": res.get("title", ""), "link": res.get("link", ""), "snippet": res.get("snippet", "")}
+        for res in json.loads(response)
+    ]
     
     if show_results:
         print("Brave Search Results:")
-        res_dicts = ast.literal_eval(response)
-        for i, res in enumerate(res_dicts):
+        for i, res in enumerate(results):
             print("-" * 80)
             print(f"Result {i+1}:")
             print(f"Title: {res['title']}")
             print(f"Link: {res['link']}")
             print(f"Snippet: {res['snippet']}")
             print("-" * 80)
-    return response
+    return results
 
 def test():
     res = search_query("奥巴马生平", count=3, show_results=True)
     print(res)
-    # zhres = res.encode().decode('unicode_escape')
-    # print(zhres)
 
 if __name__ == "__main__":
-    mcp.run(
-        transport="streamable-http",
-        host="0.0.0.0",
-        port=8888,
-        path="/mcp",
-    )
+    mcp.run(transport="streamable-http") # 0.0.0.0:8888/mcp, see FastMCP(...) above
     # test()
\ No newline at end of file
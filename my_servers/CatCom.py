@@ -1,8 +1,12 @@
+import zlib
+import struct
+import random
+import argparse
 import logging
 import hashlib
 
 import uvicorn
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import FastMCP, Image
 
 # 小猫字符画（纯ASCII，适合在终端打印）
 cats = [
@@ -47,6 +51,29 @@ def select_cat(signal: str) -> str:
     return cats[idx]
 
 
+def encode_png(width: int, height: int, rows: list) -> bytes:
+    """把RGB像素行（每行为width*3个字节）编码为PNG。"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\x00" + bytes(row) for row in rows)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def cat_photo(signal: str, width: int = 160, height: int = 120) -> bytes:
+    """根据 signal 生成一张确定的“小猫照片”（带噪点的毛色渐变），用来演示图片类型的工具结果。"""
+    rng = random.Random(hashlib.md5(signal.encode("utf-8")).digest())
+    fur = [rng.randrange(80, 220) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            shade = (x + y) * 60 // (width + height)
+            row.extend(max(0, min(255, channel + shade + rng.randrange(-24, 25))) for channel in fur)
+        rows.append(row)
+    return encode_png(width, height, rows)
+
+
 # 设置日志
 MCP_SERVER_NAME = "CatCom"
 logging.basicConfig(
@@ -81,9 +108,27 @@ def summon_cat(signal: str) -> str:
         return "小猫召唤失败！"
 
 
+@mcp.tool()
+def photograph_cat(signal: str):
+    """
+    给服务端的小猫拍一张照片。
+
+    Args:
+        signal (str): 任意提示内容，同样的内容得到同一只猫的照片。
+
+    Returns:
+        一段说明文字和一张PNG图片。
+    """
+    logger.info(f"收到给小猫拍照的信号: {signal}")
+    return ["小猫摆好了姿势，照片如下。", Image(data=cat_photo(signal), format="png")]
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CatCom MCP server (Streamable HTTP)")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
     HOST = "0.0.0.0"
-    PORT = 8081
+    PORT = args.port
 
     print(f"CatCom 启动，监听 {HOST}:{PORT}，使用 Streamable HTTP 连接方式")
     uvicorn.run(mcp.streamable_http_app, host=HOST, port=PORT)
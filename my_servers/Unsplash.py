@@ -8,6 +8,7 @@ from io import BytesIO
 
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
+from mcp.types import ToolAnnotations
 
 # 加载 .env 文件
 load_dotenv()  
@@ -84,7 +85,7 @@ def get_random_wallpaper() -> str:
     except Exception as e:
         return f"Error: {str(e)}"
 
-@mcp.tool()
+@mcp.tool(annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
 def get_filter_image_url(query: str = 'nature', color: str = 'blue', 
                   orientation: str = 'landscape', page: int = 1, 
                   per_page: int = 30, order_by: str = 'popular', get_index: int = 0) -> str:
@@ -1,24 +1,35 @@
+from typing import TypedDict
+
 from loguru import logger
 
-from fastmcp import FastMCP
+# mcp自带的FastMCP支持结构化输出：按返回值的类型注解生成outputSchema，结果同时以structuredContent返回
+from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+from mcp.types import ToolAnnotations
 
 from datetime import datetime
 import pytz
 
 mcp = FastMCP("time_mcp_server")
 
+
+class CurrentTime(TypedDict):
+    time: str # ISO 8601, with the UTC offset
+    timezone: str # name of the local timezone
+
+
 @mcp.tool()
-def get_current_time():
+def get_current_time() -> CurrentTime:
     """
-    get current time in ISO 8601 format
+    get current local time in ISO 8601 format
 
     Returns:
-        str: time string in ISO 8601 format
+        CurrentTime: time string in ISO 8601 format (with UTC offset) and the local timezone name
     """
-    current_time = datetime.now().isoformat()
-    return current_time
+    current_time = datetime.now().astimezone()
+    return {"time": current_time.isoformat(), "timezone": current_time.tzname() or ""}
 
-@mcp.tool()
+@mcp.tool(annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
 def transform_timezone(source_time: str, timezone: str) -> str:
     """
     transform the source time string to the target timezone
@@ -30,20 +41,23 @@ def transform_timezone(source_time: str, timezone: str) -> str:
 
     Returns:
         str: transformed time string in ISO 8601 format
+
+    Raises:
+        ToolError: invalid source time or unknown timezone, returned to the client as an error result
     """
     try:
         # 解析源时间字符串为 datetime 对象
         source_time_dt = datetime.fromisoformat(source_time)
     except ValueError:
         logger.error(f"Invalid source time format: {source_time}")
-        return "Invalid source time format"
+        raise ToolError(f"Invalid source time format: {source_time}")
 
     # 获取指定时区对象
     try:
         target_timezone = pytz.timezone(timezone)
     except pytz.UnknownTimeZoneError:
         logger.error(f"Unknown timezone: {timezone}")
-        return "Unknown timezone"
+        raise ToolError(f"Unknown timezone: {timezone}")
 
     # 转换为目标时区的时间
     target_time_dt = source_time_dt.astimezone(target_timezone)
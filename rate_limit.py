@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+'''
+模型请求的限流与重试（RATE_LIMIT），每个服务商（MODEL.MARK）一个：
+  - 令牌桶：每分钟请求数（RPM）和token数（TPM），发出请求前等到桶里有余量；
+  - 服务商的限流信息：429回应中的Retry-After，以及x-ratelimit-remaining/reset等响应头，余量用完时暂停到重置为止；
+  - 重试：429、5xx和连接错误按带随机抖动的指数退避重试，有Retry-After时至少等那么久；
+  - 并发：AIMD（加性增、乘性减）调整同时进行的请求数上限，成功时慢慢增加，被限流时减半，逐渐收敛到服务商的实际容量。
+排队等待（并发名额和令牌桶）的时间与模型本身的延迟分开统计。
+'''
+
+import re
+import time
+import random
+import asyncio
+import email.utils
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+
+import openai
+from loguru import logger
+
+T = TypeVar("T")
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds of a rate limit reset value such as "20ms", "1s", "6m0s" or a plain number of seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    """Seconds to wait according to retry-after-ms or retry-after (seconds or an HTTP date), None if absent"""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, openai.APIConnectionError): # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def is_throttled(error: BaseException) -> bool:
+    return isinstance(error, openai.APIStatusError) and error.status_code in (429, 503)
+
+
+class TokenBucket:
+    """Allows per_minute units per minute, in bursts of up to a minute's worth. Usage may overdraw it (a debt)."""
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount can be taken, requests larger than the capacity wait for a full bucket"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def limit_to(self, remaining: float):
+        """Follow the provider's own count of what is left"""
+        self._refill()
+        self.level = min(self.level, remaining)
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows by one per limit successes while it is used, and halves when the provider throttles"""
+    def __init__(self, initial: int, minimum: int, maximum: int, decrease_factor: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.inflight = 0
+        self.waiting = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """Wait for a slot, returns the time it was granted (for release)"""
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.inflight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+        return time.monotonic()
+
+    async def release(self, granted_at: float, outcome: str):
+        """
+        Args:
+            granted_at: returned by acquire
+            outcome: "success", "throttled" or anything else (no change of the limit)
+        """
+        async with self._condition:
+            self.inflight -= 1
+            if outcome == "success" and self.inflight + 1 >= self.limit / 2:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif outcome == "throttled" and granted_at > self._last_decrease:
+                # requests sent before the last decrease saw the old limit, they do not decrease it again
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._last_decrease = time.monotonic()
+                logger.warning(f"LLM concurrency limit decreased to {int(self.limit)}")
+            self._condition.notify_all()
+
+
+class Permit:
+    """A request slot granted by a ProviderLimiter, held until the response is consumed"""
+    def __init__(self, limiter: "ProviderLimiter", granted_at: float):
+        self.limiter = limiter
+        self.granted_at = granted_at
+        self.started = time.perf_counter() # when the successful attempt was sent
+        self.queue_wait = 0.0 # waiting for slots and rate limits, all attempts
+        self.retry_wait = 0.0 # failed attempts and backoff
+        self.retries = 0
+        self._released = False
+
+    async def release(self, outcome: str = "success"):
+        if not self._released:
+            self._released = True
+            await self.limiter.concurrency.release(self.granted_at, outcome)
+
+
+class ProviderLimiter:
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 initial_concurrency: int = 8, min_concurrency: int = 1, max_concurrency: int = 64,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 20.0):
+        """
+        Args:
+            name: the provider, for logs
+            requests_per_minute, tokens_per_minute: bucket sizes, 0 for no limit
+            initial_concurrency, min_concurrency, max_concurrency: bounds of the AIMD concurrency limit
+            max_retries: retries of a request after retryable errors
+            backoff_base, backoff_max: the n-th retry waits a random time up to min(backoff_max, backoff_base * 2**n)
+        """
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.concurrency = AIMDLimiter(initial_concurrency, min_concurrency, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0.0 # monotonic time, set from Retry-After and exhausted rate limit headers
+        self.throttled = 0
+        self.retries = 0
+        self.total_requests = 0
+        self.total_queue_wait = 0.0
+
+    def pause(self, seconds: float, reason: str):
+        until = time.monotonic() + seconds
+        if until > self.paused_until:
+            self.paused_until = until
+            logger.warning(f"LLM requests to {self.name} paused for {seconds:.2f}s ({reason})")
+
+    def observe_headers(self, headers):
+        """Follow x-ratelimit-remaining/reset headers of a response, pausing once a limit is used up"""
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            if bucket is not None:
+                bucket.limit_to(remaining)
+            if remaining <= 0:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self.pause(reset, f"{kind} limit reached")
+
+    def consume_tokens(self, tokens: int):
+        """Charge tokens known only after the response, such as the completion"""
+        if self.tokens is not None and tokens > 0:
+            self.tokens.take(tokens)
+
+    async def _acquire(self, tokens: int) -> Tuple[float, float]:
+        """Wait for a concurrency slot and the rate limits, returns (granted_at, seconds waited)"""
+        start_time = time.perf_counter()
+        granted_at = await self.concurrency.acquire()
+        try:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.delay(1) if self.requests else 0.0,
+                    self.tokens.delay(tokens) if self.tokens else 0.0,
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        except BaseException:
+            await self.concurrency.release(granted_at, "cancelled")
+            raise
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+        return granted_at, time.perf_counter() - start_time
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    async def call(self, request: Callable[[], Awaitable[T]], tokens: int = 0, max_retries: Optional[int] = None) -> Tuple[T, Permit]:
+        """
+        Send a request within the limits, retrying retryable errors
+
+        Args:
+            request: sends the request, returns once the response starts
+            tokens: estimated prompt tokens, taken from the token bucket
+            max_retries: overrides the limiter's number of retries
+
+        Returns:
+            the response and its permit, release the permit once the response is consumed
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        queue_wait, retry_wait = 0.0, 0.0
+        for retry in range(max_retries + 1):
+            granted_at, waited = await self._acquire(tokens)
+            queue_wait += waited
+            self.total_queue_wait += waited
+            self.total_requests += 1
+            permit = Permit(self, granted_at)
+            try:
+                response = await request()
+            except asyncio.CancelledError:
+                await permit.release("cancelled")
+                raise
+            except Exception as e:
+                throttled = is_throttled(e)
+                await permit.release("throttled" if throttled else "error")
+                if throttled:
+                    self.throttled += 1
+                if not is_retryable(e) or retry == max_retries:
+                    raise
+                delay = self.backoff(retry)
+                server_delay = retry_after(getattr(getattr(e, "response", None), "headers", None))
+                if server_delay is not None:
+                    delay = server_delay + random.uniform(0, self.backoff_base)
+                    self.pause(server_delay, "Retry-After")
+                self.retries += 1
+                logger.warning(f"LLM request to {self.name} failed ({e!r}), retry {retry + 1}/{max_retries} in {delay:.2f}s")
+                retry_wait += time.perf_counter() - permit.started + delay
+                await asyncio.sleep(delay)
+                continue
+            permit.queue_wait, permit.retry_wait, permit.retries = queue_wait, retry_wait, retry
+            return response, permit
+
+    def stats(self) -> dict:
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "inflight": self.concurrency.inflight,
+            "waiting": self.concurrency.waiting,
+            "requests": self.total_requests,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "avg_queue_wait": round(self.total_queue_wait / self.total_requests, 4) if self.total_requests else 0.0,
+        }
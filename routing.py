@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+'''
+多模型服务商路由：记录每个(provider, model)最近的延迟（流式为首个token的延迟）和出错率，
+每次请求按它们排序后依次尝试，出错或超时（ROUTING.ATTEMPT_TIMEOUT）就换下一个；出错后的一段时间
+（ROUTING.FAILURE_COOLDOWN）内该服务商排在最后。
+对延迟敏感的请求可以对冲（hedge）：首选服务商在其p95延迟内还没有回应时，再向下一个服务商发出同样的请求，
+采用先回应的那个，另一个被取消。流式回应收到第一个chunk后就不再切换。
+被取消的一方到取消时已等待的时间作为它延迟的下限计入统计，一直很慢的首选服务商因此会排到后面。
+超时与延迟只计算请求发出之后的部分（attempt用timed发送请求），在限流器中排队、退避重试的时间不算在内。
+'''
+
+import time
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+Route = Tuple[str, str] # (MODEL.MARK, model name)
+Timed = Callable[[Callable[[], Awaitable[Any]]], Awaitable[Any]]
+
+
+class AttemptTimeout(RuntimeError):
+    """A route did not respond within ROUTING.ATTEMPT_TIMEOUT; not a TimeoutError, which is the query's own time limit"""
+
+
+class ProviderStats:
+    """Rolling latency and error samples of one route"""
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.outcomes: Deque[bool] = deque(maxlen=window) # True for a success
+        self.last_failure = 0.0 # monotonic time
+        self.attempts = 0 # started, including cancelled ones
+        self.requests = 0
+        self.failures = 0
+        self.hedges_won = 0
+        self.hedges_lost = 0
+
+    def success(self, latency: float):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+
+    def lost_hedge(self, elapsed: float):
+        """Cancelled after elapsed seconds because another route answered first, its latency is at least that"""
+        self.requests += 1
+        self.hedges_lost += 1
+        self.latencies.append(elapsed)
+
+    def failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.outcomes.append(False)
+        self.last_failure = time.monotonic()
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def summary(self) -> dict:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate, 3),
+            "latency_p50": round(p50, 3) if p50 is not None else None,
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "hedges_won": self.hedges_won,
+            "hedges_lost": self.hedges_lost,
+        }
+
+
+class ProviderRouter:
+    def __init__(self, routes: List[Route], attempt_timeout: float = 0.0, window: int = 50, failure_cooldown: float = 30.0,
+                 hedge_percentile: float = 95.0, hedge_min_delay: float = 1.0, hedge_min_samples: int = 5):
+        """
+        Args:
+            routes: (provider mark, model) pairs, in order of preference while nothing is measured
+            attempt_timeout: seconds a request may take to respond (first chunk of a stream), 0 for no limit
+            window: number of recent requests the latency and error rate of a route are taken from
+            failure_cooldown: seconds a failed route is tried only after the others
+            hedge_percentile: a hedged request is sent once the first one took longer than this percentile of its route
+            hedge_min_delay: lower bound of the hedge delay, also used while a route has fewer than hedge_min_samples
+        """
+        self.routes = list(dict.fromkeys(routes))
+        self.attempt_timeout = attempt_timeout
+        self.failure_cooldown = failure_cooldown
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.stats: Dict[Route, ProviderStats] = {route: ProviderStats(window) for route in self.routes}
+
+    def order(self) -> List[Route]:
+        """
+        Routes in the order to try them: routes that failed recently last, then by error rate and median latency.
+        Routes never measured keep their configured place behind the measured ones. The first route is tried first while
+        it was never tried; once tried without a measurement (the query was cancelled), it waits behind the measured ones too.
+        """
+        now = time.monotonic()
+        def key(indexed):
+            index, route = indexed
+            stats = self.stats[route]
+            cooling = now - stats.last_failure < self.failure_cooldown if stats.failures else False
+            p50 = stats.percentile(50)
+            if p50 is None:
+                p50 = 0.0 if index == 0 and not stats.attempts else float("inf")
+            return (cooling, round(stats.error_rate, 1), p50, index)
+        return [route for _, route in sorted(enumerate(self.routes), key=key)]
+
+    def hedge_delay(self, route: Route) -> float:
+        stats = self.stats[route]
+        if len(stats.latencies) < self.hedge_min_samples:
+            return self.hedge_min_delay
+        return max(self.hedge_min_delay, stats.percentile(self.hedge_percentile))
+
+    async def _attempt(self, route: Route, attempt: Callable[[Route, Timed], Awaitable[T]], sent: Dict[Route, float]) -> T:
+        """Run attempt on a route, sent gets the time its last request was sent"""
+        self.stats[route].attempts += 1
+        start_time = time.perf_counter()
+        latency = None
+
+        async def timed(send: Callable[[], Awaitable[Any]]):
+            nonlocal latency
+            sent[route] = time.perf_counter()
+            if self.attempt_timeout > 0:
+                try:
+                    async with asyncio.timeout(self.attempt_timeout) as timeout:
+                        result = await send()
+                except TimeoutError as e:
+                    if not timeout.expired():
+                        raise
+                    raise AttemptTimeout(f"{route[0]}/{route[1]} did not respond within {self.attempt_timeout}s") from e
+            else:
+                result = await send()
+            latency = time.perf_counter() - sent[route]
+            return result
+
+        try:
+            result = await attempt(route, timed)
+        except asyncio.CancelledError:
+            raise # lost a hedge race or the query was cancelled, not the route's fault
+        except Exception as e:
+            self.stats[route].failure()
+            logger.warning(f"LLM request to {route[0]}/{route[1]} failed after {time.perf_counter() - start_time:.3f}s: {e!r}")
+            raise
+        self.stats[route].success(latency if latency is not None else time.perf_counter() - start_time)
+        return result
+
+    async def call(self, attempt: Callable[[Route, Timed], Awaitable[T]], hedge: bool = False,
+                   discard: Optional[Callable[[T], Awaitable[None]]] = None) -> Tuple[T, Route]:
+        """
+        Run attempt on the best route, failing over to the next routes on errors and timeouts
+
+        Args:
+            attempt: sends the request to a route through the timed function it gets (timed(send) awaits send()),
+                returns once the response starts. Only the time in timed counts, for the timeout and the route's latency,
+                waiting for the provider's rate limits and between retries may come before or between timed sends.
+            hedge: also send the request to the next route if the first one is slower than its hedge delay
+            discard: releases the result of an attempt that completed but lost the hedge race
+
+        Returns:
+            result of the first successful attempt and its route
+        """
+        candidates = self.order()
+        last_error: Optional[BaseException] = None
+        while candidates:
+            route = candidates.pop(0)
+            sent: Dict[Route, float] = {}
+            tasks = {asyncio.create_task(self._attempt(route, attempt, sent)): route}
+            try:
+                if hedge and candidates:
+                    done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(route))
+                    if not done:
+                        backup = candidates.pop(0)
+                        logger.info(f"Hedging LLM request: {route[0]}/{route[1]} slower than {self.hedge_delay(route):.3f}s, "
+                                    f"also asking {backup[0]}/{backup[1]}")
+                        tasks[asyncio.create_task(self._attempt(backup, attempt, sent))] = backup
+                while tasks:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    winner = None
+                    for task in done:
+                        task_route = tasks.pop(task)
+                        if task.exception() is not None:
+                            last_error = task.exception()
+                        elif winner is None:
+                            winner = (task.result(), task_route)
+                        elif discard is not None:
+                            await discard(task.result())
+                    if winner is not None:
+                        if winner[1] != route:
+                            self.stats[winner[1]].hedges_won += 1
+                        # the losers still waiting for a response are slower than the winner was, they are cancelled below
+                        for task, task_route in tasks.items():
+                            if not task.done() and task_route in sent:
+                                self.stats[task_route].lost_hedge(time.perf_counter() - sent[task_route])
+                        return winner
+            finally:
+                # the losers are cancelled, one that completed meanwhile is released too
+                for task in tasks:
+                    task.cancel()
+                for result in await asyncio.gather(*tasks, return_exceptions=True):
+                    if discard is not None and not isinstance(result, BaseException):
+                        await discard(result)
+            if candidates:
+                logger.info(f"Failing over to {candidates[0][0]}/{candidates[0][1]}")
+        raise last_error if last_error is not None else RuntimeError("no LLM route configured")
+
+    def summary(self) -> Dict[str, dict]:
+        return {f"{mark}/{model}": self.stats[(mark, model)].summary() for mark, model in self.routes}
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+'''
+服务模式：把host作为一个多用户的HTTP/WebSocket服务运行（python host.py --serve）。
+每个会话（conversation）有独立的对话上下文，所有会话共享同一组MCP server连接和模型client。
+租户由请求头X-Tenant区分，每个租户同时处理的问题数由SERVE.TENANT_CONCURRENCY限制。
+
+接口：
+  POST   /conversations                 新建会话，返回 {"id": ...}
+  POST   /conversations/{id}/query      body为 {"query": ..., "stream": true, "hedge": false}，以SSE流式返回输出，最后一个事件为done
+                                        （hedge可选，对延迟敏感的问题开启对冲请求，不填则按ROUTING.HEDGE）
+  WS     /conversations/{id}/ws         发送 {"query": ...}，逐条收到 {"event": ..., "data": ...}
+  DELETE /conversations/{id}            结束会话
+  GET    /stats                         会话数、各租户的并发、进程内存等
+  GET    /metrics                       Prometheus格式的各阶段耗时直方图与token计数
+  GET    /blobs/{hash}                  工具结果中存为blob的原始内容（对话中的句柄blob:<hash>），见blob_store.py；
+                                        只能取回本租户现有会话的工具结果中出现过的blob，会话结束后不再能取回
+'''
+
+import os
+import json
+import time
+import asyncio
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from loguru import logger
+
+from blob_store import HANDLE_PREFIX
+
+
+def current_rss() -> Optional[int]:
+    """Resident memory of this process in bytes, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class ReleasingResponse:
+    """
+    Sends a response, then calls release. Also when the client goes away before a streamed body was started,
+    in which case the generator of the body never runs its finally block.
+    """
+    def __init__(self, response: Response, release: Callable[[], None]):
+        self.response = response
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+
+
+class ServedConversation:
+    """A conversation of the server, owned by one tenant"""
+    def __init__(self, conversation, tenant: str):
+        self.conversation = conversation
+        self.tenant = tenant
+        self.lock = asyncio.Lock() # one query at a time per conversation
+        self.last_active = time.monotonic()
+
+
+class ConversationServer:
+    def __init__(self, client, cfg):
+        """
+        Args:
+            client: a MyMCPClient already connected to its servers, shared by all conversations
+            cfg: the SERVE options are read from it
+        """
+        self.client = client
+        self.cfg = cfg
+        self.conversations: Dict[str, ServedConversation] = {}
+        self._tenant_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._tenant_pending: Dict[str, int] = {} # queries of a tenant running or waiting for a slot
+        self._active_queries = 0
+        self.peak_active_queries = 0
+        self._base_rss = current_rss()
+        self.app = Starlette(routes=[
+            Route("/conversations", self.create_conversation, methods=["POST"]),
+            Route("/conversations/{conversation_id}", self.delete_conversation, methods=["DELETE"]),
+            Route("/conversations/{conversation_id}/query", self.query, methods=["POST"]),
+            WebSocketRoute("/conversations/{conversation_id}/ws", self.websocket),
+            Route("/stats", self.stats, methods=["GET"]),
+            Route("/metrics", self.metrics, methods=["GET"]),
+            Route("/blobs/{key}", self.blob, methods=["GET"]),
+        ])
+
+    @staticmethod
+    def tenant_of(connection) -> str:
+        return connection.headers.get("x-tenant") or connection.query_params.get("tenant") or "default"
+
+    def find_conversation(self, connection) -> Optional[ServedConversation]:
+        """The conversation of the path, if it exists and belongs to the caller's tenant"""
+        served = self.conversations.get(connection.path_params["conversation_id"])
+        if served is None or served.tenant != self.tenant_of(connection):
+            return None
+        return served
+
+    def reserve(self, tenant: str) -> bool:
+        """
+        Count a query of the tenant, unless it already has as many queries running and queued as it may.
+        Done before anything is awaited, so concurrent requests cannot all pass the check; release undoes it.
+        """
+        pending = self._tenant_pending.get(tenant, 0)
+        if pending >= self.cfg.SERVE.TENANT_CONCURRENCY + self.cfg.SERVE.TENANT_MAX_QUEUED:
+            return False
+        self._tenant_pending[tenant] = pending + 1
+        return True
+
+    def release(self, tenant: str):
+        self._tenant_pending[tenant] -= 1
+
+    async def create_conversation(self, request: Request):
+        if len(self.conversations) >= self.cfg.SERVE.MAX_CONVERSATIONS:
+            return JSONResponse({"error": "too many conversations"}, status_code=503)
+        conversation = self.client.new_conversation()
+        self.conversations[conversation.id] = ServedConversation(conversation, self.tenant_of(request))
+        logger.info(f"Conversation {conversation.id} created for tenant {self.tenant_of(request)}")
+        return JSONResponse({"id": conversation.id})
+
+    async def delete_conversation(self, request: Request):
+        served = self.find_conversation(request)
+        if served is None:
+            return JSONResponse({"error": "conversation not found"}, status_code=404)
+        del self.conversations[served.conversation.id]
+        return JSONResponse({"deleted": served.conversation.id})
+
+    async def run_query(self, served: ServedConversation, query: str, hedge: Optional[bool] = None) -> AsyncIterator[dict]:
+        """
+        Process a query in a conversation, yielding its output as {"event", "data"} events and finally its summary.
+        The caller reserves the query (reserve) and releases it once done. Waits for a slot of the tenant first.
+        The query is cancelled if the consumer stops early (client gone).
+        """
+        tenant = served.tenant
+        semaphore = self._tenant_semaphores.setdefault(tenant, asyncio.Semaphore(self.cfg.SERVE.TENANT_CONCURRENCY))
+        queue: asyncio.Queue = asyncio.Queue()
+        task = None
+        try:
+            queue_start_time = time.perf_counter()
+            async with semaphore, served.lock:
+                queue_wait = time.perf_counter() - queue_start_time
+                self._active_queries += 1
+                self.peak_active_queries = max(self.peak_active_queries, self._active_queries)
+                served.conversation.output = lambda text: queue.put_nowait({"event": "output", "data": text})
+                served.conversation.hedge = hedge
+                try:
+                    task = asyncio.create_task(self.client.process_query(query, served.conversation))
+                    task.add_done_callback(lambda _: queue.put_nowait(None))
+                    while (event := await queue.get()) is not None:
+                        yield event
+                    try:
+                        summary = task.result()
+                    except Exception as e:
+                        logger.error(f"Query of conversation {served.conversation.id} failed: {e}")
+                        yield {"event": "error", "data": str(e)}
+                    else:
+                        yield {"event": "done", "data": {**summary, "queue_wait": queue_wait}}
+                finally:
+                    self._active_queries -= 1
+                    served.conversation.output = lambda text: None
+        finally:
+            if task is not None and not task.done():
+                task.cancel()
+            served.last_active = time.monotonic()
+
+    async def query(self, request: Request):
+        served = self.find_conversation(request)
+        if served is None:
+            return JSONResponse({"error": "conversation not found"}, status_code=404)
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            return JSONResponse({"error": "body must be JSON"}, status_code=400)
+        if not isinstance(body, dict) or not body.get("query"):
+            return JSONResponse({"error": "missing query"}, status_code=400)
+        if not self.reserve(served.tenant):
+            return JSONResponse({"error": "tenant concurrency limit reached"}, status_code=429)
+
+        if not body.get("stream", True):
+            output, result = [], None
+            try:
+                async for event in self.run_query(served, body["query"], body.get("hedge")):
+                    if event["event"] == "output":
+                        output.append(event["data"])
+                    else:
+                        result = event
+            finally:
+                self.release(served.tenant)
+            if result["event"] == "error":
+                return JSONResponse({"error": result["data"]}, status_code=500)
+            return JSONResponse({**result["data"], "output": "".join(output)})
+
+        async def event_stream():
+            async for event in self.run_query(served, body["query"], body.get("hedge")):
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False, default=str)}\n\n"
+        return ReleasingResponse(StreamingResponse(event_stream(), media_type="text/event-stream"),
+                                 partial(self.release, served.tenant))
+
+    async def websocket(self, websocket: WebSocket):
+        served = self.find_conversation(websocket)
+        if served is None:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+        try:
+            while True:
+                message = await websocket.receive_json()
+                if not isinstance(message, dict) or not message.get("query"):
+                    await websocket.send_json({"event": "error", "data": "missing query"})
+                    continue
+                if not self.reserve(served.tenant):
+                    await websocket.send_json({"event": "error", "data": "tenant concurrency limit reached"})
+                    continue
+                try:
+                    async for event in self.run_query(served, message["query"], message.get("hedge")):
+                        await websocket.send_text(json.dumps(event, ensure_ascii=False, default=str))
+                finally:
+                    self.release(served.tenant)
+        except WebSocketDisconnect:
+            pass
+
+    async def stats(self, request: Request):
+        rss = current_rss()
+        grown = rss - self._base_rss if rss is not None and self._base_rss is not None else None
+        return JSONResponse({
+            "conversations": len(self.conversations),
+            "active_queries": self._active_queries,
+            "peak_active_queries": self.peak_active_queries,
+            "tenants": {tenant: pending for tenant, pending in self._tenant_pending.items() if pending},
+            "rss_mb": rss / 2**20 if rss is not None else None,
+            "memory_per_conversation_kb": grown / 1024 / len(self.conversations) if grown is not None and self.conversations else None,
+            "dialogue_tokens": sum(served.conversation.dialogue.total_tokens for served in self.conversations.values()),
+            "tool_cache": self.client.tool_cache.stats(),
+            "prompt_cache": self.client.usage,
+            "servers": self.client.server_stats(),
+            "llm_routes": self.client.router.summary(),
+            "llm_limits": self.client.rate_limit_stats(),
+            "cassette": self.client.cassette.stats() if self.client.cassette is not None else None,
+            "blobs": self.client.blob_store.stats() if self.client.blob_store is not None else None,
+            "compaction": self.client.compactor.stats() if self.client.compactor is not None else None,
+        })
+
+    async def blob(self, request: Request):
+        """
+        A stored blob, to a tenant with a conversation that got it from a tool (same 404 for others, as for unknown blobs).
+        The access ends with the conversations, the handles are kept by each conversation and dropped with it.
+        """
+        if self.client.blob_store is None:
+            return JSONResponse({"error": "blob store is off"}, status_code=404)
+        handle, tenant = HANDLE_PREFIX + request.path_params["key"], self.tenant_of(request)
+        if not any(handle in served.conversation.blobs for served in self.conversations.values() if served.tenant == tenant):
+            return JSONResponse({"error": "unknown blob"}, status_code=404)
+        try:
+            data, mime_type = self.client.blob_store.get(request.path_params["key"])
+        except KeyError:
+            return JSONResponse({"error": "unknown blob"}, status_code=404)
+        return Response(data, media_type=mime_type, headers={"Cache-Control": "max-age=31536000, immutable"})
+
+    async def metrics(self, request: Request):
+        return PlainTextResponse(self.client.tracer.render_metrics(), media_type="text/plain; version=0.0.4")
+
+    async def reap_idle_conversations(self):
+        """Drop conversations idle for more than SERVE.CONVERSATION_IDLE_TIMEOUT seconds"""
+        timeout = self.cfg.SERVE.CONVERSATION_IDLE_TIMEOUT
+        while True:
+            await asyncio.sleep(min(60.0, timeout))
+            now = time.monotonic()
+            for conversation_id, served in list(self.conversations.items()):
+                if not served.lock.locked() and now - served.last_active > timeout:
+                    del self.conversations[conversation_id]
+                    logger.info(f"Conversation {conversation_id} dropped after {timeout}s idle")
+
+    async def serve(self, host: str, port: int):
+        """Serve until the process is interrupted"""
+        reaper = asyncio.create_task(self.reap_idle_conversations()) if self.cfg.SERVE.CONVERSATION_IDLE_TIMEOUT > 0 else None
+        server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning"))
+        print(f"Serving {self.client.model_name} on http://{host}:{port} with tools "
+              f"{[tool['function']['name'] for tool in self.client.tools]}")
+        try:
+            await server.serve()
+        finally:
+            if reaper is not None:
+                reaper.cancel()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from config import get_cfg_defaults
+from host import MyMCPClient
+from routing import AttemptTimeout
+
+
+def client_with_model(get_response_message, query_timeout: float = 100.0) -> MyMCPClient:
+    cfg = get_cfg_defaults()
+    cfg.HOST.QUERY_TIMEOUT = query_timeout
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    client.get_response_message = get_response_message
+    return client
+
+
+def test_provider_timeouts_fail_the_query():
+    async def all_routes_timed_out(conversation, on_tool_call=None, step_record=None):
+        raise AttemptTimeout("b/model did not respond within 60.0s")
+    client = client_with_model(all_routes_timed_out)
+    with pytest.raises(AttemptTimeout):
+        asyncio.run(client.process_query("q", client.new_conversation()))
+
+
+def test_other_timeout_errors_are_not_the_query_time_limit():
+    async def timed_out(conversation, on_tool_call=None, step_record=None):
+        raise TimeoutError()
+    client = client_with_model(timed_out)
+    with pytest.raises(TimeoutError):
+        asyncio.run(client.process_query("q", client.new_conversation()))
+
+
+def test_query_time_limit_stops_the_query():
+    async def slow(conversation, on_tool_call=None, step_record=None):
+        await asyncio.sleep(10)
+    client = client_with_model(slow, query_timeout=0.05)
+    summary = asyncio.run(client.process_query("q", client.new_conversation()))
+    assert summary["stop_reason"] == "time limit reached (0.05s)"
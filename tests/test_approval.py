@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from approval import ToolApprovals
+from config import get_cfg_defaults
+from host import MyMCPClient
+
+CALLS = [(("search",), "brave"), (("send_email",), "mail"), (("read_inbox",), "mail")]
+
+
+def approvals_answering(*answers: str, **standing) -> ToolApprovals:
+    """Approvals whose user gives these answers in turn, the questions are kept in approvals.questions"""
+    answers = list(answers)
+    approvals = ToolApprovals(**standing)
+    approvals.questions = []
+
+    async def prompt(question):
+        approvals.questions.append(question)
+        return answers.pop(0)
+    approvals.prompt = prompt
+    return approvals
+
+
+def confirm(approvals: ToolApprovals, calls=CALLS):
+    approved, _ = asyncio.run(approvals.confirm(calls))
+    return approved
+
+
+def confirming_client(answer: str):
+    """A client with HOST.NEED_USER_CONFIRM, the user answers every question with answer"""
+    cfg = get_cfg_defaults()
+    cfg.HOST.NEED_USER_CONFIRM = True
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    questions = []
+
+    async def prompt(question):
+        questions.append(question)
+        return answer
+    client.approvals.prompt = prompt
+    return client, questions
+
+
+def test_host_tools_are_never_asked_about():
+    client, questions = confirming_client("n")
+    conversation = client.new_conversation(interactive=True)
+    calls = [("request_all_tools", {}), ("read_blob", {"blob": "blob:0123"})]
+    assert asyncio.run(client.confirm_tool_calls(calls, conversation)) == ([True, True], 0.0)
+    assert questions == []
+    assert not any(client.needs_confirmation(name, conversation) for name, _ in calls)
+
+    # asked about the other calls only, refusing them leaves the host's tools approved
+    approved, _ = asyncio.run(client.confirm_tool_calls(calls + [("send_email", {})], conversation))
+    assert approved == [True, True, False]
+    assert len(questions) == 1 and "send_email" in questions[0] and "read_blob" not in questions[0]
+    assert client.needs_confirmation("send_email", conversation)
+
+
+@pytest.mark.parametrize("answer, approved", [
+    ("", [True, True, True]),
+    ("Y", [True, True, True]),
+    ("n", [False, False, False]),
+    ("1,3", [True, False, True]),
+    ("2 9", [False, True, False]), # numbers of no call are ignored
+])
+def test_one_answer_for_all_calls_of_a_step(answer, approved):
+    approvals = approvals_answering(answer)
+    assert confirm(approvals) == approved
+    assert len(approvals.questions) == 1 and "1. search" in approvals.questions[0] and "3. read_inbox" in approvals.questions[0]
+    stats = approvals.stats()
+    assert (stats["asked"], stats["approved"], stats["refused"]) == (1, sum(approved), 3 - sum(approved))
+
+
+def test_standing_approvals_skip_the_question():
+    approvals = approvals_answering("t", "n", servers=["brave"])
+    # search is allowed from the start, the other two are asked about together
+    assert confirm(approvals) == [True, True, True]
+    assert "search" not in approvals.questions[0]
+    assert confirm(approvals) == [True, True, True] # now allowed as tools
+    assert len(approvals.questions) == 1
+    assert approvals.stats()["auto_approved"] == 1 + 3
+    # t allows the tools, not the rest of their server
+    assert confirm(approvals, [(("delete_email",), "mail")]) == [False]
+    assert len(approvals.questions) == 2
+
+    approvals = approvals_answering("s")
+    assert confirm(approvals, [(("send_email",), "mail"), (("read_blob",), None)]) == [True, True]
+    # the server is allowed, a tool without one (of the host) only as a tool
+    assert approvals.servers == {"mail"} and approvals.tools == {"read_blob"}
+    assert confirm(approvals, [(("delete_email",), "mail")]) == [True]
+    assert len(approvals.questions) == 1
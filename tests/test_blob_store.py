@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+from mcp import types
+
+from blob_store import BlobStore, render_tool_content
+
+
+def test_results_show_the_handle_not_the_host_path(tmp_path):
+    store = BlobStore(str(tmp_path))
+    image = types.ImageContent(type="image", data=base64.b64encode(b"\x89PNG....").decode(), mimeType="image/png")
+    text, handles = render_tool_content([image], store)
+    assert text == f"[image: image/png, 8 B, stored as {handles[0]}]"
+    error = store.read_text(handles[0], allowed=set(handles))
+    assert error == f"Error: {handles[0]} is image/png (8 B), only text blobs can be read"
+    assert str(tmp_path) not in text + error
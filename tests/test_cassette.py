@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from cassette import CassetteClient, CassetteMiss, LLMCassette, message_from_chunks
+
+TOOL_CALL = {"id": "call_0", "type": "function", "function": {"name": "get_current_time", "arguments": "{}"}}
+
+
+def messages(time_result: str, question: str = "What time is it?") -> list:
+    return [
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": None, "tool_calls": [TOOL_CALL]},
+        {"role": "tool", "tool_call_id": "call_0", "content": time_result},
+    ]
+
+
+class FakeProvider:
+    """Answers with the tool result it was sent, as an AsyncOpenAI client would"""
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+        self.requests = 0
+
+    async def create(self, *, model, messages, tools=None, stream=False, **kwargs):
+        self.requests += 1
+        return ChatCompletion.model_validate({
+            "id": "1", "object": "chat.completion", "created": 0, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"It is {messages[-1]['content']}."}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+        })
+
+    async def close(self):
+        pass
+
+
+def test_replay_matches_exact_then_loose_keys(tmp_path):
+    path = str(tmp_path / "cassette.jsonl")
+
+    async def run():
+        recorder = CassetteClient(LLMCassette(path, "record"), FakeProvider())
+        await recorder.create(model="m", messages=messages("12:00"))
+        assert recorder.cassette.stats()["recorded"] == 1
+
+        cassette = LLMCassette(path, "replay")
+        player = CassetteClient(cassette)
+        response = await player.create(model="m", messages=messages("12:00"))
+        assert response.choices[0].message.content == "It is 12:00."
+        assert response.usage.prompt_tokens == 10
+        # the time has moved on since the recording, only the tool result differs
+        response = await player.create(model="m", messages=messages("12:05"))
+        assert response.choices[0].message.content == "It is 12:00."
+        assert (cassette.hits, cassette.loose_hits) == (1, 1)
+        # anything else that differs is another request
+        with pytest.raises(CassetteMiss):
+            await player.create(model="m", messages=messages("12:00", question="What day is it?"))
+        with pytest.raises(CassetteMiss):
+            await player.create(model="other", messages=messages("12:00"))
+    asyncio.run(run())
+
+
+def test_recorded_response_replays_as_a_stream(tmp_path):
+    path = str(tmp_path / "cassette.jsonl")
+    cassette = LLMCassette(path, "record")
+    keys = ("exact", "loose")
+    cassette.record(keys, "m", {"role": "assistant", "content": None, "tool_calls": [TOOL_CALL]}, "tool_calls",
+                    {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}, latency=0.5)
+
+    async def run():
+        record = LLMCassette(path, "replay").lookup(keys)
+        return [chunk async for chunk in CassetteClient._replay_stream(record)]
+    message, finish_reason, usage = message_from_chunks(asyncio.run(run()))
+    assert message == {"role": "assistant", "content": None, "tool_calls": [TOOL_CALL]}
+    assert finish_reason == "tool_calls"
+    assert usage["total_tokens"] == 7
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from compactor import OutputCompactor
+
+CAT = (
+    "    /\\_/\\\n"
+    "   ( o.o )    <- cat\n"
+    "    > ^ <\n"
+    "\n"
+    "\n"
+    "\n"
+    "=====\n"
+    "=====\n"
+)
+
+
+def test_default_rule_leaves_ascii_art_and_indentation_alone():
+    compactor = OutputCompactor([])
+    compacted, lossy = compactor.compact(CAT, compactor.rule("draw_cat"))
+    assert compacted == CAT
+    assert not lossy
+
+
+def test_trailing_whitespace_alone_is_not_lossy():
+    compactor = OutputCompactor([("tool", {"collapse_whitespace": True})])
+    compacted, lossy = compactor.compact("  def f():  \n      return 1   \n\n", compactor.rule("tool"))
+    assert compacted == "  def f():\n      return 1"
+    assert not lossy
+
+
+def test_whitespace_options_keep_the_first_indent_and_count_as_lossy():
+    compactor = OutputCompactor([("tool", {"collapse_whitespace": True, "dedupe_lines": True})])
+    compacted, lossy = compactor.compact(CAT, compactor.rule("tool"))
+    assert compacted == "    /\\_/\\\n   ( o.o ) <- cat\n    > ^ <\n\n===== [repeated 2 times]"
+    assert lossy # the raw output goes to the blob store
+
+
+def test_json_values_changed_are_lossy_reformatting_is_not():
+    compactor = OutputCompactor([("spaced", {"collapse_whitespace": True})])
+    assert compactor.compact('{"a": [1, 2],\n "b": "x"}', compactor.rule("any")) == ('{"a":[1,2],"b":"x"}', False)
+    assert compactor.compact('{"a": null, "b": "x"}', compactor.rule("any")) == ('{"b":"x"}', True)
+    assert compactor.compact({"b": "x  y"}, compactor.rule("spaced")) == ('{"b":"x y"}', True)
+
+
+def test_structured_content_is_measured_against_its_compact_json():
+    compactor = OutputCompactor([("search", {"max_items": 1})])
+    structured = {"time": "2025-01-01T12:00:00", "timezone": "UTC"}
+    server_text = json.dumps(structured, indent=2) # what FastMCP sends along as text
+    compacted, lossy = compactor.compact(structured, compactor.rule("get_current_time"))
+    assert compactor.record("get_current_time", compactor.uncompacted(structured, server_text), compacted, lossy) == 0
+
+    results = {"results": [{"title": "one"}, {"title": "two"}]}
+    compacted, lossy = compactor.compact(results, compactor.rule("search"))
+    assert compactor.record("search", compactor.uncompacted(results, json.dumps(results, indent=2)), compacted, lossy) > 0
+    stats = compactor.stats()
+    assert stats["get_current_time"]["compacted"] == 0 and stats["get_current_time"]["tokens_saved"] == 0
+    assert stats["search"]["compacted"] == 1
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from dialogue import Dialogue, count_message_tokens
+
+SYSTEM = [{"role": "system", "content": "You are a helpful assistant."}]
+
+
+def add_turn(dialogue: Dialogue, n: int, result_chars: int = 2000):
+    """A user message, a tool call with a long result and the answer"""
+    dialogue.append({"role": "user", "content": f"question {n}"})
+    dialogue.append({"role": "assistant", "content": None, "tool_calls": [
+        {"id": f"call_{n}", "type": "function", "function": {"name": "search", "arguments": "{}"}}]})
+    dialogue.append({"role": "tool", "tool_call_id": f"call_{n}", "content": "x " * (result_chars // 2)})
+    dialogue.append({"role": "assistant", "content": f"answer {n}"})
+
+
+def test_fits_untouched_while_under_budget():
+    dialogue = Dialogue(SYSTEM)
+    add_turn(dialogue, 1)
+    total = dialogue.total_tokens
+    assert dialogue.fit(total) == total
+    assert len(dialogue.messages) == 5
+
+
+def test_earlier_tool_results_are_cut_before_turns_are_dropped():
+    dialogue = Dialogue(SYSTEM, compact_chars=50)
+    for n in range(3):
+        add_turn(dialogue, n)
+    full = dialogue.total_tokens
+    latest_result = dialogue.messages[-2]["content"]
+    result_tokens = count_message_tokens(dialogue.messages[-2])
+    # more than one result over, room for everything once the two earlier results are cut
+    budget = full - result_tokens * 3 // 2
+    total = dialogue.fit(budget)
+    assert total == dialogue.total_tokens <= budget
+    assert [message["content"] for message in dialogue.messages if message["role"] == "user"] == [
+        "question 0", "question 1", "question 2"]
+    results = [message["content"] for message in dialogue.messages if message["role"] == "tool"]
+    assert all("[truncated" in result for result in results[:2])
+    assert results[2] == latest_result # the latest turn is cut last
+
+
+def test_oldest_turns_are_dropped_whole_and_the_system_prompt_kept():
+    dialogue = Dialogue(SYSTEM, compact_chars=50)
+    for n in range(4):
+        add_turn(dialogue, n)
+    # the latest turn and a bit, not enough for another turn even with its result cut
+    budget = sum(count_message_tokens(message) for message in dialogue.messages[-4:]) + 10
+    dialogue.fit(budget)
+    assert dialogue.messages[0] == SYSTEM[0]
+    users = [message["content"] for message in dialogue.messages if message["role"] == "user"]
+    assert users == ["question 3"]
+    # a tool call is never separated from its result
+    for index, message in enumerate(dialogue.messages):
+        if message.get("tool_calls"):
+            assert dialogue.messages[index + 1]["tool_call_id"] == message["tool_calls"][0]["id"]
+
+
+def test_latest_turn_is_cut_when_it_alone_is_over_budget():
+    dialogue = Dialogue(SYSTEM, compact_chars=50)
+    add_turn(dialogue, 0)
+    add_turn(dialogue, 1, result_chars=20000)
+    total = dialogue.fit(200)
+    users = [message["content"] for message in dialogue.messages if message["role"] == "user"]
+    assert users == ["question 1"]
+    assert "[truncated" in dialogue.messages[-2]["content"]
+    assert total == dialogue.total_tokens
+
+
+def test_target_shrinks_below_the_budget():
+    dialogue = Dialogue(SYSTEM, compact_chars=50)
+    for n in range(4):
+        add_turn(dialogue, n)
+    full = dialogue.total_tokens
+    assert dialogue.fit(full - 1, target=full // 3) <= full // 3
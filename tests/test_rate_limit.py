@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from rate_limit import ProviderLimiter
+
+REQUEST = httpx.Request("POST", "https://provider/v1/chat/completions")
+
+
+def status_error(status: int, headers: dict = None) -> openai.APIStatusError:
+    response = httpx.Response(status, headers=headers, request=REQUEST)
+    error_class = {429: openai.RateLimitError, 400: openai.BadRequestError}.get(status, openai.InternalServerError)
+    return error_class(f"status {status}", response=response, body=None)
+
+
+def responses(*outcomes, latency: float = 0.0):
+    """A request failing or answering in turn: an exception is raised, anything else returned"""
+    outcomes = list(outcomes)
+    sent = []
+
+    async def request():
+        sent.append(time.monotonic())
+        outcome = outcomes.pop(0)
+        await asyncio.sleep(latency)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return request, sent
+
+
+def test_throttling_halves_the_concurrency_limit_and_successes_grow_it():
+    limiter = ProviderLimiter("p", initial_concurrency=8, backoff_base=0.01)
+
+    async def run():
+        async def throttled_once(status: int):
+            request, _ = responses(status_error(status), "ok", latency=0.02)
+            response, permit = await limiter.call(request)
+            await permit.release()
+            return response, permit.retries
+        # four requests in flight together are throttled: one decrease, the others were sent with the old limit
+        results = await asyncio.gather(*[throttled_once(status) for status in (429, 503, 429, 503)])
+        assert results == [("ok", 1)] * 4
+        assert limiter.throttled == 4
+        assert limiter.stats()["concurrency_limit"] == 4
+
+        async def succeed():
+            response, permit = await limiter.call(lambda: asyncio.sleep(0.01, "ok"))
+            await permit.release()
+        # additive increase, about one per limit successes while the slots are used
+        await asyncio.gather(*[succeed() for _ in range(20)])
+        assert limiter.stats()["concurrency_limit"] >= 4
+        limit = limiter.concurrency.limit
+        for _ in range(10):
+            await succeed()
+        assert limiter.concurrency.limit == limit # one request at a time does not use the limit
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_every_request_to_the_provider():
+    limiter = ProviderLimiter("p", backoff_base=0.01)
+
+    async def run():
+        request, sent = responses(status_error(429, {"retry-after-ms": "200"}), "ok")
+        first = asyncio.create_task(limiter.call(request))
+        await asyncio.sleep(0.05)
+        # another request arriving during the pause waits for it too
+        started = time.monotonic()
+        response, other_permit = await limiter.call(lambda: asyncio.sleep(0, "other"))
+        assert response == "other" and time.monotonic() - started >= 0.1
+        assert other_permit.queue_wait >= 0.1
+        response, permit = await first
+        assert response == "ok" and permit.retries == 1
+        assert sent[1] - sent[0] >= 0.2
+        assert permit.retry_wait >= 0.2
+    asyncio.run(run())
+
+
+def test_gives_up_after_max_retries_and_does_not_retry_client_errors():
+    limiter = ProviderLimiter("p", max_retries=2, backoff_base=0.01)
+
+    async def run():
+        request, sent = responses(*[status_error(503)] * 4)
+        with pytest.raises(openai.InternalServerError):
+            await limiter.call(request)
+        assert len(sent) == 3
+        request, sent = responses(status_error(503), status_error(503))
+        with pytest.raises(openai.InternalServerError):
+            await limiter.call(request, max_retries=1)
+        assert len(sent) == 2
+
+        request, sent = responses(status_error(400), "ok")
+        with pytest.raises(openai.BadRequestError):
+            await limiter.call(request)
+        assert len(sent) == 1
+        assert limiter.concurrency.inflight == 0 # every failed attempt gave its slot back
+    asyncio.run(run())
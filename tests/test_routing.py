@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextlib
+from typing import List
+
+import httpx
+import uvicorn
+from openai import AsyncOpenAI
+
+from benchmarks.fake_llm import FakeLLM
+from rate_limit import ProviderLimiter
+from routing import AttemptTimeout, ProviderRouter
+
+MESSAGES = [{"role": "user", "content": "Say hello to the benchmark."}]
+SCENARIOS = [{"query": MESSAGES[0]["content"], "answer": "Hello!"}]
+
+
+@contextlib.asynccontextmanager
+async def fake_providers(*fakes: FakeLLM):
+    """Serve the fake LLMs on local ports, yields a client per fake"""
+    servers = [uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=0, log_level="warning")) for fake in fakes]
+    tasks = [asyncio.create_task(server.serve()) for server in servers]
+    clients: List[AsyncOpenAI] = []
+    try:
+        while not all(server.started for server in servers):
+            await asyncio.sleep(0.01)
+        for server in servers:
+            port = server.servers[0].sockets[0].getsockname()[1]
+            clients.append(AsyncOpenAI(api_key="test", base_url=f"http://127.0.0.1:{port}/v1", max_retries=0,
+                                       http_client=httpx.AsyncClient()))
+        yield clients
+    finally:
+        for client in clients:
+            await client.close()
+        for server in servers:
+            server.should_exit = True
+        await asyncio.gather(*tasks)
+
+
+def attempt_with(clients: dict, limiter: ProviderLimiter = None):
+    async def attempt(route, timed):
+        async def request():
+            response = await clients[route].chat.completions.create(model=route[1], messages=MESSAGES)
+            return response.choices[0].message.content
+        if limiter is None:
+            return await timed(request)
+        content, permit = await limiter.call(lambda: timed(request))
+        await permit.release()
+        return content
+    return attempt
+
+
+def test_failover_to_the_next_route_and_keep_the_failed_one_last():
+    failing = FakeLLM(SCENARIOS, latency=0.01, token_rate=0, error_rate=1.0)
+    healthy = FakeLLM(SCENARIOS, latency=0.01, token_rate=0)
+    a, b = ("a", "model"), ("b", "model")
+
+    async def run():
+        async with fake_providers(failing, healthy) as clients:
+            router = ProviderRouter([a, b], attempt_timeout=5)
+            attempt = attempt_with(dict(zip((a, b), clients)))
+            assert await router.call(attempt) == ("Hello!", b)
+            assert router.summary()["a/model"]["failures"] == 1
+            # a is cooling down, b alone serves the next requests
+            assert router.order() == [b, a]
+            for _ in range(3):
+                assert await router.call(attempt) == ("Hello!", b)
+            assert failing.requests == 1
+            assert healthy.requests == 4
+    asyncio.run(run())
+
+
+def test_hedge_loser_is_measured_and_an_always_slow_route_moves_back():
+    slow = FakeLLM(SCENARIOS, latency=0.01, token_rate=0, slow_rate=1.0, slow_latency=0.5)
+    fast = FakeLLM(SCENARIOS, latency=0.01, token_rate=0)
+    a, b = ("a", "model"), ("b", "model")
+
+    async def run():
+        async with fake_providers(slow, fast) as clients:
+            router = ProviderRouter([a, b], attempt_timeout=5, hedge_min_delay=0.1)
+            attempt = attempt_with(dict(zip((a, b), clients)))
+            assert await router.call(attempt, hedge=True) == ("Hello!", b)
+            summary = router.summary()
+            assert summary["b/model"]["hedges_won"] == 1
+            # the cancelled attempt of a counts with the time it had taken, a lower bound of its latency
+            assert summary["a/model"]["requests"] == 1 and summary["a/model"]["hedges_lost"] == 1
+            assert summary["a/model"]["latency_p50"] >= 0.1
+            assert router.order() == [b, a]
+            for _ in range(5):
+                assert await router.call(attempt, hedge=True) == ("Hello!", b)
+            assert slow.requests == 1
+    asyncio.run(run())
+
+
+def test_first_route_tried_without_a_measurement_waits_behind_measured_ones():
+    a, b = ("a", "model"), ("b", "model")
+    router = ProviderRouter([a, b])
+    assert router.order() == [a, b]
+
+    async def run():
+        async def never_answers(route, timed):
+            await timed(lambda: asyncio.sleep(10))
+        task = asyncio.create_task(router.call(never_answers))
+        await asyncio.sleep(0.01)
+        task.cancel() # the query was cancelled, not a's fault
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
+    assert router.summary()["a/model"]["requests"] == 0
+    assert router.order() == [a, b] # nothing measured yet
+    router.stats[b].success(2.0)
+    assert router.order() == [b, a]
+
+
+def test_limiter_waits_are_neither_timed_out_nor_measured():
+    busy = FakeLLM(SCENARIOS, latency=0.1, token_rate=0, capacity=1, retry_after=0.3)
+    a = ("a", "model")
+
+    async def run():
+        async with fake_providers(busy) as clients:
+            router = ProviderRouter([a], attempt_timeout=0.25)
+            limiter = ProviderLimiter("a", backoff_base=0.01)
+            attempt = attempt_with({a: clients[0]}, limiter)
+            # the second request is throttled and retried after Retry-After, longer than the attempt timeout
+            results = await asyncio.gather(router.call(attempt), router.call(attempt))
+            assert results == [("Hello!", a)] * 2
+            assert limiter.retries >= 1
+            stats = router.stats[a]
+            assert stats.failures == 0
+            assert max(stats.latencies) < 0.25
+    asyncio.run(run())
+
+
+def test_all_routes_timing_out_is_not_the_query_time_limit():
+    router = ProviderRouter([("a", "model"), ("b", "model")], attempt_timeout=0.05)
+
+    async def never_answers(route, timed):
+        await timed(lambda: asyncio.sleep(10))
+
+    async def run():
+        async with asyncio.timeout(100) as query_timeout:
+            try:
+                await router.call(never_answers)
+            except TimeoutError:
+                raise AssertionError("a route's timeout looks like the query's own")
+            except AttemptTimeout as e:
+                assert "b/model did not respond within 0.05s" in str(e)
+        assert not query_timeout.expired()
+    asyncio.run(run())
+    assert router.summary()["a/model"]["failures"] == 1
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import json
+import asyncio
+import itertools
+
+import httpx
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
+
+from blob_store import BlobStore
+from config import get_cfg_defaults
+from host import MyMCPClient
+from serve import ConversationServer
+
+
+class FakeConversation:
+    ids = itertools.count()
+
+    def __init__(self):
+        self.id = f"conversation-{next(self.ids)}"
+        self.output = lambda text: None
+        self.hedge = None
+        self.blobs = set()
+
+
+class FakeClient:
+    """Answers every query after a while, as the shared MyMCPClient would"""
+    def __init__(self, delay: float, blob_store: BlobStore = None):
+        self.delay = delay
+        self.blob_store = blob_store
+        self.running = 0
+        self.peak_running = 0
+
+    def new_conversation(self):
+        return FakeConversation()
+
+    async def process_query(self, query: str, conversation) -> dict:
+        self.running += 1
+        self.peak_running = max(self.peak_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.blob_store is not None:
+                conversation.blobs.add(self.blob_store.put(query.encode("utf-8"), "text/plain"))
+            conversation.output(f"answer to {query}")
+            return {"steps": 1}
+        finally:
+            self.running -= 1
+
+
+def test_concurrent_queries_beyond_the_tenant_limit_are_refused():
+    cfg = get_cfg_defaults()
+    cfg.SERVE.TENANT_CONCURRENCY = 2
+    cfg.SERVE.TENANT_MAX_QUEUED = 1
+    client = FakeClient(delay=0.05)
+    server = ConversationServer(client, cfg)
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://serve") as http:
+            headers = {"X-Tenant": "a"}
+            ids = [(await http.post("/conversations", headers=headers)).json()["id"] for _ in range(8)]
+            # all requests arrive before any response is streamed
+            responses = await asyncio.gather(*[
+                http.post(f"/conversations/{conversation_id}/query", json={"query": "q"}, headers=headers)
+                for conversation_id in ids
+            ])
+            statuses = sorted(response.status_code for response in responses)
+            assert statuses == [200] * 3 + [429] * 5
+            assert all("event: done" in response.text for response in responses if response.status_code == 200)
+            assert client.peak_running == 2
+            assert server._tenant_pending["a"] == 0 # every slot released
+
+            # other tenants have their own limit, and the freed slots can be used again
+            other = (await http.post("/conversations", headers={"X-Tenant": "b"})).json()["id"]
+            response = await http.post(f"/conversations/{other}/query", json={"query": "q", "stream": False},
+                                       headers={"X-Tenant": "b"})
+            assert response.json()["output"] == "answer to q"
+            response = await http.post(f"/conversations/{ids[0]}/query", json={"query": "q"}, headers=headers)
+            assert response.status_code == 200
+    asyncio.run(run())
+
+
+def test_blobs_are_served_to_their_tenant_only(tmp_path):
+    store = BlobStore(str(tmp_path))
+    server = ConversationServer(FakeClient(delay=0, blob_store=store), get_cfg_defaults())
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://serve") as http:
+            conversation_id = (await http.post("/conversations", headers={"X-Tenant": "a"})).json()["id"]
+            await http.post(f"/conversations/{conversation_id}/query", json={"query": "secret", "stream": False},
+                            headers={"X-Tenant": "a"})
+            key = store.put(b"secret", "text/plain")[len("blob:"):]
+            other_key = store.put(b"not from a tool of a", "text/plain")[len("blob:"):]
+
+            response = await http.get(f"/blobs/{key}", headers={"X-Tenant": "a"})
+            assert response.status_code == 200 and response.content == b"secret"
+            assert (await http.get(f"/blobs/{key}", headers={"X-Tenant": "b"})).status_code == 404
+            assert (await http.get(f"/blobs/{other_key}", headers={"X-Tenant": "a"})).status_code == 404
+            # the handles go with the conversation, so does the access
+            await http.delete(f"/conversations/{conversation_id}", headers={"X-Tenant": "a"})
+            assert (await http.get(f"/blobs/{key}", headers={"X-Tenant": "a"})).status_code == 404
+    asyncio.run(run())
+
+
+def test_read_blob_reads_only_blobs_of_the_conversation(tmp_path):
+    cfg = get_cfg_defaults()
+    cfg.BLOBS.DIR = str(tmp_path)
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    server = ConversationServer(client, cfg)
+    handle = client.blob_store.put("secret of a".encode("utf-8"), "text/plain")
+
+    async def get_response_message(conversation, on_tool_call=None, step_record=None):
+        """The model reads the blob once, then answers"""
+        step_record.update(prompt_tokens=1, completion_tokens=1, cached_tokens=0, llm_latency=0.0, queue_wait=0.0, retries=0)
+        if conversation.dialogue.messages[-1]["role"] == "tool":
+            return ChatCompletionMessage(role="assistant", content="done")
+        return ChatCompletionMessage(role="assistant", content=None, tool_calls=[ChatCompletionMessageToolCall(
+            id="call_0", type="function", function=Function(name="read_blob", arguments=json.dumps({"blob": handle})))])
+    client.get_response_message = get_response_message
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://serve") as http:
+            outputs = {}
+            for tenant in ("a", "b"):
+                conversation_id = (await http.post("/conversations", headers={"X-Tenant": tenant})).json()["id"]
+                if tenant == "a":
+                    # a tool result of a's conversation was stored as the blob
+                    server.conversations[conversation_id].conversation.blobs.add(handle)
+                response = await http.post(f"/conversations/{conversation_id}/query", json={"query": "q", "stream": False},
+                                           headers={"X-Tenant": tenant})
+                outputs[tenant] = response.json()["output"]
+            assert "secret of a" in outputs["a"]
+            assert "secret of a" not in outputs["b"]
+            assert f"Error: unknown blob {handle}" in outputs["b"]
+    asyncio.run(run())
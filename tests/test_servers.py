@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import asyncio
+
+import anyio
+from mcp.server.fastmcp import FastMCP
+from mcp.shared.memory import create_client_server_memory_streams
+
+from config import get_cfg_defaults
+from host import MyMCPClient, ToolSession
+from manifest_cache import ToolManifestCache
+
+
+def time_server() -> FastMCP:
+    server = FastMCP("time_mcp_server")
+
+    @server.tool()
+    def now() -> str:
+        """current time"""
+        return "12:00"
+    return server
+
+
+def client_with_server(tmp_path, **server_cfg) -> MyMCPClient:
+    """
+    A client of one server script, whose "process" is an in-memory FastMCP server.
+    client.attempts holds the times the server was started, it fails to start while client.fail_start is set.
+    """
+    script = tmp_path / "timetools.py"
+    if not script.exists():
+        script.write_text("# the time server\n")
+    cfg = get_cfg_defaults()
+    cfg.SERVER.ACCESS_PATHS = [str(script)]
+    cfg.SERVER.MANIFEST_CACHE_FILE = str(tmp_path / "tool_manifest.json")
+    for key, value in server_cfg.items():
+        cfg.SERVER[key] = value
+    cfg.BLOBS.DIR = str(tmp_path / "blobs")
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    client.attempts = []
+    client.fail_start = False
+    client.servers = [] # cancel scopes of the running servers, cancel one to make its server die
+
+    async def connect_stdio_server(server_path, exit_stack):
+        client.attempts.append(time.monotonic())
+        if client.fail_start:
+            raise ConnectionError("server process exited")
+        client_streams, server_streams = await exit_stack.enter_async_context(create_client_server_memory_streams())
+        task_group = await exit_stack.enter_async_context(anyio.create_task_group())
+        exit_stack.callback(task_group.cancel_scope.cancel)
+        lowlevel = time_server()._mcp_server
+
+        async def serve():
+            with anyio.CancelScope() as scope:
+                client.servers.append(scope)
+                await lowlevel.run(*server_streams, lowlevel.create_initialization_options())
+        task_group.start_soon(serve)
+        session = await exit_stack.enter_async_context(ToolSession(*client_streams))
+        return await client.register_session(session, server_path)
+    client.connect_stdio_server = connect_stdio_server
+    return client
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def test_manifest_is_outdated_only_when_the_script_changed(tmp_path):
+    script = tmp_path / "timetools.py"
+    script.write_text("# v1\n")
+    cache_file = str(tmp_path / "tool_manifest.json")
+    tools = asyncio.run(time_server().list_tools())
+    ToolManifestCache(cache_file).store(str(script), "time_mcp_server", tools)
+
+    server_name, cached_tools = ToolManifestCache(cache_file).load(str(script))
+    assert server_name == "time_mcp_server"
+    assert [tool.name for tool in cached_tools] == ["now"]
+    # touched or checked out again, same content
+    os.utime(script, ns=(0, 0))
+    assert ToolManifestCache(cache_file).load(str(script)) is not None
+    script.write_text("# v2\n")
+    assert ToolManifestCache(cache_file).load(str(script)) is None
+
+
+def test_cached_server_is_started_on_the_first_call_only(tmp_path):
+    async def run():
+        # the first run starts the server and caches its tools
+        client = client_with_server(tmp_path)
+        await client.connect_to_servers(wait_all=True)
+        assert len(client.attempts) == 1
+        await client.cleanup()
+
+        client = client_with_server(tmp_path)
+        await client.connect_to_servers()
+        assert client.attempts == []
+        assert client.server_stats()["time_mcp_server"]["state"] == "deferred"
+        assert "now" in [tool["function"]["name"] for tool in client.tools]
+        # calls arriving together share one start
+        sessions = await asyncio.gather(*[client.get_session("time_mcp_server") for _ in range(3)])
+        assert len(client.attempts) == 1 and len(set(map(id, sessions))) == 1
+        assert (await sessions[0].call_tool("now", {})).content[0].text == "12:00"
+        await client.cleanup()
+
+        # a changed script is started at once
+        (tmp_path / "timetools.py").write_text("# the time server, edited\n")
+        client = client_with_server(tmp_path)
+        await client.connect_to_servers()
+        assert len(client.attempts) == 1
+        await client.cleanup()
+    asyncio.run(run())
+
+
+SUPERVISED = dict(LAZY_START=False, HEALTH_CHECK_INTERVAL=0.02, HEALTH_CHECK_TIMEOUT=0.05, HEALTH_CHECK_FAILURES=1,
+                  RECONNECT_BACKOFF_INITIAL=0.05, RECONNECT_BACKOFF_MAX=0.1, MAX_RECONNECT_ATTEMPTS=3, IDLE_TIMEOUT=0.0)
+
+
+def test_lost_server_is_reconnected_and_waited_for(tmp_path):
+    async def run():
+        client = client_with_server(tmp_path, **SUPERVISED)
+        await client.connect_to_servers(wait_all=True)
+        session = await client.get_session("time_mcp_server")
+        client.servers[0].cancel() # the server dies, its pings go unanswered
+        await wait_for(lambda: client.server_stats()["time_mcp_server"]["state"] == "reconnecting")
+        # a call made meanwhile gets the new session
+        new_session = await client.get_session("time_mcp_server")
+        assert new_session is not session
+        assert (await new_session.call_tool("now", {})).content[0].text == "12:00"
+        stats = client.server_stats()["time_mcp_server"]
+        assert stats["state"] == "ready" and stats["restarts"] == 1
+        assert stats["last_error"] == "health check failed"
+        await client.cleanup()
+    asyncio.run(run())
+
+
+def test_reconnects_back_off_and_give_up(tmp_path):
+    async def run():
+        client = client_with_server(tmp_path, **SUPERVISED)
+        await client.connect_to_servers(wait_all=True)
+        client.fail_start = True
+        client.servers[0].cancel()
+        await wait_for(lambda: client.server_stats()["time_mcp_server"]["state"] == "failed")
+        # connected once, then MAX_RECONNECT_ATTEMPTS failed reconnects
+        assert len(client.attempts) == 4
+        delays = [later - earlier for earlier, later in zip(client.attempts[1:], client.attempts[2:])]
+        assert 0.1 <= delays[0] and 0.1 <= delays[1] < 0.2 # doubled from 0.05, capped at RECONNECT_BACKOFF_MAX
+        assert client.server_stats()["time_mcp_server"]["last_error"] == "server process exited"
+        await client.cleanup()
+    asyncio.run(run())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import json
+import asyncio
+
+from jsonschema import Draft202012Validator
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
+
+from config import get_cfg_defaults
+from host import MyMCPClient
+
+ARGS = {"query": "weather"}
+
+
+def tool_call() -> ChatCompletionMessageToolCall:
+    return ChatCompletionMessageToolCall(id="call_0", type="function",
+                                         function=Function(name="brave_search", arguments=json.dumps(ARGS)))
+
+
+def client_with_confirmation() -> MyMCPClient:
+    """A client whose model streams one call of a speculative tool, with HOST.NEED_USER_CONFIRM on"""
+    cfg = get_cfg_defaults()
+    cfg.MODEL.STREAM = True
+    cfg.HOST.NEED_USER_CONFIRM = True
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    client._speculative_validators["brave_search"] = Draft202012Validator({"type": "object"})
+    client.events = []
+
+    async def execute_tool_call(tool_name, tool_args, conversation=None, speculative=False):
+        client.events.append(("call", speculative))
+        return "results"
+
+    async def get_response_message(conversation, on_tool_call=None, step_record=None):
+        on_tool_call(0, tool_call())
+        await asyncio.sleep(0.05) # the rest of the response is streamed
+        client.events.append(("response complete", None))
+        step_record.update(prompt_tokens=1, completion_tokens=1, cached_tokens=0, llm_latency=0.05, queue_wait=0.0)
+        return ChatCompletionMessage(role="assistant", content=None, tool_calls=[tool_call()])
+
+    async def prompt(question):
+        client.events.append(("asked", None))
+        return "y"
+
+    client.execute_tool_call = execute_tool_call
+    client.get_response_message = get_response_message
+    client.approvals.prompt = prompt
+    return client
+
+
+def test_nothing_runs_before_the_user_approves():
+    client = client_with_confirmation()
+    conversation = client.new_conversation(output=lambda text: None, interactive=True)
+    asyncio.run(client.send_messages(conversation))
+    assert client.events == [("response complete", None), ("asked", None), ("call", False)]
+
+
+def test_standing_approval_allows_speculation():
+    client = client_with_confirmation()
+    client.approvals.tools.add("brave_search")
+    conversation = client.new_conversation(output=lambda text: None, interactive=True)
+    step_record = asyncio.run(client.send_messages(conversation))
+    assert client.events == [("call", True), ("response complete", None)]
+    assert step_record["speculative_calls"] == 1
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from tool_cache import ToolResultCache
+
+KEY = ToolResultCache.make_key("server", "tool", {"a": 1})
+
+
+def test_cancelled_owner_does_not_cancel_waiters():
+    async def run():
+        cache = ToolResultCache()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "result"
+
+        owner = asyncio.create_task(cache.get_or_call(KEY, 60, call))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_call(KEY, 60, call))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        assert await waiter == "result"
+        assert calls == 1
+        assert cache.stats()["coalesced"] == 1
+        assert await cache.get_or_call(KEY, 60, call) == "result" # cached
+        assert calls == 1
+    asyncio.run(run())
+
+
+def test_call_cancelled_once_nobody_waits():
+    async def run():
+        cache = ToolResultCache()
+        cancelled = asyncio.Event()
+
+        async def call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(cache.get_or_call(KEY, 60, call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+        callers[1].cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.gather(*callers, return_exceptions=True)
+
+        async def fresh():
+            return "fresh"
+        # a later call starts over instead of joining the cancelled one
+        assert await cache.get_or_call(KEY, 60, fresh) == "fresh"
+    asyncio.run(run())
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    async def run():
+        cache = ToolResultCache()
+        calls = 0
+
+        async def failing():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("server down")
+
+        results = await asyncio.gather(*[cache.get_or_call(KEY, 60, failing) for _ in range(3)], return_exceptions=True)
+        assert calls == 1
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert cache.stats()["entries"] == 0
+    asyncio.run(run())
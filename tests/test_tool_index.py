@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from config import get_cfg_defaults
+from host import MyMCPClient
+from tool_index import ToolIndex, tokenize
+
+
+def tool(name: str, description: str, **params) -> dict:
+    properties = {param: {"type": "string", "description": text} for param, text in params.items()}
+    return {"type": "function", "function": {"name": name, "description": description,
+                                             "parameters": {"type": "object", "properties": properties}}}
+
+
+TOOLS = [
+    tool("get_current_time", "get current local time in ISO 8601 format"),
+    tool("search_photos", "search Unsplash for photos", query="what the photos show"),
+    tool("brave_web_search", "search the web with Brave", query="search terms"),
+    tool("send_email", "send an email to someone", to="address", body="text of the email"),
+    tool("translate_text", "translate text into another language", text="text", target="language code"),
+    tool("天气查询", "查询城市的天气预报", city="城市名"),
+]
+
+
+def test_tokenize_splits_names_and_cjk():
+    assert tokenize("getCurrentTime of brave_web_search") == ["get", "current", "time", "brave", "web", "search"]
+    assert tokenize("请查询北京的天气") == ["查", "询", "北", "京", "天", "气"]
+
+
+def test_search_returns_the_top_k_best_first():
+    index = ToolIndex()
+    index.build(TOOLS)
+    assert index.search("what time is it now?", 3) == ["get_current_time"] # only tools that match at all
+    assert index.search("find photos of cats", 1) == ["search_photos"]
+    assert index.search("search the web for photos", 2) == ["search_photos", "brave_web_search"]
+    assert index.search("明天北京天气怎么样", 3) == ["天气查询"]
+    assert index.search("nothing related", 3) == []
+
+
+def test_selected_tools_only_grow_at_the_end():
+    cfg = get_cfg_defaults()
+    cfg.HOST.TOOL_SELECTION_TOP_K = 2
+    cfg.HOST.TRANSCRIPT_FILE = ""
+    cfg.HOST.STEP_LOG_FILE = ""
+    cfg.TRACING.FILE = ""
+    client = MyMCPClient(cfg)
+    client.tools = TOOLS
+    client.tool_index.build(TOOLS)
+    conversation = client.new_conversation(output=lambda text: None)
+
+    def offered(query: str):
+        conversation.dialogue.append({"role": "user", "content": query})
+        return [tool["function"]["name"] for tool in client.select_tools(conversation)]
+
+    assert offered("send an email") == ["request_all_tools", "send_email"]
+    conversation.used_tools.add("send_email")
+    # the tools offered before stay in place, the new ones follow
+    assert offered("what time is it") == ["request_all_tools", "send_email", "get_current_time"]
+    conversation.all_tools = True
+    assert offered("anything") == [tool["function"]["name"] for tool in TOOLS]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import inspect
+from typing import TypedDict
+
+import anyio
+import pytest
+from mcp import ClientSession, types
+from mcp.server.fastmcp import FastMCP
+from mcp.shared.memory import create_client_server_memory_streams
+
+from host import ToolSession
+
+SCHEMA = {"type": "object", "properties": {"a": {"type": "integer"}}, "required": ["a"]}
+
+
+def session_with(schema: dict) -> ToolSession:
+    """A session that is not started, with the output schema of tool "t" as listed by list_tools"""
+    send_stream, receive_stream = anyio.create_memory_object_stream(0)
+    session = ToolSession(receive_stream, send_stream)
+    session._tool_output_schemas["t"] = schema
+    return session
+
+
+def validate(session: ToolSession, structured):
+    result = types.CallToolResult(content=[], structuredContent=structured)
+    asyncio.run(session._validate_tool_result("t", result))
+
+
+def test_structured_content_is_validated():
+    session = session_with(SCHEMA)
+    validate(session, {"a": 1})
+    with pytest.raises(RuntimeError, match="Invalid structured content returned by tool t"):
+        validate(session, {"a": "1"})
+    with pytest.raises(RuntimeError, match="did not return structured content"):
+        validate(session, None)
+
+
+@pytest.mark.parametrize("ref", ["#/$defs/missing", "https://example.com/schema.json"])
+def test_unresolved_ref_is_an_invalid_schema(ref):
+    session = session_with({"type": "object", "properties": {"a": {"$ref": ref}}})
+    with pytest.raises(RuntimeError, match="Invalid schema for tool t"):
+        validate(session, {"a": 1})
+
+
+def test_invalid_schema():
+    session = session_with({"type": "no such type"})
+    with pytest.raises(RuntimeError, match="Invalid schema for tool t"):
+        validate(session, {"a": 1})
+
+
+# ToolSession overrides a private hook of ClientSession, mcp==1.30.0 is pinned for it.
+# These tests fail if a new mcp version changes the hook's signature or when it is called.
+
+def test_private_hook_signature_is_unchanged():
+    hook = ClientSession._validate_tool_result
+    assert inspect.iscoroutinefunction(hook)
+    assert list(inspect.signature(hook).parameters) == ["self", "name", "result"]
+
+
+class SpySession(ToolSession):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.validated = []
+
+    async def _validate_tool_result(self, name, result):
+        self.validated.append(name)
+        await super()._validate_tool_result(name, result)
+
+
+class Point(TypedDict):
+    x: int
+    y: int
+
+
+def test_private_hook_validates_every_call_tool_result():
+    server = FastMCP("hook")
+
+    @server.tool()
+    def point() -> Point:
+        return {"x": 1, "y": 2}
+
+    async def run():
+        async with create_client_server_memory_streams() as (client_streams, server_streams):
+            async with anyio.create_task_group() as tg:
+                lowlevel = server._mcp_server
+                tg.start_soon(lambda: lowlevel.run(*server_streams, lowlevel.create_initialization_options()))
+                async with SpySession(*client_streams) as session:
+                    await session.initialize()
+                    # not listed yet: the hook lists the tools, which fills the output schemas
+                    result = await session.call_tool("point", {})
+                    assert result.structuredContent == {"x": 1, "y": 2}
+                    assert session.validated == ["point"]
+                    assert session._tool_output_schemas["point"]["required"] == ["x", "y"]
+                    # listed: the cached validator of ToolSession checks the content
+                    session._tool_output_schemas["point"] = {**SCHEMA, "required": ["z"]}
+                    with pytest.raises(RuntimeError, match="Invalid structured content returned by tool point"):
+                        await session.call_tool("point", {})
+                    assert session.validated == ["point", "point"]
+                tg.cancel_scope.cancel()
+    asyncio.run(run())
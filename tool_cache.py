@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具调用结果缓存：对只读且幂等的工具（由MCP工具注解readOnlyHint/idempotentHint或config.py声明），
+相同的 (server, tool, 参数) 在有效期内直接返回上次的结果，不再请求server。
+缓存按LRU淘汰，同一时刻相同参数的调用只会真正执行一次（single-flight），其余调用等待它的结果。
+真正的调用在缓存自己的task中进行，不属于任何一个调用者：某个调用者被取消（如丢弃的预先调用、另一个问题超时）
+不影响其他等待者，所有等待者都取消后才取消这次调用。
+'''
+
+import time
+import json
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+CacheKey = Tuple[str, str, str]
+
+
+class _Flight:
+    """A call in flight and the number of callers waiting for it"""
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class ToolResultCache:
+    def __init__(self, max_entries: int = 256):
+        """
+        Args:
+            max_entries: least recently used results are dropped beyond this size
+        """
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict() # key -> (expire time, result)
+        self._inflight: Dict[CacheKey, _Flight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0 # calls that waited for an identical call in flight
+
+    @staticmethod
+    def make_key(server_name: str, tool_name: str, tool_args: dict) -> CacheKey:
+        """Key of a call, arguments are canonicalized so that key order and spacing do not matter"""
+        return (server_name, tool_name, json.dumps(tool_args, sort_keys=True, ensure_ascii=False, separators=(",", ":")))
+
+    async def get_or_call(
+        self,
+        key: CacheKey,
+        ttl: float,
+        call: Callable[[], Awaitable[Any]],
+        cache_if: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """
+        Return the cached result of key, or await call() and cache its result for ttl seconds
+
+        Args:
+            key: from make_key
+            ttl: seconds the result stays valid
+            call: makes the real tool call
+            cache_if: results for which it returns False (e.g. errors) are returned but not cached
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            flight = _Flight(asyncio.create_task(self._call(key, ttl, call, cache_if)))
+            self._inflight[key] = flight
+        flight.waiters += 1
+        try:
+            # a cancelled caller stops waiting, the call goes on for the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # nobody waits any more, later callers start a new call
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
+
+    async def _call(self, key: CacheKey, ttl: float, call: Callable[[], Awaitable[Any]],
+                    cache_if: Optional[Callable[[Any], bool]]) -> Any:
+        try:
+            result = await call()
+        finally:
+            if key in self._inflight and self._inflight[key].task is asyncio.current_task():
+                del self._inflight[key]
+        if cache_if is None or cache_if(result):
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / total if total else 0.0,
+            "entries": len(self._entries),
+        }
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+'''
+工具检索：对工具名、描述和参数名建立BM25索引（纯本地计算，不需要网络或GPU），
+每次请求只把与问题最相关的top-k个工具发给模型，以减少工具列表占用的prompt token。
+中文按单字切分，英文按单词切分（驼峰和下划线命名会被拆开）。
+'''
+
+import re
+import math
+from collections import Counter
+from typing import Dict, List
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u2e80-\u9fff\uf900-\ufaff]")
+_STOPWORDS = {
+    "a", "an", "the", "to", "of", "in", "on", "at", "for", "by", "with", "from", "and", "or", "is", "are", "be",
+    "it", "this", "that", "i", "me", "my", "you", "your", "we", "can", "do", "please", "what", "how", "s",
+    "的", "了", "吗", "我", "你", "是", "在", "一", "个", "请", "把",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase words and single CJK characters without stopwords, camelCase and snake_case names are split too"""
+    if not text:
+        return []
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+def tool_text(tool: dict) -> str:
+    """Searchable text of a tool in OpenAI format: its name (counted twice), description and parameters"""
+    function = tool["function"]
+    parts = [function["name"], function["name"], function.get("description") or ""]
+    for param_name, param in ((function.get("parameters") or {}).get("properties") or {}).items():
+        parts.append(param_name)
+        if isinstance(param, dict):
+            parts.append(param.get("description") or "")
+    return " ".join(parts)
+
+
+class ToolIndex:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._names: List[str] = []
+        self._term_freqs: List[Counter] = []
+        self._lengths: List[int] = []
+        self._idf: Dict[str, float] = {}
+        self._avg_length = 0.0
+
+    def build(self, tools: List[dict]):
+        """Index tools in OpenAI format, replacing what was indexed before"""
+        self._names = [tool["function"]["name"] for tool in tools]
+        documents = [tokenize(tool_text(tool)) for tool in tools]
+        self._term_freqs = [Counter(document) for document in documents]
+        self._lengths = [len(document) for document in documents]
+        self._avg_length = sum(self._lengths) / len(documents) if documents else 0.0
+        doc_freqs = Counter(term for term_freq in self._term_freqs for term in term_freq)
+        self._idf = {
+            term: math.log(1 + (len(documents) - freq + 0.5) / (freq + 0.5)) for term, freq in doc_freqs.items()
+        }
+
+    def search(self, query: str, top_k: int) -> List[str]:
+        """Names of the top_k tools scoring above zero for the query, best first"""
+        terms = [term for term in set(tokenize(query)) if term in self._idf]
+        scores = []
+        for name, term_freq, length in zip(self._names, self._term_freqs, self._lengths):
+            score = 0.0
+            for term in terms:
+                freq = term_freq.get(term, 0)
+                if freq:
+                    norm = self.k1 * (1 - self.b + self.b * length / self._avg_length)
+                    score += self._idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, name))
+        scores.sort(key=lambda item: -item[0])
+        return [name for _, name in scores[:top_k]]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+'''
+轻量的耗时追踪：用嵌套的span记录一次对话各阶段（连接server、list_tools、请求模型、调用工具、agent循环）的耗时和属性
+（server、tool、model、token数等）。span结束时写入JSONL文件（由loguru的后台线程写入，见host.setup_logging），
+并计入Prometheus格式的直方图，可以通过 /metrics 接口查看。
+'''
+
+import json
+import time
+import uuid
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+trace_logger = logger.bind(trace=True)
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+# span attributes that become metric labels, the others (token counts, ids...) only go to the trace file
+METRIC_LABELS = ("server", "tool", "model")
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = 0.0
+        self.status = "ok"
+
+    def set(self, **attributes):
+        """Add attributes known only after the span started, such as token counts"""
+        self.attributes.update(attributes)
+
+    def to_record(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_time,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Metrics:
+    """Prometheus histograms and counters, kept in memory and rendered in the text exposition format"""
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List] = {} # (name, labels) -> [bucket counts, sum, count]
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._help: Dict[str, Tuple[str, str]] = {} # name -> (type, help)
+
+    def observe(self, name: str, value: float, help_text: str = "", **labels):
+        self._help.setdefault(name, ("histogram", help_text))
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        histogram = self._histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][idx] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def inc(self, name: str, value: float = 1, help_text: str = "", **labels):
+        self._help.setdefault(name, ("counter", help_text))
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram_total(self, name: str, **labels) -> Tuple[float, int]:
+        """Sum and count of a histogram over all its label sets that contain the given labels"""
+        wanted = {(k, str(v)) for k, v in labels.items()}
+        total, count = 0.0, 0
+        for (metric, metric_labels), (_, metric_sum, metric_count) in self._histograms.items():
+            if metric == name and wanted <= set(metric_labels):
+                total += metric_sum
+                count += metric_count
+        return total, count
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = ['{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._help.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric, labels), (counts, total, count) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append("{}_bucket{} {}".format(name, self._labels(labels, 'le="{}"'.format(bound)), bucket_count))
+                    lines.append("{}_bucket{} {}".format(name, self._labels(labels, 'le="+Inf"'), count))
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    def __init__(self, export_file: bool = True):
+        """
+        Args:
+            export_file: write finished spans to the trace sink (TRACING.FILE), metrics are always kept
+        """
+        self.export_file = export_file
+        self.metrics = Metrics()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Time the enclosed block as a span, nested in the span of the enclosing block (also across asyncio tasks,
+        which copy the context they are created in). Exceptions mark the span as failed and are re-raised.
+        """
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.status = "cancelled"
+            raise
+        except BaseException as e:
+            span.status = "error"
+            span.set(error=str(e))
+            raise
+        finally:
+            _current_span.reset(token)
+            span.duration = time.perf_counter() - span._start
+            self.end_span(span)
+
+    def end_span(self, span: Span):
+        labels = {key: span.attributes[key] for key in METRIC_LABELS if span.attributes.get(key) is not None}
+        self.metrics.observe("mcp_host_span_duration_seconds", span.duration, "Duration of host operations by span name",
+                             span=span.name, status=span.status, **labels)
+        if self.export_file:
+            trace_logger.info(json.dumps(span.to_record(), ensure_ascii=False, default=str))
+
+    def render_metrics(self) -> str:
+        return self.metrics.render()
+
+
+async def serve_metrics(tracer: Tracer, host: str, port: int):
+    """Serve GET /metrics on its own port, for the modes that have no web server (chat loop, batch)"""
+    # imported here so the web server packages are only needed when metrics are served
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    async def metrics(request):
+        return PlainTextResponse(tracer.render_metrics(), media_type="text/plain; version=0.0.4")
+
+    app = Starlette(routes=[Route("/metrics", metrics, methods=["GET"])])
+    await uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning")).serve()